@@ -0,0 +1,246 @@
+#! /usr/bin/env python3
+
+"""Benchmark of the Base32 and Base16 codecs of lib/base64.py.
+
+Times b32encode/b32decode/b16encode/b16decode against the struct and dict
+based code they replaced (kept below as legacy_*), and the *_into variants
+with a preallocated output buffer.  Every result is checked against the
+legacy code.
+
+Where the native loops of lib/b32viper.py load (firmware with the viper
+emitter), check_native() checks them against the portable Python loops and
+binascii that base64.py uses without them, bad characters included, and
+times both.
+
+Runs under CPython (with lib/ on the path) and on the GPy: copy this file
+and lib/base64.py (and lib/b32viper.py for the native loops) to the
+device, then
+
+    import bench_base32
+    bench_base32.run()
+
+usage: bench_base32.py [-n bytes] [-r repeats]
+"""
+
+import binascii
+import struct
+import sys
+
+try:
+    import utime
+
+    def clock_us():
+        return utime.ticks_us()
+
+    def elapsed_us(t):
+        return utime.ticks_diff(utime.ticks_us(), t)
+except ImportError:
+    import os
+    import time
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+    def clock_us():
+        return time.perf_counter()
+
+    def elapsed_us(t):
+        return int((time.perf_counter() - t) * 1e6)
+
+import base64
+
+
+# The code replaced by the table driven codec, without the argument checks
+
+_legacy_b32tab = b'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567'
+_legacy_b32rev = dict([(c, i) for i, c in enumerate(_legacy_b32tab)])
+
+
+def legacy_b32encode(s):
+    quanta, leftover = divmod(len(s), 5)
+    if leftover:
+        s = s + bytes(5 - leftover)
+        quanta += 1
+    encoded = bytearray()
+    for i in range(quanta):
+        c1, c2, c3 = struct.unpack('!HHB', s[i*5:(i+1)*5])
+        c2 += (c1 & 1) << 16
+        c3 += (c2 & 3) << 8
+        encoded += bytes([_legacy_b32tab[c1 >> 11],
+                          _legacy_b32tab[(c1 >> 6) & 0x1f],
+                          _legacy_b32tab[(c1 >> 1) & 0x1f],
+                          _legacy_b32tab[c2 >> 12],
+                          _legacy_b32tab[(c2 >> 7) & 0x1f],
+                          _legacy_b32tab[(c2 >> 2) & 0x1f],
+                          _legacy_b32tab[c3 >> 5],
+                          _legacy_b32tab[c3 & 0x1f],
+                          ])
+    if leftover:
+        cut = (0, 6, 4, 3, 1)[leftover]
+        encoded = encoded[:-cut] + b'=' * cut
+    return bytes(encoded)
+
+
+def legacy_b32decode(s):
+    padchars = s.find(b'=')
+    if padchars > 0:
+        padchars = len(s) - padchars
+        s = s[:-padchars]
+    else:
+        padchars = 0
+    parts = []
+    acc = 0
+    shift = 35
+    for c in s:
+        val = _legacy_b32rev.get(c)
+        if val is None:
+            raise binascii.Error('Non-base32 digit found')
+        acc += val << shift
+        shift -= 5
+        if shift < 0:
+            parts.append(binascii.unhexlify(bytes('%010x' % acc, "ascii")))
+            acc = 0
+            shift = 35
+    last = binascii.unhexlify(bytes('%010x' % acc, "ascii"))
+    keep = {0: 0, 1: 4, 3: 3, 4: 2, 6: 1}[padchars]
+    parts.append(last[:keep])
+    return b''.join(parts)
+
+
+def legacy_b16decode(s):
+    import re
+    if re.search(b'[^0-9A-F]', s):
+        raise binascii.Error('Non-base16 digit found')
+    return binascii.unhexlify(s)
+
+
+def timeit(name, f, arg, repeats, nbytes):
+    best = None
+    for i in range(repeats):
+        t = clock_us()
+        result = f(arg)
+        us = elapsed_us(t)
+        if best is None or us < best:
+            best = us
+    print('%-22s %9d us %9d KB/s' % (name, best, nbytes * 1000 // max(best, 1)))
+    return result
+
+
+def random_bytes(nbytes):
+    try:
+        import os
+        return os.urandom(nbytes)
+    except (ImportError, AttributeError):
+        import urandom
+        return bytes(urandom.getrandbits(8) for i in range(nbytes))
+
+
+def check_native(data, repeats):
+    """Check the viper loops against the portable ones and time both."""
+    viper = base64._viper
+    nbytes = len(data)
+    quanta = nbytes // 5
+    tab = base64._b32tab
+    rev = base64._b32rev
+
+    def b32encode_with(encode):
+        out = bytearray(quanta * 8)
+        encode(memoryview(data), memoryview(out), quanta, tab)
+        return out
+
+    b32 = timeit('portable b32 loop', lambda f: b32encode_with(f),
+                 base64._py_b32encode_quanta, repeats, nbytes)
+    assert timeit('native b32 loop', lambda f: b32encode_with(f),
+                  viper.b32encode_quanta, repeats, nbytes) == b32
+
+    def b32decode_with(decode, src):
+        out = bytearray(quanta * 5)
+        return decode(memoryview(src), memoryview(out), quanta, rev), out
+
+    n, raw = timeit('portable b32 decode', lambda f: b32decode_with(f, b32),
+                    base64._py_b32decode_quanta, repeats, nbytes)
+    assert (n, raw) == (quanta, bytearray(data[:quanta * 5]))
+    assert timeit('native b32 decode', lambda f: b32decode_with(f, b32),
+                  viper.b32decode_quanta, repeats, nbytes) == (n, raw)
+    # A bad character stops both at the same quantum
+    bad = bytearray(b32)
+    bad[len(bad) // 2] = ord('1')
+    assert (b32decode_with(viper.b32decode_quanta, bad)[0] ==
+            b32decode_with(base64._py_b32decode_quanta, bad)[0] == len(bad) // 16)
+
+    b16 = timeit('portable b16 encode', lambda s: binascii.hexlify(s).upper(),
+                 data, repeats, nbytes)
+    out = bytearray(2 * nbytes)
+    timeit('native b16 encode',
+           lambda s: viper.b16encode_block(memoryview(s), memoryview(out), nbytes,
+                                           base64._b16tab), data, repeats, nbytes)
+    assert out == b16
+    out = bytearray(nbytes)
+    assert timeit('portable b16 decode', base64._b16decode, b16, repeats,
+                  nbytes) == data
+    assert timeit('native b16 decode',
+                  lambda s: viper.b16decode_block(memoryview(s), memoryview(out),
+                                                  nbytes, base64._b16rev),
+                  b16, repeats, nbytes) == nbytes
+    assert out == data
+    bad = bytearray(b16)
+    bad[3] = ord('a')               # Lowercase is not Base16
+    assert viper.b16decode_block(memoryview(bad), memoryview(out), nbytes,
+                                 base64._b16rev) == 1
+
+
+def run(nbytes=4000, repeats=5):
+    data = random_bytes(nbytes)
+    print('%d bytes, best of %d, native loops: %s'
+          % (nbytes, repeats, 'yes' if base64._viper else 'no'))
+    if base64._viper:
+        check_native(data, repeats)
+
+    b32 = timeit('legacy b32encode', legacy_b32encode, data, repeats, nbytes)
+    assert timeit('b32encode', base64.b32encode, data, repeats, nbytes) == b32
+    out = bytearray(len(b32))
+    timeit('b32encode_into', lambda s: base64.b32encode_into(s, out), data,
+           repeats, nbytes)
+    assert out == b32
+
+    assert timeit('legacy b32decode', legacy_b32decode, b32, repeats,
+                  nbytes) == data
+    assert timeit('b32decode', base64.b32decode, b32, repeats, nbytes) == data
+    out = bytearray(len(b32) // 8 * 5)
+    n = timeit('b32decode_into', lambda s: base64.b32decode_into(s, out), b32,
+               repeats, nbytes)
+    assert out[:n] == data
+
+    b16 = timeit('hexlify().upper()', lambda s: binascii.hexlify(s).upper(),
+                 data, repeats, nbytes)
+    assert timeit('b16encode', base64.b16encode, data, repeats, nbytes) == b16
+    out = bytearray(len(b16))
+    timeit('b16encode_into', lambda s: base64.b16encode_into(s, out), data,
+           repeats, nbytes)
+    assert out == b16
+
+    assert timeit('legacy b16decode', legacy_b16decode, b16, repeats,
+                  nbytes) == data
+    assert timeit('b16decode', base64.b16decode, b16, repeats, nbytes) == data
+    out = bytearray(len(data))
+    timeit('b16decode_into', lambda s: base64.b16decode_into(s, out), b16,
+           repeats, nbytes)
+    assert out == data
+
+
+def main():
+    import getopt
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'n:r:')
+    except getopt.error as msg:
+        print(msg)
+        print(__doc__)
+        sys.exit(2)
+    nbytes = 4000
+    repeats = 5
+    for o, a in opts:
+        if o == '-n': nbytes = int(a)
+        if o == '-r': repeats = int(a)
+    run(nbytes, repeats)
+
+
+if __name__ == '__main__':
+    main()
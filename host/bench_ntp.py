@@ -0,0 +1,217 @@
+#! /usr/bin/env python3
+
+"""Benchmark and check of the NTP packet codec of lib/untplib.py.
+
+Times the struct.pack/unpack codec with whole-second timestamps that
+untplib had before (kept below as legacy_*) against to_data/from_data and
+pack_into/unpack_from with 32.32 fixed-point timestamps, and checks that
+a packet survives the round trip to the last bit.
+
+Under CPython it then queries a local SNTP stand-in whose clock runs
+offset seconds ahead of the host clock, with a one-way network delay of
+latency ms each way, and checks that NTPClient.request() finds the offset
+and the round-trip delay to the millisecond.
+
+Runs under CPython (with lib/ on the path) and on the GPy: copy this file,
+lib/untplib.py and lib/dnscache.py (with lib/wakestate.py) to the device,
+then
+
+    import bench_ntp
+    bench_ntp.run()
+
+usage: bench_ntp.py [-r repeats] [-o offset] [-l latency_ms]
+"""
+
+import struct
+import sys
+
+try:
+    import utime
+
+    def clock_us():
+        return utime.ticks_us()
+
+    def elapsed_us(t):
+        return utime.ticks_diff(utime.ticks_us(), t)
+except ImportError:
+    import os
+    import time
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+    def clock_us():
+        return time.perf_counter()
+
+    def elapsed_us(t):
+        return int((time.perf_counter() - t) * 1e6)
+
+import untplib
+from untplib import NTPPacket, NTPStats
+
+
+# The codec replaced by the fixed-point one: whole seconds, new bytes each time
+
+def legacy_to_data(p):
+    return struct.pack(NTPPacket._PACKET_FORMAT,
+                       (p.leap << 6 | p.version << 3 | p.mode),
+                       p.stratum, p.poll, p.precision,
+                       p.root_delay << 16, p.root_dispersion << 16, p.ref_id,
+                       p.ref_timestamp, 0, p.orig_timestamp, 0,
+                       p.recv_timestamp, 0, p.tx_timestamp, 0)
+
+
+def legacy_from_data(p, data):
+    unpacked = struct.unpack(NTPPacket._PACKET_FORMAT,
+                             data[0:struct.calcsize(NTPPacket._PACKET_FORMAT)])
+    p.leap = unpacked[0] >> 6 & 0x3
+    p.version = unpacked[0] >> 3 & 0x7
+    p.mode = unpacked[0] & 0x7
+    p.stratum = unpacked[1]
+    p.poll = unpacked[2]
+    p.precision = unpacked[3]
+    p.root_delay = unpacked[4] // 2**16
+    p.root_dispersion = unpacked[5] // 2**16
+    p.ref_id = unpacked[6]
+    p.ref_timestamp = unpacked[7]
+    p.orig_timestamp = unpacked[9]
+    p.recv_timestamp = unpacked[11]
+    p.tx_timestamp = unpacked[13]
+
+
+def timeit(name, f, repeats):
+    best = None
+    for i in range(repeats):
+        t = clock_us()
+        f()
+        us = elapsed_us(t)
+        if best is None or us < best:
+            best = us
+    print('%-28s %7d us' % (name, best))
+
+
+def sample_packet():
+    p = NTPStats()
+    p.leap, p.version, p.mode, p.stratum = 0, 4, 4, 2
+    p.poll, p.precision = 6, -23
+    p.root_delay = 0x00001234 << 16        # 16.16 values in 32.32
+    p.root_dispersion = 0x0000abcd << 16
+    p.ref_id = 0x47505300
+    p.ref_timestamp = 0xe4e0a3f012345678
+    p.orig_timestamp = 0xe4e0a4009abcdef0
+    p.recv_timestamp = 0xe4e0a400a0000001
+    p.tx_timestamp = 0xe4e0a400a0010002
+    return p
+
+
+def check_codec():
+    p = sample_packet()
+    buf = bytearray(64)
+    p.pack_into(buf, 8)
+    q = NTPStats()
+    q.unpack_from(buf, 8)
+    for name in NTPPacket.__slots__:
+        assert getattr(q, name) == getattr(p, name), name
+    assert bytes(p.to_data()) == bytes(buf[8:56])
+
+
+def bench_codec(repeats, n=200):
+    p = sample_packet()
+    legacy = NTPPacket()
+    legacy_from_data(legacy, p.to_data())
+    buf = bytearray(NTPPacket.PACKET_SIZE)
+    q = NTPStats()
+    print('%d packets, best of %d' % (n, repeats))
+
+    def legacy_codec():
+        for i in range(n):
+            legacy_from_data(legacy, legacy_to_data(legacy))
+
+    def data_codec():
+        for i in range(n):
+            q.from_data(p.to_data())
+
+    def into_codec():
+        for i in range(n):
+            p.pack_into(buf)
+            q.unpack_from(buf)
+
+    timeit('legacy pack/unpack', legacy_codec, repeats)
+    timeit('to_data/from_data', data_codec, repeats)
+    timeit('pack_into/unpack_from', into_codec, repeats)
+
+
+def sntp_server(offset, latency_ms):
+    """Start an SNTP server offset seconds ahead of this clock.  Return its port."""
+    import socket
+    import threading
+    import time
+
+    def ntp_now():
+        return untplib.system_us_to_ntp_time(int((time.time() + offset) * 1000000))
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(('127.0.0.1', 0))
+
+    def serve():
+        request = NTPPacket()
+        reply = NTPPacket(version=4, mode=4)
+        buf = bytearray(NTPPacket.PACKET_SIZE)
+        while True:
+            data, address = s.recvfrom(256)
+            time.sleep(latency_ms / 1000)       # The request on its way
+            recv = ntp_now()
+            request.unpack_from(data)
+            reply.stratum = 1
+            reply.ref_id = 0x47505300
+            reply.ref_timestamp = recv
+            reply.orig_timestamp = request.tx_timestamp
+            reply.recv_timestamp = recv
+            time.sleep(0.003)                   # Server processing
+            reply.tx_timestamp = ntp_now()
+            reply.pack_into(buf)
+            time.sleep(latency_ms / 1000)       # The reply on its way
+            s.sendto(buf, address)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return s.getsockname()[1]
+
+
+def check_offset(offset, latency_ms):
+    port = sntp_server(offset, latency_ms)
+    stats = untplib.NTPClient().request('127.0.0.1', version=4, port=port)
+    offset_us = stats.offset_us
+    delay_us = stats.delay_us
+    print('injected offset %+.6f s  measured %+.6f s  delay %.3f ms (%d ms on the wire)'
+          % (offset, offset_us / 1e6, delay_us / 1e3, 2 * latency_ms))
+    assert abs(offset_us - offset * 1e6) < 1000, 'offset'
+    assert abs(delay_us - 2000 * latency_ms) < 1000 + 300 * latency_ms, 'delay'
+
+
+def run(repeats=5, offset=12.345678, latency_ms=20):
+    check_codec()
+    bench_codec(repeats)
+    if sys.implementation.name != 'cpython':
+        return                  # No SNTP stand-in on the device
+    check_offset(offset, latency_ms)
+    check_offset(-offset / 10, latency_ms)
+
+
+def main():
+    import getopt
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'r:o:l:')
+    except getopt.error as msg:
+        print(msg)
+        print(__doc__)
+        sys.exit(2)
+    repeats = 5
+    offset = 12.345678
+    latency_ms = 20
+    for o, a in opts:
+        if o == '-r': repeats = int(a)
+        if o == '-o': offset = float(a)
+        if o == '-l': latency_ms = int(a)
+    run(repeats, offset, latency_ms)
+
+
+if __name__ == '__main__':
+    main()
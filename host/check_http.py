@@ -0,0 +1,452 @@
+#! /usr/bin/env python3
+
+"""Check lib/urequests.py and lib/arequests.py against a local HTTP server.
+
+Starts an HTTP/1.1 server in this process and runs urequests against it
+through the usocket made of CPython sockets of host/tlsbench.py, and
+arequests on CPython asyncio.  Each check asserts its results and prints
+what it measured:
+
+  upload     a body from a generator (sent chunked) and from a file with a
+             Content-Length, with the peak memory of the send
+  download   a body with a Content-Length and chunked, read with
+             iter_content() and readinto(), with the peak memory
+  redirect   302 after a POST (followed with a GET), 307 (the body is sent
+             again), max_redirects=0 and a redirect loop
+  keepalive  n requests on one Session over one connection, and a new
+             connection once the server has closed the idle one
+  timeout    a server slower than the read timeout, and a body that
+             trickles in past the deadline
+  async      n arequests requests run concurrently, with their time against
+             one request alone; n downloads of size and 4 * size bytes at
+             once, with the peak memory; a timeout, a deadline and a 307
+
+Peak memory is the CPython allocation peak (tracemalloc) above the memory in
+use before the check, the server thread included.  It is not the MicroPython
+heap, but shows whether a body is held whole in memory: each transfer is made
+with bodies of size and 4 * size bytes, and the peak must not grow with
+them.  CPython asyncio buffers a few hundred KB of each connection on its
+own, so the async peak is higher than on the GPy.
+
+usage: check_http.py [-n requests] [-s bytes]
+"""
+
+import asyncio
+import getopt
+import io
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+from tlsbench import micropython_modules
+
+_PATTERN = bytes((i * 7 + 3) & 255 for i in range(65536))
+
+
+def pattern(n):
+    """Yield the first n bytes of the test body in pieces of at most 64 KB."""
+    mv = memoryview(_PATTERN)
+    while n > 0:
+        k = min(n, len(mv))
+        yield mv[:k]
+        n -= k
+
+
+def pattern_crc(n):
+    crc = 0
+    for piece in pattern(n):
+        crc = zlib.crc32(piece, crc)
+    return crc
+
+
+class Handler(BaseHTTPRequestHandler):
+    """The test endpoints.
+
+    POST /echo           reply 'length crc32 chunked' of the request body
+    GET /blob?n=&chunked=1
+                         n bytes of the test body
+    GET|POST /redirect?status=&to=
+                         redirect with status to the path to
+    GET /loop            302 to itself
+    GET /slow?ms=        reply after ms
+    GET /drip?n=&ms=     n bytes, one 1 KB piece every ms
+    GET /close           reply and close the connection
+    """
+
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with Handler.lock:
+            Handler.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def query(self):
+        return {k: v[0] for k, v in parse_qs(urlsplit(self.path).query).items()}
+
+    def reply(self, body, status=200, headers=()):
+        self.send_response(status)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        # Return (length, crc32, chunked) of the request body, read in pieces
+        length = crc = 0
+        if 'chunked' in self.headers.get('Transfer-Encoding', ''):
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if not size:
+                    while self.rfile.readline() not in (b'\r\n', b''):
+                        pass
+                    return length, crc, True
+                while size:
+                    data = self.rfile.read(min(size, 16384))
+                    crc = zlib.crc32(data, crc)
+                    length += len(data)
+                    size -= len(data)
+                self.rfile.readline()
+        left = int(self.headers.get('Content-Length', 0))
+        while left:
+            data = self.rfile.read(min(left, 16384))
+            crc = zlib.crc32(data, crc)
+            length += len(data)
+            left -= len(data)
+        return length, crc, False
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        length, crc, chunked = self.read_body()
+        if path == '/redirect':
+            return self.redirect()
+        self.reply(b'%d %d %d' % (length, crc, chunked))
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        q = self.query()
+        try:
+            if path == '/blob':
+                self.blob(int(q['n']), q.get('chunked') == '1')
+            elif path == '/redirect':
+                self.redirect()
+            elif path == '/loop':
+                self.reply(b'', 302, (('Location', '/loop'),))
+            elif path == '/slow':
+                time.sleep(int(q['ms']) / 1000)
+                self.reply(b'slow')
+            elif path == '/drip':
+                self.drip(int(q['n']), int(q['ms']))
+            elif path == '/close':
+                self.reply(b'bye', headers=(('Connection', 'close'),))
+                self.close_connection = True
+            else:
+                self.reply(b'not found', 404)
+        except ConnectionError:
+            self.close_connection = True    # The client gave up (timeout checks)
+
+    def blob(self, n, chunked):
+        self.send_response(200)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Content-Length', str(n))
+        self.end_headers()
+        for piece in pattern(n):
+            if chunked:
+                # Chunks of varied sizes, some split across the client reads
+                for i in range(0, len(piece), 5000):
+                    part = piece[i:i + 5000]
+                    self.wfile.write(b'%x\r\n' % len(part))
+                    self.wfile.write(part)
+                    self.wfile.write(b'\r\n')
+            else:
+                self.wfile.write(piece)
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def redirect(self):
+        q = self.query()
+        self.reply(b'', int(q['status']), (('Location', q['to']),))
+
+    def drip(self, n, ms):
+        self.send_response(200)
+        self.send_header('Content-Length', str(n))
+        self.end_headers()
+        while n > 0:
+            k = min(n, 1024)
+            self.wfile.write(_PATTERN[:k])
+            self.wfile.flush()
+            n -= k
+            time.sleep(ms / 1000)
+
+
+def start_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+class Peak:
+    """Allocation peak above the memory in use at the start of a with block."""
+
+    def __enter__(self):
+        tracemalloc.reset_peak()
+        self.base = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def __exit__(self, *exc):
+        self.kb = (tracemalloc.get_traced_memory()[1] - self.base) // 1024
+
+
+def grows(peaks, size, n=1, buffered_kb=64):
+    """True if peaks (KB, for bodies of size and 4 * size bytes) grow with the body.
+
+    n bodies held whole would add n * 3 * size bytes; half of that, or
+    buffered_kb per body (what the sockets and streams of CPython may hold
+    whatever the reader does) if more, is allowed.
+    """
+    return peaks[1] - peaks[0] >= n * max(3 * size // 1024 // 2, buffered_kb)
+
+
+def streamed(what, measure, size):
+    """Assert that the peak of measure() does not grow with the body.
+
+    measure(n) transfers a body of n bytes inside a Peak() and returns it.
+    """
+    peaks = [measure(size).kb, measure(4 * size).kb]
+    print('%s: peak %d KB for %d bytes, %d KB for %d bytes'
+          % (what, peaks[0], size, peaks[1], 4 * size))
+    assert not grows(peaks, size), what + ': the body was held in memory'
+
+
+def check_upload(urequests, base, size):
+    def generator(n):
+        with Peak() as peak:
+            r = urequests.post(base + '/echo', data=pattern(n))
+            reply = r.content.split()
+        assert [int(x) for x in reply] == [n, pattern_crc(n), 1], reply
+        return peak
+
+    def file(n):
+        f = io.BytesIO(b''.join(pattern(n)))
+        with Peak() as peak:
+            r = urequests.post(base + '/echo', data=f,
+                               headers={'Content-Length': str(n)}, chunk_size=2048)
+            reply = r.content.split()
+        assert [int(x) for x in reply] == [n, pattern_crc(n), 0], reply
+        return peak
+
+    streamed('upload     from a generator, chunked', generator, size)
+    streamed('upload     from a file, Content-Length', file, size)
+
+
+def check_download(urequests, base, size):
+    crc = pattern_crc(size)
+    for chunked in (0, 1):
+        def download(n):
+            with Peak() as peak:
+                r = urequests.get(base + '/blob?n=%d&chunked=%d' % (n, chunked))
+                got = c = 0
+                for piece in r.iter_content(1024):
+                    got += len(piece)
+                    c = zlib.crc32(piece, c)
+            assert (got, c) == (n, pattern_crc(n)), (got, c)
+            return peak
+
+        streamed('download   %s, iter_content' % ('chunked' if chunked else 'Content-Length'),
+                 download, size)
+
+        buf = bytearray(1536)
+        r = urequests.get(base + '/blob?n=%d&chunked=%d' % (size, chunked))
+        n = c = 0
+        while True:
+            k = r.readinto(buf)
+            if not k:
+                break
+            n += k
+            c = zlib.crc32(buf[:k], c)
+        r.close()
+        assert (n, c) == (size, crc), (n, c)
+    assert urequests.get(base + '/blob?n=100000&chunked=1').content == b''.join(pattern(100000))
+
+
+def check_redirect(urequests, base):
+    # A 302 after a POST is followed with a GET, without the body
+    r = urequests.post(base + '/redirect?status=302&to=/blob?n=10', data=b'x' * 5000)
+    assert r.status_code == 200 and r.content == _PATTERN[:10]
+    # A 307 keeps the method and sends the body again
+    r = urequests.post(base + '/redirect?status=307&to=/echo', data=b'x' * 5000)
+    assert r.content.split()[0] == b'5000'
+    r = urequests.get(base + '/redirect?status=301&to=/blob?n=10', max_redirects=0)
+    assert r.status_code == 301
+    r.close()
+    try:
+        urequests.get(base + '/loop')
+    except ValueError as e:
+        print('redirect   302 after POST, 307 with body, max_redirects=0, loop:', e)
+    else:
+        raise AssertionError('redirect loop not stopped')
+
+
+def check_keepalive(urequests, base, n):
+    session = urequests.Session()
+    before = Handler.connections
+    for i in range(n):
+        r = session.get(base + '/blob?n=3000&chunked=%d' % (i & 1))
+        assert r.content == _PATTERN[:3000]
+        assert r.stats['reused'] == (i > 0)
+    r = session.post(base + '/echo', data=b'y' * 700)
+    assert r.content.split()[0] == b'700'
+    assert Handler.connections - before == 1, Handler.connections - before
+    assert session.connects == 1
+    # The server closes the connection after /close: the next request opens one
+    session.get(base + '/close').content
+    r = session.get(base + '/blob?n=10')
+    assert r.content == _PATTERN[:10] and not r.stats['reused']
+    session.close()
+    print('keepalive  %d requests on 1 connection, %d after a server close'
+          % (n + 1, Handler.connections - before))
+    assert Handler.connections - before == 2
+
+
+def check_timeout(urequests, base):
+    start = time.monotonic()
+    try:
+        urequests.get(base + '/slow?ms=1000', timeout=0.2)
+    except urequests.RequestTimeout as e:
+        assert e.phase == 'head', e.phase
+        ms = (time.monotonic() - start) * 1000
+        print('timeout    0.2 s read timeout: RequestTimeout in %s after %d ms' % (e.phase, ms))
+        assert ms < 600
+    else:
+        raise AssertionError('no timeout')
+
+    # Each piece comes within the timeout, the whole body does not within the deadline
+    start = time.monotonic()
+    try:
+        urequests.get(base + '/drip?n=20000&ms=50', timeout=1, deadline=0.4).content
+    except urequests.RequestTimeout as e:
+        assert e.phase == 'body', e.phase
+        ms = (time.monotonic() - start) * 1000
+        print('timeout    0.4 s deadline: RequestTimeout in %s after %d ms' % (e.phase, ms))
+        assert ms < 800
+    else:
+        raise AssertionError('no deadline')
+
+
+def check_async(base, n, size):
+    import arequests
+    crcs = {k * size: pattern_crc(k * size) for k in (1, 4)}
+
+    async def download(chunked, size):
+        r = await arequests.get(base + '/blob?n=%d&chunked=%d' % (size, chunked))
+        got = c = 0
+        async for piece in r.iter_content(1024):
+            got += len(piece)
+            c = zlib.crc32(piece, c)
+        assert (got, c) == (size, crcs[size]), (got, c)
+        return got
+
+    async def slow():
+        r = await arequests.get(base + '/slow?ms=300')
+        return await r.content
+
+    async def timeouts():
+        try:
+            await arequests.get(base + '/slow?ms=1000', timeout=0.2)
+        except arequests.RequestTimeout as e:
+            assert e.phase == 'head', e.phase
+        else:
+            raise AssertionError('no timeout')
+        try:
+            r = await arequests.get(base + '/drip?n=20000&ms=50', deadline=0.4)
+            await r.content
+        except arequests.RequestTimeout as e:
+            assert e.phase == 'body', e.phase
+        else:
+            raise AssertionError('no deadline')
+        r = await arequests.post(base + '/redirect?status=307&to=/echo', data=b'z' * 900)
+        assert (await r.content).split()[0] == b'900'
+
+    async def main():
+        start = time.monotonic()
+        await slow()
+        one = time.monotonic() - start
+        start = time.monotonic()
+        results = await asyncio.gather(*[slow() for i in range(n)])
+        assert results == [b'slow'] * n
+        together = time.monotonic() - start
+        print('async      %d requests of 300 ms each: %d ms together, %d ms alone'
+              % (n, together * 1000, one * 1000))
+        assert together < 2 * one, 'the requests did not run concurrently'
+
+        # CPython asyncio buffers a few hundred KB of each connection whatever
+        # the reader does (uasyncio does not), so the peak is compared with
+        # that of bodies four times as large: it must not grow with them
+        peaks = []
+        for k in (1, 4):
+            with Peak() as peak:
+                results = await asyncio.gather(*[download(i & 1, k * size)
+                                                 for i in range(n)])
+            assert results == [k * size] * n
+            peaks.append(peak.kb)
+        print('async      %d downloads at once: peak %d KB for %d bytes each, '
+              '%d KB for %d bytes' % (n, peaks[0], size, peaks[1], 4 * size))
+        assert not grows(peaks, size, n, 256), 'the bodies were held in memory'
+        await timeouts()
+        print('async      timeout, deadline and 307 redirect')
+
+    asyncio.run(main())
+
+
+def run(n=5, size=300000):
+    usocket, ussl = micropython_modules()
+    sys.modules['usocket'] = usocket
+    sys.modules['ussl'] = ussl
+    import urequests
+
+    base = start_server()
+    tracemalloc.start()
+    try:
+        check_upload(urequests, base, size)
+        check_download(urequests, base, size)
+        check_redirect(urequests, base)
+        check_keepalive(urequests, base, n)
+        check_timeout(urequests, base)
+        check_async(base, n, size)
+    finally:
+        tracemalloc.stop()
+    print('all checks passed')
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'n:s:')
+    except getopt.error as msg:
+        print(msg)
+        print(__doc__)
+        sys.exit(2)
+    n = 5
+    size = 300000
+    for o, a in opts:
+        if o == '-n': n = int(a)
+        if o == '-s': size = int(a)
+    run(n, size)
+
+
+if __name__ == '__main__':
+    main()
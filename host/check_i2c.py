@@ -0,0 +1,95 @@
+#! /usr/bin/env python3
+
+"""Check the I2C transactions of the DS3231 accesses of main.py.
+
+Runs the DS3231 accesses of a wake against the simulated DS3231 on the
+simulated I2C bus of host/sim, and asserts the number of I2C transactions
+of each, as counted by urtc (DS3231.transactions) and by the bus:
+
+  boot       the alarm set-up at the start of main.py: one load() burst read
+             of all the registers, then flush() writes alarm 1 (0x07-0x0a)
+             and control and status (0x0e-0x0f), one transaction each
+  set_clocks sync_rtc() on a wake without an NTP sync: one read of the time
+             and date registers
+  align      sync_rtc() with align, on a wake that synced NTP: the seconds
+             register polled every 2 ms until it ticks over, at most 1.1 s
+
+usage: check_i2c.py [-n wakes]
+"""
+
+import getopt
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, 'sim'), os.path.join(HERE, '..', 'lib')]
+
+import _sim
+import machine
+from _ds3231 import DS3231 as SimDS3231
+from urtc import DS3231
+
+BOOT = 3            # load(), flush() of alarm 1, flush() of control and status
+SET_CLOCKS = 1      # sync_rtc() without align
+
+
+def counted(ds3231, func):
+    """Return (urtc count, bus count) of the I2C transactions of func()."""
+    ds3231.transactions = 0
+    before = _sim.counters.get('i2c', 0)
+    func()
+    return ds3231.transactions, _sim.counters.get('i2c', 0) - before
+
+
+def boot(ds3231, next_hour, next_minute=5):
+    # The DS3231 accesses of the start of main.py, in the same order
+    ds3231.load()
+    ds3231.datetime()
+    ds3231.alarm_time((None, None, None, None, next_hour, next_minute, 0, None))
+    ds3231.alarm_time()
+    ds3231.no_interrupt()
+    ds3231.no_alarmflag()
+    ds3231.interrupt(alarm=0)
+    ds3231.flush()
+
+
+def run(wakes=5):
+    _sim.devices[('i2c', 0x68)] = device = SimDS3231(_sim.config['start'])
+    ds3231 = DS3231(machine.I2C(0, machine.I2C.MASTER, baudrate=100000))
+    rtc = machine.RTC()
+    for i in range(wakes):
+        # Wakes at various points of the second of the DS3231
+        _sim.advance_us(21600 * 1000000 + i * 317000)
+        n = counted(ds3231, lambda: boot(ds3231, (7, 13, 19, 1)[i % 4]))
+        assert n == (BOOT, BOOT), ('boot', n)
+        alarm = device.regs[0x07:0x0b]
+        assert alarm[0] == 0 and alarm[3] & 0x80, ('alarm', bytes(alarm))
+        assert device.regs[0x0e] & 0x05 == 0x05, 'alarm 1 interrupt not enabled'
+
+        n = counted(ds3231, lambda: ds3231.sync_rtc(rtc))
+        assert n == (SET_CLOCKS, SET_CLOCKS), ('set_clocks', n)
+
+        n = counted(ds3231, lambda: ds3231.sync_rtc(rtc, align=True))
+        assert n[0] == n[1] and 2 <= n[0] <= 1100 // 2 + 1, ('align', n)
+        error_ms = (_sim.rtc[0] - device.now()) * 1000
+        assert abs(error_ms) < 5, ('align error', error_ms)
+        print('wake %d: boot %d, set_clocks %d, align %d I2C transactions '
+              '(GPy clock %+.1f ms)' % (i + 1, BOOT, SET_CLOCKS, n[0], error_ms))
+    print('all checks passed')
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'n:')
+    except getopt.error as msg:
+        print(msg)
+        print(__doc__)
+        sys.exit(2)
+    wakes = 5
+    for o, a in opts:
+        if o == '-n': wakes = int(a)
+    run(wakes)
+
+
+if __name__ == '__main__':
+    main()
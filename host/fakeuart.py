@@ -0,0 +1,172 @@
+#! /usr/bin/env python3
+
+"""Fake ESP32-CAM UART for benchmarking lib/uartrx.py under CPython.
+
+FakeUART delivers a byte stream at the rate of a given baud rate (10 bits
+per byte), like machine.UART on the GPy: bytes that are not read before the
+receive buffer (rx_buffer_size) is full are lost and counted in overruns.
+The sender can pause at given offsets to simulate a stalled or hung camera.
+Time is the virtual clock of host/sim (utime), so the benchmark reports the
+time on the GPy, not on the host.
+
+Run as a script to benchmark the receive engine in direct and ring buffer
+mode, and to time the detection of a hung camera:
+
+usage: fakeuart.py [-b baudrate] [-n bytes]
+"""
+
+import getopt
+import os
+import sys
+import time
+
+sys.path[:0] = [os.path.join(os.path.dirname(__file__), 'sim'),
+                os.path.join(os.path.dirname(__file__), '..', 'lib')]
+
+import _sim
+import utime
+
+
+def virtual_clock():
+    return _sim.now_us / 1e6
+
+
+class FakeUART:
+
+    def __init__(self, data=b'', baudrate=38400, rx_buffer_size=4096,
+                 stalls=(), clock=virtual_clock):
+        """stalls is a list of (offset, seconds): the sender pauses for that
+        long before it sends the byte at offset (float('inf') for a hang)."""
+        self.clock = clock
+        self.baudrate = baudrate
+        self.rx_buffer_size = rx_buffer_size
+        self.written = bytearray()      # Bytes written by the GPy
+        self.overruns = 0
+        self.feed(data, stalls)
+
+    def init(self, baudrate=38400, bits=8, parity=None, stop=1, **kw):
+        self.baudrate = baudrate
+        self.rx_buffer_size = kw.get('rx_buffer_size', self.rx_buffer_size)
+
+    def deinit(self):
+        pass
+
+    def feed(self, data, stalls=()):
+        """Start sending data now."""
+        self.data = bytes(data)
+        self.stalls = sorted(stalls)
+        self.start = self.clock()
+        self.pos = 0
+
+    def _sent(self):
+        # Number of bytes the sender has put on the line so far
+        t = self.clock() - self.start
+        rate = self.baudrate / 10
+        sent = 0
+        for offset, pause in self.stalls:
+            if t * rate < offset - sent:
+                break
+            t -= (offset - sent) / rate
+            sent = offset
+            t -= pause
+            if t < 0:
+                return sent
+        return min(len(self.data), sent + int(t * rate))
+
+    def any(self):
+        sent = self._sent()
+        if sent - self.pos > self.rx_buffer_size:
+            self.overruns += sent - self.pos - self.rx_buffer_size
+            self.pos = sent - self.rx_buffer_size
+        return sent - self.pos
+
+    def readinto(self, buf, nbytes=None):
+        n = min(len(buf) if nbytes is None else nbytes, self.any())
+        if not n:
+            return None
+        buf[:n] = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def read(self, nbytes=None):
+        n = self.any() if nbytes is None else min(nbytes, self.any())
+        if not n:
+            return None
+        data = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return data
+
+    def readline(self):
+        n = self.any()
+        if not n:
+            return None
+        end = self.data.find(b'\n', self.pos, self.pos + n)
+        end = self.pos + n if end < 0 else end + 1
+        line = self.data[self.pos:end]
+        self.pos = end
+        return line
+
+    def write(self, buf):
+        self.written += buf
+        return len(buf)
+
+
+def bench(baudrate, nbytes, ring_size, chunk=1536):
+    from uartrx import UartReceiver
+    data = os.urandom(nbytes)
+    uart = FakeUART(data, baudrate)
+    rx = UartReceiver(uart, ring_size=ring_size)
+    buf = bytearray(chunk)
+    mv = memoryview(buf)
+    rx.start(60000)
+    cpu = time.process_time()
+    got = 0
+    while got < nbytes:
+        n = min(chunk, nbytes - got)
+        rx.readinto(mv, n)
+        got += n
+    cpu = time.process_time() - cpu
+    stats = rx.stats()
+    print('%7d baud %-10s %6d bytes %6d ms %7d B/s  cpu %4d ms  stalls %d'
+          '  max gap %d ms  overruns %d'
+          % (baudrate, 'ring %d' % ring_size if ring_size else 'direct',
+             stats['bytes'], stats['ms'],
+             stats['bytes'] * 1000 // max(stats['ms'], 1), cpu * 1000,
+             stats['stalls'], stats['max_gap_ms'], uart.overruns))
+
+
+def bench_hang(baudrate, gap_ms):
+    from uartrx import UartReceiver, UartTimeout
+    uart = FakeUART(os.urandom(20000), baudrate,
+                    stalls=[(10000, float('inf'))])
+    rx = UartReceiver(uart, gap_ms=gap_ms)
+    buf = bytearray(20000)
+    rx.start(60000)
+    t = utime.ticks_ms()
+    try:
+        rx.readinto(memoryview(buf), len(buf))
+    except UartTimeout as e:
+        print('hung camera detected after %d ms (gap %d ms): %s'
+              % (utime.ticks_diff(utime.ticks_ms(), t), gap_ms, e))
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'b:n:')
+    except getopt.error as msg:
+        print(msg)
+        print(__doc__)
+        sys.exit(2)
+    baudrates = (115200, 460800, 921600)
+    nbytes = 30000
+    for o, a in opts:
+        if o == '-b': baudrates = (int(a),)
+        if o == '-n': nbytes = int(a)
+    for baudrate in baudrates:
+        for ring_size in (0, 4096):
+            bench(baudrate, nbytes, ring_size)
+    bench_hang(baudrates[-1], 2000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+#! /usr/bin/env python3
+
+"""Reference picture receiver for local testing of the GPy upload modes.
+
+Runs under CPython on a PC.  Accepts the uploads sent by main.py:
+
+POST /file/base64  JSON document {"voltage", "base64File", "id", "timeStamp"}
+                   ('stream' and 'buffered' upload modes)
+POST /file/binary  raw JPEG bytes (application/octet-stream) with the metadata
+                   in the X-Station-Id, X-Voltage and X-Timestamp headers
+                   ('binary' upload mode)
+
+POST bodies may be sent with Content-Length or in chunked transfer encoding.
+HEAD /file/resumable/<upload id>
+                   Upload-Offset of a resumable upload ('resumable' upload mode)
+PATCH /file/resumable/<upload id>
+                   one chunk of a resumable upload at Upload-Offset.  Chunks are
+                   kept in <directory>/partial until Upload-Length bytes are held.
+                   The chunk at offset 0 carries the metadata headers and the
+                   wake trace; they are kept with the chunks (<upload id>.meta),
+                   so the later chunks and HEAD carry the offset and length only.
+
+Each picture is saved as <id>_<timestamp>_<voltage>.jpg in the output
+directory and the filename is returned in a JSON reply.  Point upload_host
+and upload_port in main.py at this machine to use it.
+
+The wake cycle traces sent with a picture (X-Wake-Trace header) are appended
+to trace.log in the output directory, one cycle per line after the station id.
+
+Fault injection: with -f rate, each resumable chunk is cut with the given
+probability, either part way through the body or by dropping the reply after
+the chunk was stored.  The number of picture bytes received for each upload
+is logged against the picture length to measure the bytes re-sent.
+
+usage: receiver.py [-p port] [-d directory] [-f rate]
+"""
+
+import base64
+import getopt
+import json
+import os
+import random
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def picture_filename(station_id, time_stamp, voltage):
+    """Return the filename used to store a picture.
+
+    Matches the picture filename the GPy sends to the ESP32-CAM, with the
+    time stamp digits only (no ':' so it is valid on any filesystem).
+    """
+    digits = ''.join(c for c in str(time_stamp) if c.isdigit())
+    return '%s_%s_%s.jpg' % (station_id, digits, voltage)
+
+
+class PictureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    directory = '.'
+    fault_rate = 0.0
+    received = {}       # Picture bytes received per resumable upload id
+
+    def read_body(self):
+        """Return the request body, None if it is cut short.
+
+        The body is read by Content-Length or in chunked transfer encoding.
+        """
+        if 'chunked' not in self.headers.get('Transfer-Encoding', ''):
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length)
+            return body if len(body) == length else None
+        parts = []
+        while True:
+            line = self.rfile.readline()
+            try:
+                size = int(line.split(b';')[0], 16)
+            except ValueError:
+                return None
+            if not size:
+                break
+            parts.append(self.rfile.read(size))
+            if len(parts[-1]) != size or self.rfile.readline() != b'\r\n':
+                return None
+        while self.rfile.readline() not in (b'\r\n', b''):
+            pass            # Trailer fields
+        return b''.join(parts)
+
+    def do_POST(self):
+        body = self.read_body()
+        if body is None:
+            return self.reply(400, {'error': 'short body'})
+        length = len(body)
+        if self.path == '/file/base64':
+            try:
+                doc = json.loads(body)
+                picture = base64.b64decode(doc['base64File'], validate=True)
+                meta = (doc['id'], doc['timeStamp'], doc['voltage'])
+            except (ValueError, KeyError) as e:
+                return self.reply(400, {'error': str(e)})
+        elif self.path == '/file/binary':
+            picture = body
+            meta = (self.headers.get('X-Station-Id'),
+                    self.headers.get('X-Timestamp'),
+                    self.headers.get('X-Voltage'))
+            if None in meta:
+                return self.reply(400, {'error': 'missing metadata header'})
+        else:
+            return self.reply(404, {'error': 'unknown path ' + self.path})
+        filename = picture_filename(*meta)
+        with open(os.path.join(self.directory, filename), 'wb') as f:
+            f.write(picture)
+        self.log_message('saved %s (%d bytes, %d on the wire)',
+                         filename, len(picture), length)
+        self.save_trace(meta[0])
+        self.reply(200, {'filename': filename})
+
+    def save_trace(self, station_id, trace=None):
+        """Append the wake cycle traces sent with a picture to trace.log."""
+        trace = trace or self.headers.get('X-Wake-Trace')
+        if not trace:
+            return
+        with open(os.path.join(self.directory, 'trace.log'), 'a') as f:
+            for cycle in trace.split(', '):
+                f.write('%s %s\n' % (station_id, cycle))
+
+    def resumable(self):
+        """Return the upload id, the chunk file, the finished picture file and
+        the metadata (station id, time stamp, voltage, wake trace).
+
+        The metadata comes from the headers of the first chunk, and from the
+        .meta file kept with the chunks for the later requests.  The picture
+        file is None while the metadata is unknown.
+        """
+        prefix = '/file/resumable/'
+        if not self.path.startswith(prefix):
+            return None, None, None, None
+        upload_id = os.path.basename(self.path[len(prefix):])
+        part = os.path.join(self.directory, 'partial', upload_id + '.part')
+        meta_file = os.path.join(self.directory, 'partial', upload_id + '.meta')
+        meta = [self.headers.get('X-Station-Id'),
+                self.headers.get('X-Timestamp'),
+                self.headers.get('X-Voltage'),
+                self.headers.get('X-Wake-Trace')]
+        if None not in meta[:3]:
+            os.makedirs(os.path.dirname(meta_file), exist_ok=True)
+            with open(meta_file, 'w') as f:
+                json.dump(meta, f)
+        elif os.path.exists(meta_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+        else:
+            return upload_id, part, None, None
+        return upload_id, part, os.path.join(self.directory,
+                                             picture_filename(*meta[:3])), meta
+
+    def do_HEAD(self):
+        upload_id, part, picture, meta = self.resumable()
+        if upload_id is None:
+            return self.reply(404, head=True)
+        if picture and os.path.exists(picture):
+            offset = os.path.getsize(picture)
+        elif os.path.exists(part):
+            offset = os.path.getsize(part)
+        else:
+            return self.reply(404, offset=0, head=True)
+        self.reply(200, offset=offset, head=True)
+
+    def do_PATCH(self):
+        upload_id, part, picture, meta = self.resumable()
+        if upload_id is None:
+            return self.reply(404, {'error': 'unknown path ' + self.path})
+        if picture is None:
+            return self.reply(400, {'error': 'missing metadata header'})
+        length = int(self.headers.get('Content-Length', 0))
+        offset = int(self.headers['Upload-Offset'])
+        total = int(self.headers['Upload-Length'])
+        current = os.path.getsize(part) if os.path.exists(part) else 0
+        if os.path.exists(picture):
+            current = os.path.getsize(picture)
+        if offset != current:
+            self.rfile.read(length)
+            return self.reply(409, {'error': 'offset mismatch'}, offset=current)
+
+        os.makedirs(os.path.dirname(part), exist_ok=True)
+        fault = random.random() < self.fault_rate
+        if fault and (random.random() < 0.5 or offset + length >= total):
+            # Cut the connection part way through the chunk
+            length = random.randrange(length)
+        body = self.rfile.read(length)
+        self.received[upload_id] = self.received.get(upload_id, 0) + len(body)
+        if fault or len(body) != int(self.headers['Content-Length']):
+            if not fault:
+                self.log_message('%s: chunk at %d cut by the client',
+                                 upload_id, offset)
+            elif len(body) == int(self.headers['Content-Length']):
+                # Keep the chunk but drop the reply
+                with open(part, 'ab') as f:
+                    f.write(body)
+                self.log_message('%s: fault, reply to chunk at %d dropped',
+                                 upload_id, offset)
+            else:
+                self.log_message('%s: fault, chunk at %d cut after %d bytes',
+                                 upload_id, offset, len(body))
+            self.close_connection = True
+            return
+
+        with open(part, 'ab') as f:
+            f.write(body)
+        offset += len(body)
+        if offset < total:
+            return self.reply(204, offset=offset)
+
+        os.replace(part, picture)
+        received = self.received.pop(upload_id, 0)
+        self.log_message('saved %s (%d bytes, %d received, %d re-sent)',
+                         os.path.basename(picture), total, received,
+                         received - total)
+        self.save_trace(meta[0], meta[3])
+        self.reply(200, {'filename': os.path.basename(picture)}, offset=offset)
+
+    def reply(self, code, doc=None, offset=None, head=False):
+        data = json.dumps(doc).encode() if doc is not None else b''
+        self.send_response(code)
+        if offset is not None:
+            self.send_header('Upload-Offset', str(offset))
+        if doc is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(data)
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'p:d:f:')
+    except getopt.error as msg:
+        print(msg)
+        print(__doc__)
+        sys.exit(2)
+    port = 8555
+    directory = '.'
+    for o, a in opts:
+        if o == '-p': port = int(a)
+        if o == '-d': directory = a
+        if o == '-f': PictureHandler.fault_rate = float(a)
+    os.makedirs(directory, exist_ok=True)
+    PictureHandler.directory = directory
+    server = ThreadingHTTPServer(('', port), PictureHandler)
+    print('Receiving pictures on port %d into %s' % (port, directory))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+# Emulated DS3231 real time clock on the simulated I2C bus.
+#
+# Registers 0x00-0x12 as in the datasheet: time and date (BCD, 24 hour),
+# alarm 1 and 2, control, status, aging offset and temperature.  The clock
+# runs at rtc_drift_ppm from _sim.config, less 0.1 ppm per LSB of the aging
+# offset.  When an alarm matches, its flag is set and, with INTCN and the
+# alarm interrupt enabled, INT/SQW (wired to P22) goes low until the flag is
+# cleared.
+
+import calendar
+import time
+
+import _sim
+
+CONTROL = 0x0e
+STATUS = 0x0f
+AGING = 0x10
+
+
+def _bcd(value):
+    return value + 6 * (value // 10)
+
+
+def _bin(value):
+    return value - 6 * (value >> 4)
+
+
+class DS3231:
+
+    def __init__(self, local_time, int_pin='P22', lost_power=False):
+        """local_time is the time the clock shows now, in seconds.  With
+        lost_power the backup battery was flat: the clock starts at
+        2000-01-01 with the oscillator stop flag set."""
+        self.regs = bytearray(0x13)
+        self.regs[CONTROL] = 0x1c               # INTCN, RS2, RS1
+        if lost_power:
+            local_time = 946684800
+            self.regs[STATUS] = 0x80
+        self.regs[0x11] = 25                    # 25.00 degrees C
+        self.int_pin = int_pin
+        self.pointer = 0
+        self.seconds = local_time
+        self.at_us = _sim.now_us
+        self.timers = [None, None]
+        self._schedule()
+
+    def gpy_reset(self):
+        # The timers of the virtual clock are cleared on a GPy reset
+        self.timers = [None, None]
+        self._schedule()
+
+    def rate(self):
+        aging = self.regs[AGING] - 256 if self.regs[AGING] & 0x80 else self.regs[AGING]
+        return 1 + (_sim.config['rtc_drift_ppm'] - 0.1 * aging) / 1e6
+
+    def now(self):
+        """Return the time the clock shows, in seconds."""
+        return self.seconds + (_sim.now_us - self.at_us) / 1e6 * self.rate()
+
+    def _rebase(self, seconds):
+        self.seconds = seconds
+        self.at_us = _sim.now_us
+
+    def _time_regs(self):
+        t = time.gmtime(int(self.now()))
+        return bytes((_bcd(t.tm_sec), _bcd(t.tm_min), _bcd(t.tm_hour),
+                      t.tm_wday + 1, _bcd(t.tm_mday), _bcd(t.tm_mon),
+                      _bcd(t.tm_year % 100)))
+
+    def read(self, reg, n):
+        if reg is None:
+            reg = self.pointer
+        self.regs[0:7] = self._time_regs()
+        data = bytearray()
+        for i in range(n):
+            data.append(self.regs[(reg + i) % len(self.regs)])
+        self.pointer = (reg + n) % len(self.regs)
+        return data
+
+    def write(self, reg, data):
+        self.regs[0:7] = self._time_regs()
+        self._rebase(self.now())                # The aging offset changes the rate from now
+        fraction = self.now() % 1
+        time_written = False
+        for i, b in enumerate(data):
+            r = (reg + i) % len(self.regs)
+            if r == STATUS:
+                # OSF and the alarm flags can only be cleared, BSY is read only
+                b = (b & 0x78) | (self.regs[STATUS] & b & 0x83)
+            if r < 7:
+                time_written = True
+                if r == 0:
+                    fraction = 0        # Writing the seconds restarts the second
+            if r == CONTROL:
+                b &= ~0x20              # CONV: the conversion is done at once
+            if r < 0x11:                # The temperature is read only
+                self.regs[r] = b
+        self.pointer = (reg + len(data)) % len(self.regs)
+        if time_written:
+            r = self.regs
+            self._rebase(calendar.timegm((2000 + _bin(r[6]), _bin(r[5] & 0x1f),
+                                          _bin(r[4]), _bin(r[2] & 0x3f),
+                                          _bin(r[1]), _bin(r[0]), 0, 0, 0))
+                         + fraction)
+        self._interrupt()
+        self._schedule()
+
+    def _match(self, alarm, t):
+        # Return True if the alarm registers match the time t (struct_time)
+        r = self.regs
+        if alarm == 0:
+            fields = [(r[7], t.tm_sec), (r[8], t.tm_min), (r[9], t.tm_hour)]
+            day = r[10]
+        else:
+            if t.tm_sec:
+                return False
+            fields = [(r[11], t.tm_min), (r[12], t.tm_hour)]
+            day = r[13]
+        for reg, value in fields:
+            if not reg & 0x80 and _bin(reg & 0x7f) != value:
+                return False
+        if day & 0x80:
+            return True
+        if day & 0x40:
+            return _bin(day & 0x0f) == t.tm_wday + 1
+        return _bin(day & 0x3f) == t.tm_mday
+
+    def _next(self, alarm):
+        # Seconds from now to the next match of the alarm (None: not within 2 days)
+        now = self.now()
+        t0 = int(now) + 1
+        # Step by one second while the seconds are masked, otherwise jump to
+        # the candidates whose seconds match
+        r = self.regs
+        if alarm == 0 and not r[7] & 0x80:
+            sec = _bin(r[7] & 0x7f)
+            first = t0 + (sec - t0 % 60) % 60
+            step = 60
+        elif alarm == 1:
+            first = t0 + (-t0) % 60
+            step = 60
+        else:
+            first = t0
+            step = 1
+        t = first
+        while t - t0 < 2 * 86400:
+            if self._match(alarm, time.gmtime(t)):
+                return t - now
+            t += step
+        return None
+
+    def _schedule(self):
+        for alarm in (0, 1):
+            if self.timers[alarm] is not None:
+                _sim.cancel(self.timers[alarm])
+                self.timers[alarm] = None
+            seconds = self._next(alarm)
+            if seconds is not None:
+                at = _sim.now_us + int(seconds / self.rate() * 1e6) + 1
+                self.timers[alarm] = _sim.schedule(at, lambda a=alarm: self._fire(a))
+
+    def _fire(self, alarm):
+        self.timers[alarm] = None
+        self.regs[STATUS] |= 1 << alarm
+        self._interrupt()
+        self._schedule()
+
+    def _interrupt(self):
+        c = self.regs[CONTROL]
+        active = (c & 0x04 and self.regs[STATUS] & c & 0x03)
+        _sim.drive(self.int_pin, 0 if active else 1)
@@ -0,0 +1,210 @@
+# Emulated ESP32-CAM on the simulated UART 1.
+#
+# A rising edge on its RESET line (P8) boots the camera.  It then answers the
+# protocol of main.py and lib/camlink.py:
+#
+#   'Hello\0'          -> 'ready' (once booted)
+#   'BAUD <rate>\0'    -> 'OK <rate>' and a switch to that rate if rate is at
+#                         most max_baudrate, else 'NO'.
+#   '<filename>\0'     -> after capture_ms, '<length>\r\n' and the picture,
+#                         raw at the base rate or in CRC framed blocks (with
+#                         ACK/NAK) at a negotiated rate.
+#
+# A camera without negotiation (the firmware before it) takes any message
+# after 'ready', a BAUD request too, as the picture filename.  names lists the
+# filenames of the pictures taken since the last boot.
+#
+# The picture is a JPEG file or a recording of the bytes an ESP32-CAM sent
+# after the filename (the length line and the picture), replayed at the rate
+# in use.  corrupt_rate is the probability that a block (framed) or a
+# 1 KB stretch (raw) arrives with a flipped byte; stalls is a list of
+# (offset, ms) pauses of the sender.
+
+import zlib
+
+import _sim
+
+_SYNC = 0xa5
+_ACK = 0x06
+_NAK = 0x15
+
+_BOOT_LOG = (b'ets Jun  8 2016 00:22:57\r\n\r\nrst:0x1 (POWERON_RESET),boot:0x13 '
+             b'(SPI_FAST_FLASH_BOOT)\r\nconfigsip: 0, SPIWP:0xee\r\n'
+             b'load:0x3fff0018,len:4\r\nentry 0x400806b4\r\n')
+
+
+def recording(data):
+    """Return the picture in a recording of the bytes sent after the filename."""
+    line, _, rest = data.partition(b'\n')
+    return rest[:int(line.strip())]
+
+
+class Esp32Cam:
+
+    def __init__(self, picture, baudrate=38400, max_baudrate=921600,
+                 negotiate=True, boot_ms=900, capture_ms=1500,
+                 block_size=1024, ack_ms=500, corrupt_rate=0.0, stalls=(),
+                 reset_pin='P8'):
+        self.picture = bytes(picture)
+        self.base_baudrate = baudrate
+        self.max_baudrate = max_baudrate
+        self.negotiate = negotiate
+        self.boot_ms = boot_ms
+        self.capture_ms = capture_ms
+        self.block_size = block_size
+        self.ack_ms = ack_ms
+        self.corrupt_rate = corrupt_rate
+        self.stalls = sorted(stalls)
+        self.uart = None
+        self.reset_level = 1
+        self.pictures = 0
+        self.names = []
+        self.blocks = 0
+        self.resent = 0
+        _sim.wiring[reset_pin] = self.reset_line
+        self.gpy_reset()
+
+    def gpy_reset(self):
+        self.state = 'off'
+        self.baudrate = self.base_baudrate
+        self.framed = False
+        self.inbuf = b''
+        self.timer = None
+
+    def attach(self, uart):
+        self.uart = uart
+
+    def reset_line(self, level):
+        if level and not self.reset_level:
+            self.boot()
+        self.reset_level = level
+
+    def boot(self):
+        self.gpy_reset()
+        self.state = 'boot'
+        self.names = []
+        self.ready_us = _sim.now_us + self.boot_ms * 1000
+        if self.uart:
+            self.uart.send(_BOOT_LOG, 115200, 50000)
+
+    def _send(self, data, delay_us=0):
+        return self.uart.send(data, self.baudrate, delay_us)
+
+    def _after(self, us, func):
+        if self.timer is not None:
+            _sim.cancel(self.timer)
+        self.timer = _sim.schedule(us, func)
+
+    def receive(self, data, baudrate):
+        if self.state == 'off' or self.uart is None:
+            return
+        if baudrate != self.baudrate:
+            return              # Garbage at the wrong rate
+        self.inbuf += data
+        if self.state == 'sending':
+            while len(self.inbuf) >= 3:
+                reply, self.inbuf = self.inbuf[:3], self.inbuf[3:]
+                self._reply(reply)
+            return
+        while b'\0' in self.inbuf:
+            message, _, self.inbuf = self.inbuf.partition(b'\0')
+            self._message(message)
+
+    def _message(self, message):
+        if message == b'Hello':
+            if _sim.now_us >= self.ready_us:
+                if self.state == 'switching':
+                    self.framed = True
+                    if self.timer is not None:
+                        _sim.cancel(self.timer)
+                        self.timer = None
+                self.state = 'ready'
+                self._send(b'ready')
+        elif self.state != 'ready':
+            pass
+        elif message.startswith(b'BAUD ') and self.negotiate:
+            rate = int(message[5:])
+            if rate > self.max_baudrate:
+                self._send(b'NO\r\n')
+                return
+            end = self._send(b'OK %d\r\n' % rate)
+            self._after(end + 5000, lambda: self._switch(rate))
+        else:
+            # The filename: take the picture
+            self.state = 'capture'
+            self.pictures += 1
+            self.names.append(message.decode())
+            self._after(_sim.now_us + self.capture_ms * 1000, self._start)
+
+    def _switch(self, rate):
+        self.timer = None
+        self.baudrate = rate
+        self.state = 'switching'
+        # Return to the base rate if no Hello comes at the new rate
+        self._after(_sim.now_us + 1000000, self._fallback)
+
+    def _fallback(self):
+        self.timer = None
+        self.baudrate = self.base_baudrate
+        self.state = 'ready'
+
+    def _start(self):
+        self.timer = None
+        self._send(b'%d\r\n' % len(self.picture))
+        if not self.framed:
+            self.state = 'done'
+            self._send_raw()
+            return
+        self.state = 'sending'
+        self.seq = 0
+        self._send_block()
+
+    def _corrupt(self, data):
+        if not _sim.chance(self.corrupt_rate):
+            return data
+        data = bytearray(data)
+        data[_sim.rng.randrange(len(data))] ^= 0x10
+        return bytes(data)
+
+    def _stall_ms(self, start, end):
+        return sum(ms for offset, ms in self.stalls if start <= offset < end)
+
+    def _send_raw(self):
+        pos = 0
+        while pos < len(self.picture):
+            chunk = self.picture[pos:pos + 1024]
+            delay = self._stall_ms(pos, pos + len(chunk)) * 1000
+            self._send(self._corrupt(chunk), delay)
+            pos += len(chunk)
+
+    def _send_block(self):
+        start = self.seq * self.block_size
+        data = self.picture[start:start + self.block_size]
+        head = bytes((self.seq & 0xff, self.seq >> 8 & 0xff,
+                      len(data) & 0xff, len(data) >> 8))
+        crc = zlib.crc32(head + data) & 0xffffffff
+        block = bytes((_SYNC,)) + head + data + crc.to_bytes(4, 'little')
+        self.blocks += 1
+        delay = self._stall_ms(start, start + len(data)) * 1000
+        end = self._send(self._corrupt(block), delay)
+        self._after(end + self.ack_ms * 1000, self._timeout)
+
+    def _timeout(self):
+        self.timer = None
+        self.resent += 1
+        self._send_block()
+
+    def _reply(self, reply):
+        seq = reply[1] | reply[2] << 8
+        if reply[0] == _NAK:
+            self.resent += 1
+            self._send_block()
+        elif reply[0] == _ACK and seq == self.seq & 0xffff:
+            self.seq += 1
+            if self.seq * self.block_size >= len(self.picture):
+                if self.timer is not None:
+                    _sim.cancel(self.timer)
+                    self.timer = None
+                self.state = 'done'
+                return
+            self._send_block()
@@ -0,0 +1,206 @@
+# State shared by the stand-in GPy modules in host/sim: the virtual clock,
+#   timers, pins, the simulation settings and the counters reported by
+#   host/simulate.py.
+
+import os
+import random as _random
+import tempfile
+
+
+class Shutdown(BaseException):
+    """The simulated GPy was reset or went to deep sleep.
+
+    A BaseException so that the 'except Exception' handlers of main.py do not
+    catch it.  reason is 'reset', 'deepsleep' or 'sleep'; ms is the deep
+    sleep time.
+    """
+
+    def __init__(self, reason, ms=None):
+        BaseException.__init__(self, reason)
+        self.reason = reason
+        self.ms = ms
+
+
+# Settings.  host/simulate.py changes them before a wake cycle.
+config = {
+    'seed': 1,
+    'flash': os.path.join(tempfile.gettempdir(), 'gpy-flash'),
+    'start': 1633071900,        # Wall clock (UTC) at the start: 2021-10-01 07:05:00
+    'timezone': -5 * 3600,      # Local time of the DS3231 (set by NTP)
+    'boot_ms': 1200,            # Time from reset to main.py
+    'sleep_s': 600,             # utime.sleep() of this length or more ends the wake
+    'battery_v': 7.6,
+    # WiFi
+    'wifi_ms': 2500,            # Time to associate
+    'wifi_fail': 0.0,           # Probability that the association fails
+    # LTE
+    'attach_ms': 25000,         # Time to attach
+    'attach_fail': 0.0,         # Probability that an attach attempt fails
+    'lte_connect_ms': 2000,     # Time to start the data session
+    # IP
+    'dns_ms': 120,
+    'dns_fail': 0.0,
+    'rtt_ms': {'wifi': 40, 'lte': 180},
+    'bandwidth': {'wifi': 500000, 'lte': 20000},    # Upload bytes/s
+    'drop_rate': 0.0,           # Probability that a send drops the connection
+    'ntp_fail': 0.0,
+    'server': ('127.0.0.1', 8555),  # Every TCP connection goes to this server
+    # DS3231
+    'rtc_drift_ppm': 0.0,       # Positive: the DS3231 runs fast
+    'rtc_offset_s': 0,          # DS3231 time minus local time at the start
+}
+
+rng = _random.Random(config['seed'])
+
+now_us = 0          # Virtual time since the start of the simulation
+boot_us = 0         # now_us at the last reset; utime ticks count from here
+awake_us = None     # now_us when the wake ended (see utime.sleep)
+link = None         # 'wifi' or 'lte' while a data link is up
+counters = {}
+devices = {}        # ('i2c', address) or ('uart', bus) -> simulated device
+wiring = {}         # Output pin id -> function(level) of the connected device
+nvs = {}            # pycom non-volatile storage, kept over resets
+rtc = None          # (seconds, now_us) set by machine.RTC.init()
+wake_reason = 0     # machine.wake_reason() after the last reset
+wake_pins = None    # Pins set by machine.pin_sleep_wakeup()
+_timers = []
+_pins = {}          # Pin id -> machine.Pin
+_inputs = {}        # Pin id -> level driven by a simulated device
+_seq = 0
+
+
+def count(name, n=1):
+    counters[name] = counters.get(name, 0) + n
+
+
+def seed(value):
+    config['seed'] = value
+    rng.seed(value)
+
+
+def chance(p):
+    return p > 0 and rng.random() < p
+
+
+def wall():
+    """Return the true UTC time in seconds."""
+    return config['start'] + now_us / 1e6
+
+
+def schedule(at_us, func):
+    """Call func() when the virtual clock reaches at_us.  Return a handle."""
+    global _seq
+    _seq += 1
+    timer = [at_us, _seq, func]
+    _timers.append(timer)
+    return timer
+
+
+def cancel(timer):
+    if timer in _timers:
+        _timers.remove(timer)
+
+
+def advance_us(us):
+    """Move the virtual clock forward, running the timers that fall due."""
+    global now_us
+    end = now_us + max(0, int(us))
+    while True:
+        due = [t for t in _timers if t[0] <= end]
+        if not due:
+            break
+        timer = min(due)
+        _timers.remove(timer)
+        now_us = max(now_us, timer[0])
+        timer[2]()
+    now_us = end
+
+
+def advance_ms(ms):
+    advance_us(ms * 1000)
+
+
+def ticks_us():
+    return now_us - boot_us
+
+
+def register_pin(pin):
+    _pins[pin.id] = pin
+
+
+def input_level(pin_id):
+    return _inputs.get(pin_id, 1)
+
+
+def drive(pin_id, level):
+    """A device drives the input pin_id.  Runs the pin callback on an edge."""
+    old = _inputs.get(pin_id, 1)
+    _inputs[pin_id] = level
+    pin = _pins.get(pin_id)
+    if pin is not None and old != level:
+        pin._edge(level)
+
+
+def flash_path(path):
+    """Map a path on the GPy (/flash/...) to the simulated flash directory."""
+    path = str(path)
+    if path == '/flash' or path.startswith('/flash/'):
+        return os.path.join(config['flash'], path[7:])
+    return path
+
+
+def output(pin_id, level):
+    """The GPy drives the output pin_id."""
+    func = wiring.get(pin_id)
+    if func is not None:
+        func(level)
+
+
+def reset(reason=0):
+    """Start a new wake: the GPy was reset or woke up from deep sleep with
+    machine.wake_reason() reason.  Devices, NVS and the flash are kept."""
+    global boot_us, awake_us, link, rtc, wake_reason
+    del _timers[:]
+    _pins.clear()
+    boot_us = now_us
+    awake_us = None
+    link = None
+    rtc = None
+    wake_reason = reason
+    counters.clear()
+    for device in list(devices.values()):
+        if hasattr(device, 'gpy_reset'):
+            device.gpy_reset()
+    advance_ms(config['boot_ms'])
+
+
+def _next_timer():
+    return min(_timers)[0] if _timers else None
+
+
+def idle():
+    """main.py has ended: run the devices until one resets the GPy (raises
+    Shutdown).  Return if nothing is left to happen."""
+    while _timers:
+        advance_us(_next_timer() - now_us)
+
+
+def sleep_until_wake(ms):
+    """Deep sleep for ms (0: no timer) or until the pins set by
+    machine.pin_sleep_wakeup() wake the GPy.  Return the wake reason
+    (1 pin, 2 timer) or None if the GPy never wakes."""
+    _pins.clear()
+    end = now_us + ms * 1000 if ms else None
+    while True:
+        if wake_pins:
+            pins, mode, pull = wake_pins
+            levels = [input_level(pin) for pin in pins]
+            if mode == 0 and not any(levels) or mode == 1 and any(levels):
+                return 1
+        t = _next_timer()
+        if end is not None and (t is None or t >= end):
+            advance_us(end - now_us)
+            return 2
+        if t is None:
+            return None
+        advance_us(t - now_us)
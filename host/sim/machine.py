@@ -0,0 +1,369 @@
+# Stand-in for the Pycom machine module under CPython.
+#
+# Pins, the I2C bus and the UART talk to the simulated devices registered in
+# _sim.devices (the DS3231 on I2C, the ESP32-CAM on UART 1).  Driving P23
+# low resets the GPy, as on the board, and deepsleep() ends the wake; both
+# raise _sim.Shutdown.
+
+import _sim
+
+PWRON_RESET = 0
+HARD_RESET = 1
+WDT_RESET = 2
+DEEPSLEEP_RESET = 3
+SOFT_RESET = 4
+
+PWRON_WAKE = 0
+PIN_WAKE = 1
+RTC_WAKE = 2
+ULP_WAKE = 3
+
+WAKEUP_ALL_LOW = 0
+WAKEUP_ANY_HIGH = 1
+
+
+def idle():
+    _sim.advance_us(1000)
+
+
+def reset():
+    if _sim.awake_us is None:
+        _sim.awake_us = _sim.now_us
+    raise _sim.Shutdown('reset')
+
+
+def deepsleep(ms=0):
+    if _sim.awake_us is None:
+        _sim.awake_us = _sim.now_us
+    raise _sim.Shutdown('deepsleep', ms)
+
+
+def pin_sleep_wakeup(pins, mode, enable_pull=False):
+    _sim.wake_pins = (tuple(pins), mode, enable_pull)
+
+
+def wake_reason():
+    return (_sim.wake_reason, None)
+
+
+def reset_cause():
+    return DEEPSLEEP_RESET if _sim.wake_reason else PWRON_RESET
+
+
+def unique_id():
+    return b'\x24\x0a\xc4\x00\x00\x50'
+
+
+def freq():
+    return 160000000
+
+
+def _reset_line(level):
+    if not level:
+        reset()
+
+
+_sim.wiring.setdefault('P23', _reset_line)
+
+
+class WDT:
+
+    def __init__(self, id=0, timeout=5000):
+        self.timeout = timeout
+
+    def feed(self):
+        pass
+
+
+class Pin:
+    IN = 1
+    OUT = 2
+    OPEN_DRAIN = 7
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 1
+    IRQ_RISING = 2
+    IRQ_LOW_LEVEL = 4
+    IRQ_HIGH_LEVEL = 8
+
+    def __init__(self, id, mode=IN, pull=None, value=None, alt=-1):
+        self.id = id
+        self._mode = mode
+        self._pull = pull
+        self._level = 1
+        self._trigger = 0
+        self._handler = None
+        self._arg = None
+        _sim.register_pin(self)
+        if value is not None:
+            self.value(value)
+
+    def __call__(self, value=None):
+        return self.value(value)
+
+    def value(self, value=None):
+        if value is None:
+            if self._mode == Pin.IN:
+                return _sim.input_level(self.id)
+            return self._level & _sim.input_level(self.id)
+        value = 1 if value else 0
+        if value != self._level:
+            self._level = value
+            _sim.output(self.id, value)
+        self._level = value
+
+    def mode(self, mode=None):
+        if mode is None:
+            return self._mode
+        self._mode = mode
+
+    def pull(self, pull=None):
+        if pull is None:
+            return self._pull
+        self._pull = pull
+
+    def hold(self, hold=None):
+        pass
+
+    def callback(self, trigger, handler=None, arg=None):
+        self._trigger = trigger
+        self._handler = handler
+        self._arg = arg
+
+    def _edge(self, level):
+        if self._handler is None:
+            return
+        if (level and self._trigger & Pin.IRQ_RISING or
+                not level and self._trigger & Pin.IRQ_FALLING):
+            self._handler(self if self._arg is None else self._arg)
+
+
+class I2C:
+    MASTER = 0
+
+    def __init__(self, bus=0, mode=MASTER, baudrate=100000, pins=None):
+        self.bus = bus
+        self.baudrate = baudrate
+
+    def init(self, mode=MASTER, baudrate=100000, pins=None):
+        self.baudrate = baudrate
+
+    def deinit(self):
+        pass
+
+    def _device(self, addr, nbytes):
+        # Address, register and data bytes at 9 bits each, plus a start/stop
+        _sim.count('i2c')
+        _sim.advance_us((nbytes + 3) * 9 * 1000000 // self.baudrate + 20)
+        device = _sim.devices.get(('i2c', addr))
+        if device is None:
+            raise OSError(19)       # ENODEV: no acknowledge
+        return device
+
+    def scan(self):
+        return sorted(key[1] for key in _sim.devices if key[0] == 'i2c')
+
+    def readfrom_mem(self, addr, memaddr, nbytes, addrsize=8):
+        return bytes(self._device(addr, nbytes).read(memaddr, nbytes))
+
+    def readfrom_mem_into(self, addr, memaddr, buf, addrsize=8):
+        data = self._device(addr, len(buf)).read(memaddr, len(buf))
+        buf[:len(data)] = data
+
+    def writeto_mem(self, addr, memaddr, buf, addrsize=8):
+        self._device(addr, len(buf)).write(memaddr, bytes(buf))
+
+    def readfrom(self, addr, nbytes, stop=True):
+        return bytes(self._device(addr, nbytes).read(None, nbytes))
+
+    def readfrom_into(self, addr, buf, stop=True):
+        data = self._device(addr, len(buf)).read(None, len(buf))
+        buf[:len(data)] = data
+
+    def writeto(self, addr, buf, stop=True):
+        buf = bytes(buf)
+        device = self._device(addr, len(buf))
+        if buf:
+            device.write(buf[0], buf[1:])
+        return len(buf)
+
+
+class RTC:
+    INTERNAL_RC = 0
+    XTAL_32KHZ = 1
+
+    def __init__(self, id=0, datetime=None, source=INTERNAL_RC):
+        if datetime is not None:
+            self.init(datetime)
+
+    @staticmethod
+    def _seconds():
+        if _sim.rtc is None:
+            return _sim.ticks_us() / 1e6         # 1970 after a reset
+        seconds, at_us = _sim.rtc
+        return seconds + (_sim.now_us - at_us) / 1e6
+
+    def init(self, datetime=None, source=None):
+        import utime
+        if datetime is None:
+            datetime = (1970, 1, 1)
+        t = tuple(datetime) + (0,) * (7 - len(datetime))
+        _sim.rtc = (utime.mktime(t[:6] + (0, 0)) + t[6] / 1e6, _sim.now_us)
+
+    def now(self):
+        import utime
+        t = self._seconds()
+        return utime.gmtime(int(t))[:6] + (int(t * 1e6) % 1000000, None)
+
+    def ntp_sync(self, server, update_period=3600):
+        pass
+
+    def synced(self):
+        return False
+
+
+class ADC:
+    ATTN_0DB = 0
+    ATTN_2_5DB = 1
+    ATTN_6DB = 2
+    ATTN_11DB = 3
+
+    def __init__(self, id=0, bits=12):
+        self.bits = bits
+
+    def channel(self, pin=None, attn=ATTN_0DB):
+        return ADCChannel(pin, attn)
+
+    def vref(self, vref=None):
+        return 1100
+
+    def deinit(self):
+        pass
+
+
+class ADCChannel:
+    # The battery divider on P18: inverse of the calibration in battery_voltage()
+
+    def __init__(self, pin, attn):
+        self.pin = pin
+
+    def __call__(self):
+        return self.value()
+
+    def value(self):
+        volts = _sim.config['battery_v'] + _sim.rng.uniform(-0.01, 0.01)
+        return max(0, min(4095, int((volts - 0.544528802) / 0.001754703)))
+
+    def voltage(self):
+        return self.value() * 1100 // 4095
+
+
+class UART:
+    """UART whose peer (_sim.devices[('uart', bus)]) sends bytes at its baud rate.
+
+    Bytes arrive one frame time (10 bits) apart and are kept in a receive
+    buffer of rx_buffer_size bytes; bytes that arrive while it is full are
+    lost and counted in overruns.  Bytes sent at a baud rate other than the
+    UART's arrive corrupted.  Writes reach the peer at once.
+    """
+
+    def __init__(self, bus, baudrate=9600, bits=8, parity=None, stop=1,
+                 rx_buffer_size=512, **kw):
+        self.bus = bus
+        self.rx = bytearray()
+        self.overruns = 0
+        self.line = []          # [start_us, us_per_byte, data, delivered, baudrate]
+        self.init(baudrate, bits, parity, stop, rx_buffer_size=rx_buffer_size)
+        self.peer = _sim.devices.get(('uart', bus))
+        if self.peer is not None:
+            self.peer.attach(self)
+
+    def init(self, baudrate=9600, bits=8, parity=None, stop=1, **kw):
+        self._update()
+        self.baudrate = baudrate
+        self.rx_buffer_size = kw.get('rx_buffer_size',
+                                     getattr(self, 'rx_buffer_size', 512))
+
+    def deinit(self):
+        self.line = []
+        self.rx = bytearray()
+
+    def send(self, data, baudrate, delay_us=0):
+        """Called by the peer: send data at baudrate, delay_us after the
+        bytes sent before.  Return the time the last byte arrives."""
+        start = _sim.now_us
+        if self.line:
+            last = self.line[-1]
+            start = max(start, last[0] + len(last[2]) * last[1])
+        start += delay_us
+        us = 10e6 / baudrate
+        self.line.append([start, us, bytes(data), 0, baudrate])
+        return start + len(data) * us
+
+    def idle(self):
+        """Return True when the peer has nothing left to send."""
+        self._update()
+        return not self.line
+
+    def _update(self):
+        now = _sim.now_us
+        while self.line:
+            seg = self.line[0]
+            start, us, data, done, baudrate = seg
+            n = min(len(data), int((now - start) / us)) if now >= start else 0
+            if n > done:
+                chunk = data[done:n]
+                if baudrate != self.baudrate:
+                    chunk = bytes(b ^ 0x5a for b in chunk)
+                room = self.rx_buffer_size - len(self.rx)
+                if len(chunk) > room:
+                    self.overruns += len(chunk) - room
+                    chunk = chunk[:max(room, 0)]
+                self.rx += chunk
+                seg[3] = n
+            if n < len(data):
+                break
+            self.line.pop(0)
+
+    def any(self):
+        self._update()
+        return len(self.rx)
+
+    def _take(self, n):
+        data = bytes(self.rx[:n])
+        del self.rx[:n]
+        return data
+
+    def read(self, nbytes=None):
+        n = self.any()
+        if nbytes is not None:
+            n = min(n, nbytes)
+        return self._take(n) if n else None
+
+    def readinto(self, buf, nbytes=None):
+        n = self.any()
+        n = min(n, len(buf) if nbytes is None else nbytes)
+        if not n:
+            return None
+        buf[:n] = self._take(n)
+        return n
+
+    def readline(self):
+        n = self.any()
+        if not n:
+            return None
+        end = self.rx.find(b'\n')
+        return self._take(n if end < 0 else end + 1)
+
+    def write(self, buf):
+        if isinstance(buf, str):
+            buf = buf.encode()
+        buf = bytes(buf)
+        # The GPy waits for the bytes to go out
+        _sim.advance_us(len(buf) * 10e6 / self.baudrate)
+        if self.peer is not None:
+            self.peer.receive(buf, self.baudrate)
+        return len(buf)
+
+    def _poll(self, mask):
+        return 1 if self.any() else 0
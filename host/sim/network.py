@@ -0,0 +1,125 @@
+# Stand-in for the Pycom network module under CPython.
+#
+# WLAN and LTE come up after the times in _sim.config (wifi_ms, attach_ms,
+# lte_connect_ms, with 20% jitter) or never, with the failure rates
+# wifi_fail and attach_fail.  While one is up, _sim.link names it and the
+# sockets of usocket use its round trip time and bandwidth.
+
+import _sim
+
+
+def _jitter(ms):
+    return int(ms * 1000 * _sim.rng.uniform(0.8, 1.2))
+
+
+class _Radio:
+
+    def __init__(self):
+        self._up_us = None
+        self._timer = None
+
+    def _start(self, ms, fail, name):
+        self._stop()
+        if _sim.chance(fail):
+            return
+        self._up_us = _sim.now_us + _jitter(ms)
+        self._timer = _sim.schedule(self._up_us, lambda: self._link(name))
+
+    def _link(self, name):
+        self._timer = None
+        if name:
+            _sim.link = name
+
+    def _stop(self):
+        if self._timer is not None:
+            _sim.cancel(self._timer)
+        self._timer = None
+        self._up_us = None
+
+    def _up(self):
+        return self._up_us is not None and _sim.now_us >= self._up_us
+
+
+class WLAN(_Radio):
+    STA = 1
+    AP = 2
+    STA_AP = 3
+    INT_ANT = 0
+    EXT_ANT = 1
+    WEP = 1
+    WPA = 2
+    WPA2 = 3
+    WPA2_ENT = 5
+
+    def __init__(self, mode=STA, antenna=INT_ANT, max_tx_pwr=78, **kw):
+        _Radio.__init__(self)
+
+    def init(self, mode=STA, **kw):
+        pass
+
+    def connect(self, ssid, auth=None, timeout=None, **kw):
+        _sim.count('wifi_connect')
+        self._start(_sim.config['wifi_ms'], _sim.config['wifi_fail'], 'wifi')
+
+    def isconnected(self):
+        return self._up()
+
+    def disconnect(self):
+        self._stop()
+        if _sim.link == 'wifi':
+            _sim.link = None
+
+    def deinit(self):
+        self.disconnect()
+
+    def ifconfig(self, *args, **kw):
+        return ('192.168.1.50', '255.255.255.0', '192.168.1.1', '192.168.1.1')
+
+    def scan(self):
+        return []
+
+
+class LTE(_Radio):
+    IP = 'IP'
+    IPV4V6 = 'IPV4V6'
+
+    def __init__(self, carrier=None, **kw):
+        _Radio.__init__(self)
+        self._data = _Radio()
+
+    def attach(self, band=None, apn=None, type=None, **kw):
+        _sim.count('lte_attach')
+        self._start(_sim.config['attach_ms'], _sim.config['attach_fail'], None)
+
+    def isattached(self):
+        return self._up()
+
+    def connect(self, cid=1):
+        if not self._up():
+            raise OSError("LTE not attached")
+        self._data._start(_sim.config['lte_connect_ms'], 0, 'lte')
+
+    def isconnected(self):
+        return self._data._up()
+
+    def disconnect(self):
+        self._data._stop()
+        if _sim.link == 'lte':
+            _sim.link = None
+
+    def detach(self, reset=False):
+        self.disconnect()
+        self._stop()
+
+    def deinit(self, detach=True, reset=False, dettach=None):
+        self.detach()
+
+    def send_at_cmd(self, cmd, timeout=10000, **kw):
+        _sim.advance_us(20000)
+        return '\r\nOK\r\n'
+
+    def imei(self):
+        return '354347090000050'
+
+    def iccid(self):
+        return '89014103270000000050'
@@ -0,0 +1,56 @@
+# Stand-in for the pycom module under CPython.
+#
+# The non-volatile storage (nvs_*) is _sim.nvs, which lasts over resets.
+
+import _sim
+
+_heartbeat = True
+_rgb = 0
+
+
+def heartbeat(state=None):
+    global _heartbeat
+    if state is None:
+        return _heartbeat
+    _heartbeat = bool(state)
+
+
+def rgbled(color=None):
+    global _rgb
+    if color is None:
+        return _rgb
+    _rgb = color
+
+
+def nvs_set(key, value):
+    _sim.nvs[key] = int(value) & 0xffffffff
+
+
+def nvs_get(key, *default):
+    if key in _sim.nvs:
+        return _sim.nvs[key]
+    if default:
+        return default[0]
+    raise ValueError("no such key")
+
+
+def nvs_erase(key):
+    if key not in _sim.nvs:
+        raise KeyError(key)
+    del _sim.nvs[key]
+
+
+def nvs_erase_all():
+    _sim.nvs.clear()
+
+
+def heartbeat_on_boot(state=None):
+    pass
+
+
+def wifi_on_boot(state=None):
+    pass
+
+
+def lte_modem_en_on_boot(state=None):
+    pass
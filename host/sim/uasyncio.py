@@ -0,0 +1,203 @@
+# Stand-in for the MicroPython uasyncio module under CPython, in virtual time.
+#
+# A small scheduler of coroutines.  A task that sleeps waits for the virtual
+# clock; when every task waits, the clock moves on to the first wake up, so
+# a wake cycle runs as fast as the host allows.  _sim.Shutdown (reset or
+# deep sleep) goes straight through.
+
+import _sim
+
+
+class CancelledError(BaseException):
+    pass
+
+
+class TimeoutError(Exception):
+    pass
+
+
+class _Sleep:
+    # Awaited by sleep(): yields the time to wake up to the scheduler
+
+    def __init__(self, at_us):
+        self.at_us = at_us
+
+    def __await__(self):
+        yield self
+
+
+class _Wait:
+    # Awaited by Event.wait() and Task.__await__: yields the waiting list
+
+    def __init__(self, waiting):
+        self.waiting = waiting
+
+    def __await__(self):
+        yield self
+
+
+_ready = []         # Tasks to run now
+_sleeping = []      # (at_us, seq, task)
+_seq = 0
+_current = None
+
+
+def _schedule(task, at_us=None):
+    global _seq
+    if at_us is None or at_us <= _sim.now_us:
+        _ready.append(task)
+    else:
+        _seq += 1
+        _sleeping.append((at_us, _seq, task))
+
+
+class Task:
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.error = None
+        self.waiting = []
+        self.cancelling = False
+
+    def _step(self):
+        global _current
+        _current = self
+        try:
+            if self.cancelling:
+                self.cancelling = False
+                wait = self.coro.throw(CancelledError())
+            else:
+                wait = self.coro.send(None)
+        except StopIteration as e:
+            self._finish(e.value, None)
+        except CancelledError as e:
+            self._finish(None, e)
+        except Exception as e:
+            self._finish(None, e)
+        else:
+            if isinstance(wait, _Sleep):
+                _schedule(self, wait.at_us)
+            elif isinstance(wait, _Wait):
+                wait.waiting.append(self)
+            else:
+                _schedule(self)
+        finally:
+            _current = None
+
+    def _finish(self, result, error):
+        self.done = True
+        self.result = result
+        self.error = error
+        for task in self.waiting:
+            _schedule(task)
+        del self.waiting[:]
+
+    def __await__(self):
+        if not self.done:
+            yield _Wait(self.waiting)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def cancel(self):
+        if self.done:
+            return False
+        for i, entry in enumerate(_sleeping):
+            if entry[2] is self:
+                del _sleeping[i]
+                break
+        self.cancelling = True
+        if self not in _ready:
+            _ready.append(self)
+        return True
+
+
+def create_task(coro):
+    task = Task(coro)
+    _schedule(task)
+    return task
+
+
+def sleep_ms(ms):
+    return _Sleep(_sim.now_us + int(ms * 1000))
+
+
+def sleep(s):
+    return _Sleep(_sim.now_us + int(s * 1000000))
+
+
+class Event:
+
+    def __init__(self):
+        self.state = False
+        self.waiting = []
+
+    def is_set(self):
+        return self.state
+
+    def set(self):
+        self.state = True
+        for task in self.waiting:
+            _schedule(task)
+        del self.waiting[:]
+
+    def clear(self):
+        self.state = False
+
+    async def wait(self):
+        while not self.state:
+            await _Wait(self.waiting)
+        return True
+
+
+async def gather(*aws, return_exceptions=False):
+    tasks = [aw if isinstance(aw, Task) else create_task(aw) for aw in aws]
+    results = []
+    for task in tasks:
+        try:
+            results.append(await task)
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            results.append(e)
+    return results
+
+
+async def wait_for(aw, timeout):
+    task = aw if isinstance(aw, Task) else create_task(aw)
+    if timeout is None:
+        return await task
+    end = _sim.now_us + int(timeout * 1000000)
+    while not task.done and _sim.now_us < end:
+        await _Sleep(min(end, _sim.now_us + 1000))
+    if not task.done:
+        task.cancel()
+        raise TimeoutError
+    return await task
+
+
+def wait_for_ms(aw, timeout):
+    return wait_for(aw, timeout / 1000)
+
+
+def run(coro):
+    del _ready[:]
+    del _sleeping[:]
+    main = create_task(coro)
+    while not main.done:
+        if _ready:
+            task = _ready.pop(0)
+            if not task.done:
+                task._step()
+        elif _sleeping:
+            _sleeping.sort(key=lambda entry: entry[:2])
+            at_us, _, task = _sleeping.pop(0)
+            _sim.advance_us(at_us - _sim.now_us)
+            task._step()
+        else:
+            raise RuntimeError("deadlock: every task waits on an event")
+    if main.error is not None:
+        raise main.error
+    return main.result
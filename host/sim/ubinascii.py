@@ -0,0 +1,3 @@
+# Stand-in for the MicroPython ubinascii module under CPython
+
+from binascii import *
@@ -0,0 +1,3 @@
+# Stand-in for the MicroPython ucollections module under CPython
+
+from collections import *
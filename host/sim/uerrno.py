@@ -0,0 +1,3 @@
+# Stand-in for the MicroPython uerrno module under CPython
+
+from errno import *
@@ -0,0 +1,3 @@
+# Stand-in for the MicroPython ujson module under CPython
+
+from json import *
@@ -0,0 +1,61 @@
+# Stand-in for the MicroPython uos module under CPython.
+#
+# Paths under /flash are kept in _sim.config['flash'] on the host, which
+# lasts over resets like the flash of the GPy.
+
+import os as _os
+
+import _sim
+
+sep = '/'
+
+
+def _path(path):
+    return _sim.flash_path(path)
+
+
+def listdir(path='/flash'):
+    return sorted(_os.listdir(_path(path)))
+
+
+def stat(path):
+    return tuple(_os.stat(_path(path)))
+
+
+def remove(path):
+    _os.remove(_path(path))
+
+
+def rename(old, new):
+    _os.replace(_path(old), _path(new))
+
+
+def mkdir(path):
+    _os.mkdir(_path(path))
+
+
+def rmdir(path):
+    _os.rmdir(_path(path))
+
+
+def getcwd():
+    return '/flash'
+
+
+def statvfs(path='/flash'):
+    # About 4 MB of flash in 4 KB blocks, less what the files take
+    used = 0
+    for root, dirs, files in _os.walk(_sim.config['flash']):
+        used += sum(_os.path.getsize(_os.path.join(root, f)) for f in files)
+    total = 1024
+    free = max(0, total - (used + 4095) // 4096)
+    return (4096, 4096, total, free, free, 0, 0, 0, 0, 255)
+
+
+def urandom(n):
+    return bytes(_sim.rng.randrange(256) for _ in range(n))
+
+
+def uname():
+    return ('GPy', 'GPy', '1.20.2.r4', 'v1.11-783192e', 'GPy with ESP32',
+            '1.20.2.r4', '1.20.2.r4', '1.20.2.r4')
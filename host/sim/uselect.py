@@ -0,0 +1,49 @@
+# Stand-in for the MicroPython uselect module under CPython, in virtual time.
+#
+# Works with the simulated UART and sockets (their _poll method) and with
+# any object that has an any() method.  While nothing is ready, poll()
+# moves the virtual clock in 1 ms steps up to its timeout.
+
+import _sim
+
+POLLIN = 1
+POLLOUT = 4
+POLLERR = 8
+POLLHUP = 16
+
+
+def _events(obj, mask):
+    if hasattr(obj, '_poll'):
+        return obj._poll(mask) & (mask | POLLERR | POLLHUP)
+    if mask & POLLIN and obj.any():
+        return POLLIN
+    return 0
+
+
+class poll:
+
+    def __init__(self):
+        self.objects = {}
+
+    def register(self, obj, eventmask=POLLIN | POLLOUT):
+        self.objects[id(obj)] = (obj, eventmask)
+
+    def unregister(self, obj):
+        self.objects.pop(id(obj), None)
+
+    def modify(self, obj, eventmask):
+        self.objects[id(obj)] = (obj, eventmask)
+
+    def poll(self, timeout=-1):
+        end = _sim.now_us + timeout * 1000
+        while True:
+            ready = []
+            for obj, mask in self.objects.values():
+                events = _events(obj, mask)
+                if events:
+                    ready.append((obj, events))
+            if ready or 0 <= timeout and _sim.now_us >= end:
+                return ready
+            _sim.advance_us(1000)
+
+    ipoll = poll
@@ -0,0 +1,236 @@
+# Stand-in for the MicroPython usocket module under CPython.
+#
+# Names resolve to made-up addresses and every TCP connection goes to the
+# local ingest server in _sim.config['server'] (host/receiver.py).  The
+# virtual clock is charged for the network: DNS (dns_ms), one round trip for
+# the connect and for the first reply after a request, and the upload
+# bandwidth of the link for every byte sent.  UDP requests to port 123 are
+# answered by a simulated NTP server from the true time, after a round trip
+# of one to two times the link RTT (each server is its own distance away).  Bytes on the wire
+# are counted in _sim.counters (tx, rx).
+#
+# A non-blocking connect (settimeout(0)) raises EINPROGRESS and the socket
+# polls writable (uselect) one round trip later.
+
+import errno
+import select as _select
+import socket as _socket
+import struct
+import zlib
+
+import _sim
+
+AF_INET = 2
+AF_INET6 = 10
+SOCK_STREAM = 1
+SOCK_DGRAM = 2
+SOCK_RAW = 3
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+SOL_SOCKET = 0xfff
+SO_REUSEADDR = 4
+
+error = OSError
+timeout = _socket.timeout
+
+_NTP_DELTA = 2208988800
+
+
+def _link():
+    if _sim.link is None:
+        raise OSError(-202, "no network")
+    return _sim.link
+
+
+def _rtt_us():
+    return _sim.config['rtt_ms'][_link()] * 1000
+
+
+def _wire_us(n):
+    return n * 1000000 // _sim.config['bandwidth'][_link()]
+
+
+def getaddrinfo(host, port):
+    # As on the GPy: the host and port only, one TCP address
+    _link()
+    _sim.count('dns')
+    _sim.advance_us(_sim.config['dns_ms'] * 1000)
+    if _sim.chance(_sim.config['dns_fail']):
+        raise OSError(-202, "name resolution failed")
+    if host.replace('.', '').isdigit():
+        ip = host
+    else:
+        h = zlib.crc32(host.encode())
+        ip = '10.%d.%d.%d' % (h >> 16 & 0xff, h >> 8 & 0xff, h & 0xff or 1)
+    return [(AF_INET, SOCK_STREAM, IPPROTO_TCP, '', (ip, port))]
+
+
+def _ntp_reply(request, t):
+    seconds = int(t) + _NTP_DELTA
+    fraction = int((t % 1) * 2 ** 32)
+    packet = bytearray(48)
+    packet[0] = 0x24                        # LI 0, version 4, server
+    packet[1] = 2                           # Stratum
+    packet[2] = 6
+    packet[3] = 0xec
+    packet[12:16] = b'GPS\0'
+    struct.pack_into('!II', packet, 16, seconds - 60, 0)
+    packet[24:32] = request[40:48]          # Originate = client transmit time
+    struct.pack_into('!IIII', packet, 32, seconds, fraction, seconds, fraction)
+    return bytes(packet)
+
+
+class socket:
+
+    def __init__(self, af=AF_INET, type=SOCK_STREAM, proto=0):
+        self.type = type
+        self.s = None
+        self.timeout = None
+        self.rbuf = b''
+        self.ready_us = None        # End of a non-blocking connect
+        self.replied = True         # The next read needs one round trip
+        self.udp = []               # (arrival time, reply, address) of the UDP requests
+
+    def settimeout(self, value):
+        self.timeout = value
+
+    def setblocking(self, flag):
+        self.timeout = None if flag else 0
+
+    def setsockopt(self, level, option, value):
+        pass
+
+    def connect(self, address):
+        if self.type == SOCK_DGRAM:
+            self.peer = address
+            return
+        _link()
+        _sim.count('connect')
+        try:
+            self.s = _socket.create_connection(_sim.config['server'], 10)
+        except OSError:
+            raise OSError(errno.ECONNREFUSED, "connection refused")
+        if self.timeout == 0:
+            self.ready_us = _sim.now_us + _rtt_us()
+            raise OSError(errno.EINPROGRESS, "in progress")
+        _sim.advance_us(_rtt_us())
+
+    def _connected(self):
+        if self.s is None:
+            raise OSError(errno.ENOTCONN, "not connected")
+        if self.ready_us is not None:
+            if _sim.now_us < self.ready_us:
+                raise OSError(errno.EAGAIN, "connect in progress")
+            self.ready_us = None
+
+    def send(self, data):
+        self._connected()
+        data = bytes(data)
+        if _sim.chance(_sim.config['drop_rate']):
+            self.close()
+            raise OSError(errno.ECONNRESET, "connection reset")
+        _sim.advance_us(_wire_us(len(data)))
+        try:
+            self.s.sendall(data)
+        except OSError:
+            raise OSError(errno.ECONNRESET, "connection reset")
+        _sim.count('tx', len(data))
+        self.replied = False
+        return len(data)
+
+    sendall = send
+    write = send
+
+    def _fill(self):
+        # Wait for the next bytes from the server.  Return False at the end.
+        self._connected()
+        if not self.replied:
+            _sim.advance_us(_rtt_us())
+            self.replied = True
+        self.s.settimeout(30 if self.timeout is None else max(self.timeout, 1))
+        try:
+            data = self.s.recv(4096)
+        except _socket.timeout:
+            _sim.advance_us((self.timeout or 30) * 1000000)
+            raise timeout(errno.ETIMEDOUT, "timed out")
+        except OSError:
+            raise OSError(errno.ECONNRESET, "connection reset")
+        _sim.count('rx', len(data))
+        self.rbuf += data
+        return bool(data)
+
+    def _take(self, n):
+        data, self.rbuf = self.rbuf[:n], self.rbuf[n:]
+        return data
+
+    def recv(self, n):
+        if self.type == SOCK_DGRAM:
+            return self.recvfrom(n)[0]
+        if not self.rbuf:
+            self._fill()
+        return self._take(n)
+
+    def read(self, n=None):
+        while n is None or len(self.rbuf) < n:
+            if not self._fill():
+                break
+        return self._take(len(self.rbuf) if n is None else n)
+
+    def readinto(self, buf, n=None):
+        n = len(buf) if n is None else n
+        if not self.rbuf:
+            self._fill()
+        data = self._take(n)
+        buf[:len(data)] = data
+        return len(data)
+
+    def readline(self):
+        while b'\n' not in self.rbuf:
+            if not self._fill():
+                return self._take(len(self.rbuf))
+        return self._take(self.rbuf.index(b'\n') + 1)
+
+    def makefile(self, mode='rb', buffering=0):
+        return self
+
+    def close(self):
+        if self.s is not None:
+            self.s.close()
+            self.s = None
+
+    def sendto(self, data, address):
+        _link()
+        _sim.count('tx', len(data))
+        if address[1] == 123 and not _sim.chance(_sim.config['ntp_fail']):
+            rtt = _rtt_us() * (1 + zlib.crc32(address[0].encode()) % 100 / 100)
+            reply = _ntp_reply(bytes(data), _sim.wall() + rtt / 2e6)
+            self.udp.append((_sim.now_us + int(rtt), reply, address))
+            self.udp.sort()
+        return len(data)
+
+    def recvfrom(self, n):
+        if not self.udp:
+            if self.timeout == 0:
+                raise OSError(errno.EAGAIN, "would block")
+            _sim.advance_us((30 if self.timeout is None else self.timeout) * 1000000)
+            raise timeout(errno.ETIMEDOUT, "timed out")
+        at, reply, address = self.udp.pop(0)
+        _sim.advance_us(at - _sim.now_us)
+        _sim.count('rx', len(reply))
+        return reply[:n], address
+
+    def _poll(self, mask):
+        # uselect: return the events that are ready
+        events = 0
+        if self.type == SOCK_DGRAM:
+            if self.udp and _sim.now_us >= self.udp[0][0]:
+                events |= 1
+            return events
+        if self.s is None:
+            return 0
+        if mask & 4 and (self.ready_us is None or _sim.now_us >= self.ready_us):
+            events |= 4
+        if mask & 1 and self.replied and (
+                self.rbuf or _select.select([self.s], [], [], 0.001)[0]):
+            events |= 1
+        return events
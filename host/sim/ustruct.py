@@ -0,0 +1,3 @@
+# Stand-in for the MicroPython ustruct module under CPython
+
+from struct import *
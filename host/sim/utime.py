@@ -0,0 +1,78 @@
+# Stand-in for the Pycom utime module under CPython, in virtual time.
+#
+# The clock only moves when the GPy waits: sleep(), machine.idle(), a poll or
+# the simulated time of a UART, radio or socket operation.  The time of day
+# is the GPy RTC (machine.RTC), as on the device.
+#
+# A sleep of _sim.config['sleep_s'] or more ends the wake (main.py waits for
+# the DS3231 reset that way); the time of the wake is then kept in
+# _sim.awake_us and the sleep goes on, so the DS3231 alarm can reset the GPy.
+
+import calendar as _calendar
+import time as _time
+
+import _sim
+
+_timezone = 0
+
+
+def ticks_ms():
+    return _sim.ticks_us() // 1000
+
+
+def ticks_us():
+    return _sim.ticks_us()
+
+
+def ticks_cpu():
+    return _sim.ticks_us()
+
+
+def ticks_add(ticks, delta):
+    return ticks + delta
+
+
+def ticks_diff(end, start):
+    return end - start
+
+
+def sleep_us(us):
+    _sim.advance_us(us)
+
+
+def sleep_ms(ms):
+    _sim.advance_us(ms * 1000)
+
+
+def sleep(s):
+    if s >= _sim.config['sleep_s'] and _sim.awake_us is None:
+        _sim.awake_us = _sim.now_us
+    _sim.advance_us(s * 1000000)
+
+
+def timezone(offset=None):
+    global _timezone
+    if offset is None:
+        return _timezone
+    _timezone = offset
+
+
+def time():
+    import machine
+    return int(machine.RTC._seconds())
+
+
+def gmtime(secs=None):
+    if secs is None:
+        secs = time()
+    return tuple(_time.gmtime(secs))[:8]
+
+
+def localtime(secs=None):
+    if secs is None:
+        secs = time()
+    return tuple(_time.gmtime(secs + _timezone))[:8]
+
+
+def mktime(t):
+    return _calendar.timegm(tuple(t[:6]) + (0, 0, 0))
@@ -0,0 +1,376 @@
+#! /usr/bin/env python3
+
+"""Run main.py under CPython against a simulated GPy, camera, clock and network.
+
+The stand-in modules in host/sim replace the MicroPython and Pycom modules:
+machine (pins, I2C, UART, RTC, ADC), network (WiFi, LTE), usocket, uselect,
+uasyncio, utime, uos and pycom.  They run in virtual time: the clock moves by
+the simulated time of each radio, socket, UART or I2C operation and of each
+sleep, so a wake cycle of a minute on the GPy runs in well under a second.
+
+A simulated DS3231 (host/sim/_ds3231.py) sits on the I2C bus and wakes the
+GPy at its alarm (P22 deep sleep wake, or a reset through P23), and a simulated ESP32-CAM
+(host/sim/_esp32cam.py) answers on UART 1.  TCP connections go to
+host/receiver.py, started on a local port, so the uploads are checked
+end to end.  The flash (/flash) is a temporary directory that is kept from
+one wake cycle to the next, as are the NVS and the devices.
+
+Each wake cycle is reported with the phase timings of the wake trace (see
+lib/trace.py), the time the GPy was awake, the bytes on the wire, the peak
+memory, whether the picture reached the receiver intact, the sleep time
+until the next wake and the battery charge used (with the currents set in
+main.py) and the errors of the DS3231 and GPy clocks.  The wake ends
+at machine.deepsleep(), a reset, or the first sleep of 10 minutes or more
+(the shutdown() wait for the DS3231 alarm).  Peak memory is the CPython
+allocation peak (tracemalloc) during the cycle, after the module imports and
+including the receiver thread.  It tracks the buffers main.py holds but is not the
+MicroPython heap.
+
+usage: simulate.py [-n cycles] [-m mode] [-p] [-l] [-s bytes | -j file | -r file]
+                   [-b baudrate] [-a ms] [-f rate] [-x rate] [-c rate] [-d ppm]
+                   [-o seconds] [-S seed]
+                   [-D name=value ...] [-v]
+
+-n cycles   wake cycles to run (1)
+-m mode     upload_mode of main.py (binary, stream, buffered, resumable)
+-p          run the steps one after the other (wake_pipeline = False)
+-l          connect with LTE (use_lte = True)
+-s bytes    size of the synthetic picture (30000)
+-j file     send this JPEG file
+-r file     replay a recording of the bytes an ESP32-CAM sent after the
+            picture filename (the length line and the picture)
+-b baudrate highest baud rate the camera accepts (0: the camera firmware
+            before negotiation, which takes a BAUD request as the picture
+            filename).  main.py negotiates with -D camera_negotiate=True
+-a ms       LTE attach time
+-f rate     receiver fault rate for resumable chunks (receiver.py -f)
+-x rate     probability that a send drops the connection
+-c rate     probability that a camera block arrives corrupted
+-d ppm      drift of the DS3231 (positive: it runs fast)
+-o seconds  error of the DS3231 at the start
+-S seed     random seed
+-D name=value
+            replace a top level assignment of main.py (e.g. -D camera_ring_size=4096)
+-v          show the output of main.py
+"""
+
+import ast
+import builtins
+import compileall
+import contextlib
+import getopt
+import importlib
+import io
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import traceback
+import tracemalloc
+from http.server import ThreadingHTTPServer
+
+HOST = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HOST)
+SIM = os.path.join(HOST, 'sim')
+LIB = os.path.join(ROOT, 'lib')
+
+sys.path[:0] = [SIM, LIB]
+
+import _sim
+import receiver
+from _ds3231 import DS3231
+from _esp32cam import Esp32Cam, recording
+
+# Kept over resets: the simulation state and the devices
+_KEEP = ('_sim', '_ds3231', '_esp32cam')
+
+
+class QuietHandler(receiver.PictureHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass            # Connections dropped by the simulated network
+
+
+def start_receiver(directory):
+    QuietHandler.directory = directory
+    server = QuietServer(('127.0.0.1', 0), QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def synthetic_jpeg(size):
+    body = bytes(_sim.rng.randrange(256) for _ in range(max(size - 4, 0)))
+    return b'\xff\xd8' + body + b'\xff\xd9'
+
+
+def override(src, name, value):
+    """Replace the top level assignment of name in the main.py source."""
+    pattern = re.compile(r'^%s\s*=.*$' % re.escape(name), re.M)
+    if not pattern.search(src):
+        raise SystemExit('main.py has no top level assignment of ' + name)
+    return pattern.sub(lambda m: '%s = %s' % (name, value), src, count=1)
+
+
+def unload():
+    # A reset reloads every module, as on the GPy.  Standard library modules of the
+    #   same name as a module in lib (base64) are dropped too, so main.py gets lib's.
+    shadowed = set(name[:-3] for name in os.listdir(LIB) if name.endswith('.py'))
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, '__file__', None) or ''
+        if name in _KEEP:
+            continue
+        if name in shadowed or os.path.dirname(os.path.abspath(path)) in (SIM, LIB):
+            del sys.modules[name]
+
+
+@contextlib.contextmanager
+def gpy_open():
+    # open() of main.py and lib sees the simulated flash
+    real_open = builtins.open
+
+    def flash_open(file, *args, **kw):
+        if isinstance(file, str):
+            file = _sim.flash_path(file)
+        return real_open(file, *args, **kw)
+
+    builtins.open = flash_open
+    try:
+        yield
+    finally:
+        builtins.open = real_open
+
+
+def imported_modules(src):
+    """Return the names of the modules main.py imports at the top level."""
+    names = []
+    for node in ast.walk(ast.parse(src)):
+        if isinstance(node, ast.Import):
+            names += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            names.append(node.module)
+    return names
+
+
+def run_cycle(code, modules, verbose):
+    """Run main.py once.  Return (globals, end, error)."""
+    unload()
+    # Import the modules before the memory is traced, so the peak is the data of the
+    #   wake and not the code objects
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+    import untplib
+    import usocket
+    import utime
+    untplib.socket = usocket        # 'socket' and 'time' are MicroPython aliases
+    untplib.time = utime
+    g = {'__name__': '__main__'}
+    out = sys.stdout if verbose else io.StringIO()
+    end = 'returned'
+    error = None
+    tracemalloc.start()
+    try:
+        with gpy_open(), contextlib.redirect_stdout(out):
+            try:
+                exec(code, g)
+            except Exception:
+                error = traceback.format_exc().strip().splitlines()[-1]
+            # main.py has ended: the GPy waits for the DS3231 reset
+            if _sim.awake_us is None:
+                _sim.awake_us = _sim.now_us
+            _sim.idle()
+    except _sim.Shutdown as e:
+        end = e.reason if e.ms is None else '%s %d ms' % (e.reason, e.ms)
+        g['_shutdown'] = e
+    finally:
+        g['_peak'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return g, end, error
+
+
+def received(directory, picture):
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith('.jpg') and os.path.isfile(path):
+            with open(path, 'rb') as f:
+                if f.read() == picture:
+                    os.remove(path)
+                    return True
+    return False
+
+
+class Energy:
+    """Battery charge from the awake and sleep times, with the currents set in
+    main.py (awake_ma, idle_ma, deepsleep_ma)."""
+
+    def __init__(self):
+        self.hours = 0.0
+        self.mah = 0.0
+        self.idle_mah = 0.0     # The same wakes, waiting awake between them
+
+    def add(self, g, awake_us, sleep_us, deep):
+        awake_h = awake_us / 3.6e9
+        sleep_h = sleep_us / 3.6e9
+        awake = awake_h * g.get('awake_ma', 0)
+        sleep = sleep_h * g.get('deepsleep_ma' if deep else 'idle_ma', 0)
+        self.hours += awake_h + sleep_h
+        self.mah += awake + sleep
+        self.idle_mah += awake + sleep_h * g.get('idle_ma', 0)
+        return awake, sleep
+
+    def report(self):
+        if self.hours:
+            day = 24 / self.hours
+            print('estimated charge per day: %.1f mAh, %.1f mAh waiting awake, %.1f mAh saved'
+                  % (self.mah * day, self.idle_mah * day,
+                     (self.idle_mah - self.mah) * day))
+
+
+def clock_errors():
+    """Return the errors (ms) of the DS3231 and of the GPy clock set from it, now."""
+    local = _sim.wall() + _sim.config['timezone']
+    ds3231 = _sim.devices.get(('i2c', 0x68))
+    if ds3231 is None or _sim.rtc is None:
+        return None
+    import machine
+    return ((ds3231.now() - local) * 1000, (machine.RTC._seconds() - local) * 1000)
+
+
+_PICTURE_NAME = re.compile(r'\d+_\d{12}_\d+$')
+
+
+def report(n, g, end, error, intact, sleep_us, charge, clock, camera):
+    awake_ms = (_sim.awake_us - _sim.boot_us) // 1000
+    c = _sim.counters
+    print('cycle %d: awake %d ms  tx %d B  rx %d B  peak %d KB  end %s  picture %s'
+          % (n, awake_ms, c.get('tx', 0), c.get('rx', 0), g['_peak'] // 1024,
+             end, 'intact' if intact else 'MISSING'))
+    print('  sleep %d s  estimated charge: awake %.2f mAh, sleep %.2f mAh'
+          % (sleep_us // 1000000, charge[0], charge[1]))
+    if error:
+        print('  error: ' + error)
+    trace = g.get('trace')
+    if trace is not None:
+        spans = ['%s %d+%d' % (name, trace.spans[name][0], trace.spans[name][1])
+                 for name in trace.order]
+        print('  phases (ms): ' + ', '.join(spans))
+        if trace.counters:
+            print('  counters: ' + ', '.join('%s %d' % kv for kv in trace.counters.items()))
+    # One picture per wake, named <station>_<YYYYMMDDhhmm>_<voltage> by main.py
+    if len(camera.names) > 1 or not all(_PICTURE_NAME.match(n) for n in camera.names):
+        print('  camera: %d pictures taken, named %s'
+              % (len(camera.names), ', '.join(repr(name) for name in camera.names)))
+    if clock:
+        print('  clock error: DS3231 %+d ms, GPy %+d ms' % clock)
+    other = sorted((k, v) for k, v in c.items() if k not in ('tx', 'rx'))
+    print('  simulator: ' + ', '.join('%s %d' % kv for kv in other))
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'n:m:pls:j:r:b:a:f:x:c:d:o:S:D:v')
+    except getopt.error as msg:
+        print(msg)
+        print(__doc__)
+        sys.exit(2)
+    cycles = 1
+    size = 30000
+    jpeg = replay = None
+    max_baudrate = 921600
+    corrupt_rate = 0.0
+    overrides = []
+    verbose = False
+    for o, a in opts:
+        if o == '-n': cycles = int(a)
+        if o == '-m': overrides.append(('upload_mode', repr(a)))
+        if o == '-p': overrides.append(('wake_pipeline', 'False'))
+        if o == '-l': overrides.append(('use_lte', 'True'))
+        if o == '-s': size = int(a)
+        if o == '-j': jpeg = a
+        if o == '-r': replay = a
+        if o == '-b': max_baudrate = int(a)
+        if o == '-a': _sim.config['attach_ms'] = int(a)
+        if o == '-f': QuietHandler.fault_rate = float(a)
+        if o == '-x': _sim.config['drop_rate'] = float(a)
+        if o == '-c': corrupt_rate = float(a)
+        if o == '-d': _sim.config['rtc_drift_ppm'] = float(a)
+        if o == '-o': _sim.config['rtc_offset_s'] = float(a)
+        if o == '-S': _sim.seed(int(a))
+        if o == '-D': overrides.append(tuple(a.split('=', 1)))
+        if o == '-v': verbose = True
+
+    with open(os.path.join(ROOT, 'main.py')) as f:
+        src = f.read()
+    for name, value in overrides:
+        src = override(src, name, value)
+    code = compile(src, os.path.join(ROOT, 'main.py'), 'exec')
+    modules = imported_modules(src)
+    # Compile the modules once, so the peak memory of a cycle is not the compiler's
+    for directory in (SIM, LIB):
+        compileall.compile_dir(directory, quiet=1)
+
+    if jpeg:
+        with open(jpeg, 'rb') as f:
+            picture = f.read()
+    elif replay:
+        with open(replay, 'rb') as f:
+            picture = recording(f.read())
+    else:
+        picture = synthetic_jpeg(size)
+
+    work = tempfile.mkdtemp(prefix='gpy-sim-')
+    inbox = os.path.join(work, 'received')
+    os.makedirs(inbox)
+    _sim.config['flash'] = os.path.join(work, 'flash')
+    os.makedirs(_sim.config['flash'])
+    server = start_receiver(inbox)
+    _sim.config['server'] = server.server_address[:2]
+
+    start = _sim.config['start'] + _sim.config['timezone'] + _sim.config['rtc_offset_s']
+    _sim.devices[('i2c', 0x68)] = DS3231(start)
+    camera = _sim.devices[('uart', 1)] = Esp32Cam(picture,
+                                                  max_baudrate=max_baudrate or 38400,
+                                                  negotiate=bool(max_baudrate),
+                                                  corrupt_rate=corrupt_rate)
+    energy = Energy()
+    try:
+        reason = 0
+        for n in range(1, cycles + 1):
+            _sim.reset(reason)
+            g, end, error = run_cycle(code, modules, verbose)
+            intact = received(inbox, picture)
+            shutdown = g.get('_shutdown')
+            deep = shutdown is not None and shutdown.reason == 'deepsleep'
+            clock = clock_errors()
+            reason = 0
+            if deep:
+                reason = _sim.sleep_until_wake(shutdown.ms)
+            sleep_us = _sim.now_us - _sim.awake_us
+            charge = energy.add(g, _sim.awake_us - _sim.boot_us, sleep_us, deep)
+            report(n, g, end, error, intact, sleep_us, charge, clock, camera)
+            if shutdown is None:
+                print('the GPy was not reset: stopping')
+                break
+            if reason is None:
+                print('the GPy does not wake up: stopping')
+                break
+        energy.report()
+    finally:
+        server.shutdown()
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+#! /usr/bin/env python3
+
+"""Measure the TLS handshake cost of lib/urequests.py under CPython.
+
+Starts a local HTTPS server (CPython ssl, TLS 1.2 like the mbedTLS of the
+GPy, with a self-signed certificate made by the openssl command) behind a
+proxy that adds a round trip time and counts the bytes in each direction.
+urequests runs against it through usocket and ussl modules made of CPython
+sockets and ssl, with ussl.save_session() as on the Pycom firmware.
+
+The same small POST is made n times:
+
+  full      one connection per request, full handshake each time
+  resumed   one connection per request, TLS session resumed
+  session   one keep-alive Session, one handshake in all
+
+and the bytes on the wire, the time and the handshakes are printed for each.
+
+usage: tlsbench.py [-n requests] [-r rtt_ms] [-s body_bytes]
+"""
+
+import getopt
+import os
+import queue
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+
+class Socket:
+    """The part of the MicroPython socket API used by urequests."""
+
+    def __init__(self, *args, sock=None):
+        self.s = sock if sock is not None else socket.socket(*args)
+        self.f = None
+
+    def connect(self, address):
+        self.s.connect(address)
+
+    def settimeout(self, timeout):
+        self.s.settimeout(timeout)
+
+    def write(self, data):
+        self.s.sendall(data)
+        return len(data)
+
+    def _file(self):
+        if self.f is None:
+            self.f = self.s.makefile('rb')
+        return self.f
+
+    def readline(self):
+        return self._file().readline()
+
+    def read(self, n=-1):
+        return self._file().read(n)
+
+    def readinto(self, buf):
+        # Like MicroPython: what is there, not a full buffer
+        data = self._file().read1(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    @property
+    def session_reused(self):
+        return self.s.session_reused
+
+    def close(self):
+        if self.f:
+            self.f.close()
+        self.s.close()
+
+
+def micropython_modules():
+    """Return the usocket and ussl modules for urequests."""
+    usocket = types.ModuleType('usocket')
+    # getaddrinfo() takes the host and port only, as on the GPy
+    usocket.getaddrinfo = lambda host, port: socket.getaddrinfo(
+        host, port, socket.AF_INET, socket.SOCK_STREAM)
+    usocket.AF_INET = socket.AF_INET
+    usocket.SOCK_STREAM = socket.SOCK_STREAM
+    usocket.socket = Socket
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    context.maximum_version = ssl.TLSVersion.TLSv1_2
+
+    ussl = types.ModuleType('ussl')
+
+    def wrap_socket(sock, server_hostname=None, saved_session=None):
+        return Socket(sock=context.wrap_socket(sock.s, server_hostname=server_hostname,
+                                               session=saved_session))
+
+    ussl.wrap_socket = wrap_socket
+    ussl.save_session = lambda sock: sock.s.session
+    return usocket, ussl
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+def https_server(directory):
+    key = os.path.join(directory, 'key.pem')
+    cert = os.path.join(directory, 'cert.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                    '-keyout', key, '-out', cert, '-days', '1', '-subj', '/CN=localhost'],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.maximum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert, key)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+class LatencyProxy:
+    """TCP proxy that delays the data rtt_ms / 2 each way and counts it."""
+
+    def __init__(self, target_port, rtt_ms):
+        self.target = ('127.0.0.1', target_port)
+        self.delay = rtt_ms / 2000
+        self.up = 0                 # Bytes from the client
+        self.down = 0               # Bytes to the client
+        self.lock = threading.Lock()
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(8)
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            client, _ = self.listener.accept()
+            server = socket.create_connection(self.target)
+            for src, dst, up in ((client, server, True), (server, client, False)):
+                q = queue.Queue()
+                threading.Thread(target=self.read, args=(src, q, up), daemon=True).start()
+                threading.Thread(target=self.write, args=(dst, q), daemon=True).start()
+
+    def read(self, src, q, up):
+        while True:
+            try:
+                data = src.recv(65536)
+            except OSError:
+                data = b''
+            with self.lock:
+                if up:
+                    self.up += len(data)
+                else:
+                    self.down += len(data)
+            q.put((time.monotonic() + self.delay, data))
+            if not data:
+                return
+
+    def write(self, dst, q):
+        while True:
+            at, data = q.get()
+            time.sleep(max(0, at - time.monotonic()))
+            try:
+                if data:
+                    dst.sendall(data)
+                else:
+                    dst.shutdown(socket.SHUT_WR)
+                    return
+            except OSError:
+                return
+
+    def reset(self):
+        with self.lock:
+            self.up = self.down = 0
+
+
+def run(n, rtt_ms, body_size):
+    usocket, ussl = micropython_modules()
+    sys.modules['usocket'] = usocket
+    sys.modules['ussl'] = ussl
+    import urequests
+
+    with tempfile.TemporaryDirectory() as directory:
+        proxy = LatencyProxy(https_server(directory), rtt_ms)
+    url = 'https://127.0.0.1:%d/telemetry' % proxy.port
+    body = b'x' * body_size
+    print('%d POSTs of %d bytes, RTT %d ms' % (n, body_size, rtt_ms))
+    for mode in ('full', 'resumed', 'session'):
+        urequests._tls_sessions.clear()
+        session = urequests.Session()
+        proxy.reset()
+        start = time.monotonic()
+        handshakes = resumed = tls_ms = 0
+        for i in range(n):
+            if mode == 'full':
+                urequests._tls_sessions.clear()
+            if mode == 'session':
+                r = session.post(url, data=body)
+            else:
+                r = urequests.post(url, data=body)
+            r.content
+            if not r.stats['reused']:
+                handshakes += 1
+                resumed += r.stats['tls_resumed'] is True
+                tls_ms += r.stats['tls_ms']
+        elapsed = time.monotonic() - start
+        session.close()
+        time.sleep(rtt_ms / 1000 + 0.1)     # Let the proxy count the closes
+        print('%-8s %7d bytes up %7d down %6d ms  handshakes %d (%d resumed, %d ms)'
+              % (mode, proxy.up, proxy.down, elapsed * 1000, handshakes, resumed, tls_ms))
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'n:r:s:')
+    except getopt.error as msg:
+        print(msg)
+        print(__doc__)
+        sys.exit(2)
+    n = 5
+    rtt_ms = 300
+    body_size = 200
+    for o, a in opts:
+        if o == '-n': n = int(a)
+        if o == '-r': rtt_ms = int(a)
+        if o == '-s': body_size = int(a)
+    run(n, rtt_ms, body_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+try:
+    import ujson
+except ImportError:
+    import json as ujson
+
+from urequests import RequestTimeout, _Budget, _Head, _body, _follow, _head, _no_budget, _split_url
+
+# The uasyncio version of urequests: the same request(), get(), post()... and
+# Response, with every network operation awaited, so other tasks run while a
+# request waits on the network.  Requests run concurrently in their own tasks
+# (asyncio.gather), and can be cancelled (Task.cancel) or given a timeout and a
+# deadline as in urequests.  Each request uses its own connection, closed after
+# the response.  Runs under CPython asyncio as well.
+
+
+async def _wait(aw, budget, phase, timeout):
+    # Await aw within timeout seconds and the deadline of budget
+    left = budget.check(phase)
+    if left is not None and (timeout is None or left < timeout):
+        timeout = left
+    if timeout is None:
+        return await aw
+    try:
+        return await asyncio.wait_for(aw, timeout)
+    except asyncio.TimeoutError:
+        budget.check(phase)
+        raise RequestTimeout(phase, "HTTP %s timed out" % phase)
+
+
+class Response:
+    """Response of arequests.request().
+
+    Read the body with await r.content, await r.text, await r.json(),
+    await r.read(n), await r.readinto(buf) or async for chunk in
+    r.iter_content(n).  The connection is closed at the end of the body
+    or by close().
+    """
+
+    def __init__(self, reader, writer, length=None, chunked=False, budget=_no_budget):
+        self.raw = reader
+        self._writer = writer
+        self.encoding = "utf-8"
+        self._cached = None
+        self._chunked = chunked
+        self._left = 0 if chunked else length
+        self._budget = budget
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self.raw = None
+        self._cached = None
+
+    async def _readline(self):
+        return await _wait(self.raw.readline(), self._budget, "body", self._budget.read)
+
+    async def read(self, n=1024):
+        """Return up to n bytes of the body, b"" at its end."""
+        if self.raw is None:
+            return b""
+        if self._chunked and not self._left:
+            size = int((await self._readline()).split(b";", 1)[0], 16)
+            if not size:
+                while (await self._readline()) not in (b"\r\n", b""):
+                    pass            # Trailer fields
+                self._chunked = False
+            self._left = size
+        if self._left is not None:
+            n = min(n, self._left)
+        if not n:
+            return b""
+        data = await _wait(self.raw.read(n), self._budget, "body", self._budget.read)
+        if not data:
+            if self._left is not None:
+                raise OSError("Body cut short")
+            return b""
+        if self._left is not None:
+            self._left -= len(data)
+            if self._chunked and not self._left:
+                await self._readline()      # CRLF after the chunk
+        return data
+
+    async def readinto(self, buf, nbytes=None):
+        mv = memoryview(buf)
+        if nbytes is None:
+            nbytes = len(mv)
+        data = await self.read(nbytes)
+        mv[:len(data)] = data
+        return len(data)
+
+    def iter_content(self, chunk_size=1024):
+        return _Chunks(self, chunk_size)
+
+    async def _content(self):
+        if self._cached is None:
+            parts = []
+            try:
+                while True:
+                    data = await self.read(self._left or 4096)
+                    if not data:
+                        break
+                    parts.append(data)
+            finally:
+                self.close()
+            self._cached = b"".join(parts)
+        return self._cached
+
+    @property
+    def content(self):
+        return self._content()
+
+    async def _text(self):
+        return str(await self._content(), self.encoding)
+
+    @property
+    def text(self):
+        return self._text()
+
+    async def json(self):
+        return ujson.loads(await self._content())
+
+
+class _Chunks:
+    # async for iterator over the body (MicroPython has no async generators)
+
+    def __init__(self, resp, chunk_size):
+        self.resp = resp
+        self.chunk_size = chunk_size
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        data = await self.resp.read(self.chunk_size)
+        if not data:
+            self.resp.close()
+            raise StopAsyncIteration
+        return data
+
+
+async def _request(method, url, data, is_json, headers, chunk_size, budget):
+    # Send one request.  Return the response and the Location it redirects to
+    # (None if it is not a redirect).
+    proto, host, port, path = _split_url(url)
+    length = None
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        length = len(data)
+    elif "Content-Length" in headers:
+        length = int(headers["Content-Length"])
+
+    # The address lookup, connect and TLS handshake are one "connect" phase
+    if proto == "https:":
+        connect = asyncio.open_connection(host, port, ssl=True)
+    else:
+        connect = asyncio.open_connection(host, port)
+    reader, writer = await _wait(connect, budget, "connect", budget.connect)
+    try:
+        # The request line and headers (and a body in memory) in one write
+        buf = bytearray()
+        for part in _head(method, host, path, headers, data, length, is_json, False):
+            buf += part.encode() if isinstance(part, str) else part
+        if length is not None and isinstance(data, (bytes, bytearray, memoryview)):
+            buf += data
+            data = None
+        writer.write(buf)
+        await _wait(writer.drain(), budget, "send", budget.read)
+        if data is not None:
+            for part in _body(data, length, chunk_size):
+                writer.write(part)
+                await _wait(writer.drain(), budget, "send", budget.read)
+
+        head = _Head(method)
+        while head.feed(await _wait(reader.readline(), budget, "head", budget.read)):
+            pass
+    except BaseException:           # Also when cancelled
+        writer.close()
+        raise
+
+    resp = Response(reader, writer, head.length, head.chunked, budget)
+    resp.status_code = head.status
+    resp.reason = head.reason
+    return resp, head.location
+
+
+async def request(method, url, data=None, json=None, headers={}, chunk_size=1024,
+                  max_redirects=2, timeout=None, deadline=None):
+    if json is not None:
+        assert data is None
+        data = ujson.dumps(json)
+    if isinstance(data, str):
+        data = data.encode()
+    budget = _no_budget
+    if timeout is not None or deadline is not None:
+        budget = _Budget(timeout, deadline)
+    # Follow up to max_redirects redirects; with 0 the redirect is returned
+    for i in range(max_redirects + 1):
+        resp, location = await _request(method, url, data,
+                                        json is not None and data is not None,
+                                        headers, chunk_size, budget)
+        if location is None or not max_redirects:
+            return resp
+        resp.close()
+        method, url, data, headers = _follow(resp.status_code, method, url,
+                                             location, data, headers)
+    raise ValueError("Too many redirects")
+
+
+def head(url, **kw):
+    return request("HEAD", url, **kw)
+
+def get(url, **kw):
+    return request("GET", url, **kw)
+
+def post(url, **kw):
+    return request("POST", url, **kw)
+
+def put(url, **kw):
+    return request("PUT", url, **kw)
+
+def patch(url, **kw):
+    return request("PATCH", url, **kw)
+
+def delete(url, **kw):
+    return request("DELETE", url, **kw)
@@ -0,0 +1,75 @@
+import micropython
+
+# Native code for the Base32 and Base16 loops of base64.py.  base64.py falls back
+# to Python loops and binascii if this module does not compile (firmware without
+# the native emitter) or on CPython.  Viper functions take at most four arguments, so the
+# callers pass memoryview slices instead of offsets.
+
+
+@micropython.viper
+def b32encode_quanta(src: ptr8, dst: ptr8, quanta: int, tab: ptr8):
+    i = 0
+    j = 0
+    for q in range(quanta):
+        hi = src[i] << 12 | src[i + 1] << 4 | src[i + 2] >> 4
+        lo = (src[i + 2] & 15) << 16 | src[i + 3] << 8 | src[i + 4]
+        dst[j] = tab[hi >> 15]
+        dst[j + 1] = tab[(hi >> 10) & 31]
+        dst[j + 2] = tab[(hi >> 5) & 31]
+        dst[j + 3] = tab[hi & 31]
+        dst[j + 4] = tab[lo >> 15]
+        dst[j + 5] = tab[(lo >> 10) & 31]
+        dst[j + 6] = tab[(lo >> 5) & 31]
+        dst[j + 7] = tab[lo & 31]
+        i += 5
+        j += 8
+
+
+@micropython.viper
+def b32decode_quanta(src: ptr8, dst: ptr8, quanta: int, rev: ptr8) -> int:
+    i = 0
+    j = 0
+    for q in range(quanta):
+        a = rev[src[i]]
+        b = rev[src[i + 1]]
+        c = rev[src[i + 2]]
+        d = rev[src[i + 3]]
+        e = rev[src[i + 4]]
+        f = rev[src[i + 5]]
+        g = rev[src[i + 6]]
+        h = rev[src[i + 7]]
+        if (a | b | c | d | e | f | g | h) > 31:
+            return q
+        hi = a << 15 | b << 10 | c << 5 | d
+        lo = e << 15 | f << 10 | g << 5 | h
+        dst[j] = hi >> 12
+        dst[j + 1] = (hi >> 4) & 255
+        dst[j + 2] = (hi & 15) << 4 | lo >> 16
+        dst[j + 3] = (lo >> 8) & 255
+        dst[j + 4] = lo & 255
+        i += 8
+        j += 5
+    return quanta
+
+
+@micropython.viper
+def b16encode_block(src: ptr8, dst: ptr8, n: int, tab: ptr8):
+    j = 0
+    for i in range(n):
+        c = src[i]
+        dst[j] = tab[c >> 4]
+        dst[j + 1] = tab[c & 15]
+        j += 2
+
+
+@micropython.viper
+def b16decode_block(src: ptr8, dst: ptr8, n: int, rev: ptr8) -> int:
+    j = 0
+    for i in range(n):
+        hi = rev[src[j]]
+        lo = rev[src[j + 1]]
+        if (hi | lo) > 15:
+            return i
+        dst[i] = hi << 4 | lo
+        j += 2
+    return n
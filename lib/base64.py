@@ -7,7 +7,6 @@
 # Modified 22-May-2007 by Guido van Rossum to use bytes everywhere
 
 import re
-import struct
 import binascii
 
 
@@ -17,6 +16,8 @@ __all__ = [
     # Generalized interface for other encodings
     'b64encode', 'b64decode', 'b32encode', 'b32decode',
     'b16encode', 'b16decode',
+    # Base32 and Base16 into preallocated buffers
+    'b32encode_into', 'b32decode_into', 'b16encode_into', 'b16decode_into',
     # Standard Base64 encoding
     'standard_b64encode', 'standard_b64decode',
     # Some common Base64 alternatives.  As referenced by RFC 3458, see thread
@@ -24,6 +25,8 @@ __all__ = [
     #
     # http://zgp.org/pipermail/p2p-hackers/2001-September/000316.html
     'urlsafe_b64encode', 'urlsafe_b64decode',
+    # Incremental Base64 encoding into caller buffers
+    'B64Encoder', 'encode_stream',
     ]
 
 
@@ -42,6 +45,27 @@ def _bytes_from_decode_data(s):
         raise TypeError("argument should be bytes or ASCII string, not %s" % s.__class__.__name__)
 
 
+# bytes.maketrans() and bytes.translate() are not in MicroPython
+def _maketrans(frm, to):
+    table = bytearray(range(256))
+    for a, b in zip(frm, to):
+        table[a] = b
+    return bytes(table)
+
+
+def _translate_into(buf, table, start=0, end=None):
+    for i in range(start, len(buf) if end is None else end):
+        buf[i] = table[buf[i]]
+
+
+def _translate(s, table):
+    if hasattr(s, 'translate'):
+        return s.translate(table)
+    s = bytearray(s)
+    _translate_into(s, table)
+    return bytes(s)
+
+
 
 # Base64 encoding/decoding uses binascii
 
@@ -64,7 +88,7 @@ def b64encode(s, altchars=None):
             raise TypeError("expected bytes, not %s"
                             % altchars.__class__.__name__)
         assert len(altchars) == 2, repr(altchars)
-        return encoded.translate(bytes.maketrans(b'+/', altchars))
+        return _translate(encoded, _maketrans(b'+/', altchars))
     return encoded
 
 
@@ -86,7 +110,7 @@ def b64decode(s, altchars=None, validate=False):
     if altchars is not None:
         altchars = _bytes_from_decode_data(altchars)
         assert len(altchars) == 2, repr(altchars)
-        s = s.translate(bytes.maketrans(altchars, b'+/'))
+        s = _translate(s, _maketrans(altchars, b'+/'))
     if validate and not re.match(b'^[A-Za-z0-9+/]*={0,2}$', s):
         raise binascii.Error('Non-base64 digit found')
     return binascii.a2b_base64(s)
@@ -110,8 +134,8 @@ def standard_b64decode(s):
     return b64decode(s)
 
 
-#_urlsafe_encode_translation = bytes.maketrans(b'+/', b'-_')
-#_urlsafe_decode_translation = bytes.maketrans(b'-_', b'+/')
+_urlsafe_encode_translation = _maketrans(b'+/', b'-_')
+_urlsafe_decode_translation = _maketrans(b'-_', b'+/')
 
 def urlsafe_b64encode(s):
     """Encode a byte string using a url-safe Base64 alphabet.
@@ -120,8 +144,7 @@ def urlsafe_b64encode(s):
     returned.  The alphabet uses '-' instead of '+' and '_' instead of
     '/'.
     """
-#    return b64encode(s).translate(_urlsafe_encode_translation)
-    raise NotImplementedError()
+    return _translate(b64encode(s), _urlsafe_encode_translation)
 
 def urlsafe_b64decode(s):
     """Decode a byte string encoded with the standard Base64 alphabet.
@@ -133,28 +156,245 @@ def urlsafe_b64decode(s):
 
     The alphabet uses '-' instead of '+' and '_' instead of '/'.
     """
-#    s = _bytes_from_decode_data(s)
-#    s = s.translate(_urlsafe_decode_translation)
-#    return b64decode(s)
-    raise NotImplementedError()
+    s = _bytes_from_decode_data(s)
+    s = _translate(s, _urlsafe_decode_translation)
+    return b64decode(s)
+
+
+# Incremental Base64 encoding
+
+_b64tab = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
 
+class B64Encoder:
+    """Base64 encoder for data that arrives in pieces of any size.
 
+    encode_into(src, dst) encodes the complete 3-byte quanta of the bytes
+    given so far into the writable buffer dst and returns the number of
+    bytes written.  The 0-2 bytes left over are kept for the next call, so
+    the output is the same as b64encode() of all the pieces joined.
+    finish() writes the last quantum with its padding.  update(data) and
+    finish() without dst return the encoded bytes instead.
 
-# Base32 encoding/decoding must be done in Python
-_b32alphabet = {
-    0: b'A',  9: b'J', 18: b'S', 27: b'3',
-    1: b'B', 10: b'K', 19: b'T', 28: b'4',
-    2: b'C', 11: b'L', 20: b'U', 29: b'5',
-    3: b'D', 12: b'M', 21: b'V', 30: b'6',
-    4: b'E', 13: b'N', 22: b'W', 31: b'7',
-    5: b'F', 14: b'O', 23: b'X',
-    6: b'G', 15: b'P', 24: b'Y',
-    7: b'H', 16: b'Q', 25: b'Z',
-    8: b'I', 17: b'R', 26: b'2',
-    }
+    Only one temporary of at most block bytes is made per binascii call, so
+    a payload of any size is encoded in constant memory.  altchars replaces
+    '+' and '/' as in b64encode().
+    """
+
+    def __init__(self, altchars=None, block=1536):
+        self.carry = bytearray(3)
+        self.ncarry = 0
+        self.block = block - block % 3
+        self.table = None
+        if altchars is not None:
+            altchars = _bytes_from_decode_data(altchars)
+            assert len(altchars) == 2, repr(altchars)
+            self.table = _maketrans(b'+/', altchars)
+        self.tab = _translate(_b64tab, self.table) if self.table else _b64tab
+
+    def encoded_len(self, n):
+        """Return the bytes encode_into() writes for n more input bytes."""
+        return (self.ncarry + n) // 3 * 4
+
+    def _quantum(self, dst, pos, n):
+        # Encode the n (1-3) bytes of the carry at dst[pos:pos+4], padded
+        c = self.carry
+        b = c[0] << 16 | (c[1] << 8 if n > 1 else 0) | (c[2] if n > 2 else 0)
+        tab = self.tab
+        dst[pos] = tab[b >> 18]
+        dst[pos + 1] = tab[b >> 12 & 63]
+        dst[pos + 2] = tab[b >> 6 & 63] if n > 1 else 61     # '='
+        dst[pos + 3] = tab[b & 63] if n > 2 else 61
+
+    def encode_into(self, src, dst):
+        src = memoryview(src)
+        pos = 0
+        out = 0
+        if self.ncarry:
+            take = min(3 - self.ncarry, len(src))
+            self.carry[self.ncarry:self.ncarry + take] = src[:take]
+            self.ncarry += take
+            pos = take
+            if self.ncarry < 3:
+                return 0
+            self._quantum(dst, 0, 3)
+            self.ncarry = 0
+            out = 4
+        end = len(src) - (len(src) - pos) % 3
+        while pos < end:
+            n = min(self.block, end - pos)
+            encoded = binascii.b2a_base64(src[pos:pos + n])
+            k = n // 3 * 4      # Without the newline
+            dst[out:out + k] = memoryview(encoded)[:k]
+            del encoded
+            if self.table:
+                _translate_into(dst, self.table, out, out + k)
+            pos += n
+            out += k
+        self.ncarry = len(src) - end
+        self.carry[:self.ncarry] = src[end:]
+        return out
+
+    def update(self, data):
+        dst = bytearray(self.encoded_len(len(data)))
+        self.encode_into(data, dst)
+        return dst
+
+    def finish(self, dst=None):
+        n = self.ncarry
+        self.ncarry = 0
+        if dst is None:
+            if not n:
+                return b''
+            dst = bytearray(4)
+            self._quantum(dst, 0, n)
+            return bytes(dst)
+        if not n:
+            return 0
+        self._quantum(dst, 0, n)
+        return 4
+
+
+def _readinto_full(input, mv):
+    # Fill mv from input unless the input ends.  Return the number of bytes read.
+    got = 0
+    while got < len(mv):
+        n = input.readinto(mv[got:])
+        if not n:
+            break
+        got += n
+    return got
 
-_b32tab = [v[0] for k, v in sorted(_b32alphabet.items())]
-_b32rev = dict([(v[0], k) for k, v in _b32alphabet.items()])
+
+def encode_stream(input, output, chunk_size=1536, altchars=None):
+    """Encode a binary file into one Base64 string without newlines.
+
+    Reads with readinto() into one reusable buffer and writes each encoded
+    chunk from one output buffer, so the memory used does not depend on the
+    size of the input.  Returns the number of bytes written.
+    """
+    encoder = B64Encoder(altchars, chunk_size)
+    chunk_size = encoder.block
+    inbuf = memoryview(bytearray(chunk_size))
+    outbuf = memoryview(bytearray(encoder.encoded_len(chunk_size) + 4))
+    total = 0
+    while True:
+        n = _readinto_full(input, inbuf)
+        if not n:
+            break
+        k = encoder.encode_into(inbuf[:n], outbuf)
+        output.write(outbuf[:k])
+        total += k
+        if n < chunk_size:
+            break
+    k = encoder.finish(outbuf)
+    if k:
+        output.write(outbuf[:k])
+    return total + k
+
+
+
+# Base32 and Base16 encoding/decoding must be done in Python
+#
+# The encoders and decoders work on whole buffers with 256-entry lookup tables and
+# write into preallocated output.  The inner loops run as native code from
+# b32viper.py where the firmware has the viper emitter.  Otherwise Base32 runs the
+# Python loops below and Base16 uses binascii, which is faster than a Python loop.
+# 40-bit Base32 quanta are handled as two 20-bit halves so that the arithmetic
+# stays in MicroPython small ints.
+
+_b32tab = b'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567'
+_b16tab = b'0123456789ABCDEF'
+
+
+def _reverse_table(tab):
+    rev = bytearray(b'\xff' * 256)         # 0xff: not in the alphabet
+    for i, c in enumerate(tab):
+        rev[c] = i
+    return bytes(rev)
+
+
+_b32rev = _reverse_table(_b32tab)
+_b16rev = _reverse_table(_b16tab)
+
+# Number of '=' after a last quantum of 1-4 bytes, and back from the number of
+# '=' to the number of bytes that the padded quantum lacks
+_b32pad = (0, 6, 4, 3, 1)
+_b32unpad = {0: 0, 1: 1, 3: 2, 4: 3, 6: 4}
+
+
+def _py_b32encode_quanta(src, dst, quanta, tab):
+    i = 0
+    j = 0
+    for q in range(quanta):
+        hi = src[i] << 12 | src[i + 1] << 4 | src[i + 2] >> 4
+        lo = (src[i + 2] & 15) << 16 | src[i + 3] << 8 | src[i + 4]
+        dst[j] = tab[hi >> 15]
+        dst[j + 1] = tab[(hi >> 10) & 31]
+        dst[j + 2] = tab[(hi >> 5) & 31]
+        dst[j + 3] = tab[hi & 31]
+        dst[j + 4] = tab[lo >> 15]
+        dst[j + 5] = tab[(lo >> 10) & 31]
+        dst[j + 6] = tab[(lo >> 5) & 31]
+        dst[j + 7] = tab[lo & 31]
+        i += 5
+        j += 8
+
+
+def _py_b32decode_quanta(src, dst, quanta, rev):
+    # Return the number of quanta decoded: less than quanta at a bad character
+    i = 0
+    j = 0
+    for q in range(quanta):
+        a, b, c, d, e, f, g, h = (rev[src[i]], rev[src[i + 1]], rev[src[i + 2]],
+                                  rev[src[i + 3]], rev[src[i + 4]], rev[src[i + 5]],
+                                  rev[src[i + 6]], rev[src[i + 7]])
+        if (a | b | c | d | e | f | g | h) > 31:
+            return q
+        hi = a << 15 | b << 10 | c << 5 | d
+        lo = e << 15 | f << 10 | g << 5 | h
+        dst[j] = hi >> 12
+        dst[j + 1] = (hi >> 4) & 255
+        dst[j + 2] = (hi & 15) << 4 | lo >> 16
+        dst[j + 3] = (lo >> 8) & 255
+        dst[j + 4] = lo & 255
+        i += 8
+        j += 5
+    return quanta
+
+
+try:
+    import b32viper as _viper
+except (ImportError, SyntaxError):  # CPython, or no native emitter
+    _viper = None
+
+if _viper is None:
+    _b32encode_quanta = _py_b32encode_quanta
+    _b32decode_quanta = _py_b32decode_quanta
+else:
+    _b32encode_quanta = _viper.b32encode_quanta
+    _b32decode_quanta = _viper.b32decode_quanta
+
+
+def b32encode_into(s, dst):
+    """Encode the byte string s using Base32 into the writable buffer dst.
+
+    dst must hold (len(s) + 4) // 5 * 8 bytes.  Returns the number of
+    bytes written.
+    """
+    src = memoryview(s)
+    out = memoryview(dst)
+    quanta, leftover = divmod(len(src), 5)
+    _b32encode_quanta(src, out, quanta, _b32tab)
+    j = quanta * 8
+    if leftover:
+        # Pad the last quantum with zero bits
+        last = bytearray(5)
+        last[:leftover] = src[quanta * 5:]
+        _b32encode_quanta(last, out[j:], 1, _b32tab)
+        for k in range(j + 8 - _b32pad[leftover], j + 8):
+            out[k] = 61             # '='
+        j += 8
+    return j
 
 
 def b32encode(s):
@@ -164,42 +404,46 @@ def b32encode(s):
     """
     if not isinstance(s, bytes_types):
         raise TypeError("expected bytes, not %s" % s.__class__.__name__)
-    quanta, leftover = divmod(len(s), 5)
-    # Pad the last quantum with zero bits if necessary
-    if leftover:
-        s = s + bytes(5 - leftover)  # Don't use += !
-        quanta += 1
-    encoded = bytearray()
-    for i in range(quanta):
-        # c1 and c2 are 16 bits wide, c3 is 8 bits wide.  The intent of this
-        # code is to process the 40 bits in units of 5 bits.  So we take the 1
-        # leftover bit of c1 and tack it onto c2.  Then we take the 2 leftover
-        # bits of c2 and tack them onto c3.  The shifts and masks are intended
-        # to give us values of exactly 5 bits in width.
-        c1, c2, c3 = struct.unpack('!HHB', s[i*5:(i+1)*5])
-        c2 += (c1 & 1) << 16 # 17 bits wide
-        c3 += (c2 & 3) << 8  # 10 bits wide
-        encoded += bytes([_b32tab[c1 >> 11],         # bits 1 - 5
-                          _b32tab[(c1 >> 6) & 0x1f], # bits 6 - 10
-                          _b32tab[(c1 >> 1) & 0x1f], # bits 11 - 15
-                          _b32tab[c2 >> 12],         # bits 16 - 20 (1 - 5)
-                          _b32tab[(c2 >> 7) & 0x1f], # bits 21 - 25 (6 - 10)
-                          _b32tab[(c2 >> 2) & 0x1f], # bits 26 - 30 (11 - 15)
-                          _b32tab[c3 >> 5],          # bits 31 - 35 (1 - 5)
-                          _b32tab[c3 & 0x1f],        # bits 36 - 40 (1 - 5)
-                          ])
-    # Adjust for any leftover partial quanta
-    if leftover == 1:
-        encoded = encoded[:-6] + b'======'
-    elif leftover == 2:
-        encoded = encoded[:-4] + b'===='
-    elif leftover == 3:
-        encoded = encoded[:-3] + b'==='
-    elif leftover == 4:
-        encoded = encoded[:-1] + b'='
+    encoded = bytearray((len(s) + 4) // 5 * 8)
+    b32encode_into(s, encoded)
     return bytes(encoded)
 
 
+def b32decode_into(s, dst):
+    """Decode the Base32 byte string s into the writable buffer dst.
+
+    s must use the uppercase alphabet and be padded to a multiple of 8
+    characters.  dst must hold len(s) // 8 * 5 bytes.  Returns the number
+    of bytes written.  binascii.Error is raised as in b32decode().
+    """
+    src = memoryview(s)
+    out = memoryview(dst)
+    n = len(src)
+    if n % 8:
+        raise binascii.Error('Incorrect padding')
+    end = n
+    while end and src[end - 1] == 61:
+        end -= 1
+    padchars = n - end
+    if padchars not in _b32unpad:
+        raise binascii.Error('Incorrect padding')
+    quanta = end // 8
+    if _b32decode_quanta(src, out, quanta, _b32rev) < quanta:
+        raise binascii.Error('Non-base32 digit found')
+    j = quanta * 5
+    if padchars:
+        # Decode the last quantum with the padding as zero bits
+        last = bytearray(b'AAAAAAAA')
+        last[:end - quanta * 8] = src[quanta * 8:end]
+        decoded = bytearray(5)
+        if not _b32decode_quanta(last, decoded, 1, _b32rev):
+            raise binascii.Error('Non-base32 digit found')
+        k = 5 - _b32unpad[padchars]
+        out[j:j + k] = decoded[:k]
+        j += k
+    return j
+
+
 def b32decode(s, casefold=False, map01=None):
     """Decode a Base32 encoded byte string.
 
@@ -220,8 +464,7 @@ def b32decode(s, casefold=False, map01=None):
     characters present in the input.
     """
     s = _bytes_from_decode_data(s)
-    quanta, leftover = divmod(len(s), 8)
-    if leftover:
+    if len(s) % 8:
         raise binascii.Error('Incorrect padding')
     # Handle section 2.4 zero and one mapping.  The flag map01 will be either
     # False, or the character to map the digit 1 (one) to.  It should be
@@ -229,55 +472,31 @@ def b32decode(s, casefold=False, map01=None):
     if map01 is not None:
         map01 = _bytes_from_decode_data(map01)
         assert len(map01) == 1, repr(map01)
-        s = s.translate(bytes.maketrans(b'01', b'O' + map01))
+        s = _translate(s, _maketrans(b'01', b'O' + map01))
     if casefold:
         s = s.upper()
-    # Strip off pad characters from the right.  We need to count the pad
-    # characters because this will tell us how many null bytes to remove from
-    # the end of the decoded string.
-    padchars = s.find(b'=')
-    if padchars > 0:
-        padchars = len(s) - padchars
-        s = s[:-padchars]
-    else:
-        padchars = 0
-
-    # Now decode the full quanta
-    parts = []
-    acc = 0
-    shift = 35
-    for c in s:
-        val = _b32rev.get(c)
-        if val is None:
-            raise binascii.Error('Non-base32 digit found')
-        acc += _b32rev[c] << shift
-        shift -= 5
-        if shift < 0:
-            parts.append(binascii.unhexlify(bytes('%010x' % acc, "ascii")))
-            acc = 0
-            shift = 35
-    # Process the last, partial quanta
-    last = binascii.unhexlify(bytes('%010x' % acc, "ascii"))
-    if padchars == 0:
-        last = b''                      # No characters
-    elif padchars == 1:
-        last = last[:-1]
-    elif padchars == 3:
-        last = last[:-2]
-    elif padchars == 4:
-        last = last[:-3]
-    elif padchars == 6:
-        last = last[:-4]
-    else:
-        raise binascii.Error('Incorrect padding')
-    parts.append(last)
-    return b''.join(parts)
+    decoded = bytearray(len(s) // 8 * 5)
+    n = b32decode_into(s, decoded)
+    return bytes(memoryview(decoded)[:n])
 
 
 
 # RFC 3548, Base 16 Alphabet specifies uppercase, but hexlify() returns
 # lowercase.  The RFC also recommends against accepting input case
 # insensitively.
+def b16encode_into(s, dst):
+    """Encode the byte string s using Base16 into the writable buffer dst.
+
+    dst must hold 2 * len(s) bytes.  Returns the number of bytes written.
+    """
+    n = len(s)
+    if _viper is None:
+        memoryview(dst)[:2 * n] = binascii.hexlify(s).upper()
+    else:
+        _viper.b16encode_block(memoryview(s), memoryview(dst), n, _b16tab)
+    return 2 * n
+
+
 def b16encode(s):
     """Encode a byte string using Base16.
 
@@ -285,7 +504,37 @@ def b16encode(s):
     """
     if not isinstance(s, bytes_types):
         raise TypeError("expected bytes, not %s" % s.__class__.__name__)
-    return binascii.hexlify(s).upper()
+    if _viper is None:
+        return binascii.hexlify(s).upper()
+    encoded = bytearray(2 * len(s))
+    b16encode_into(s, encoded)
+    return bytes(encoded)
+
+
+def _b16decode(s):
+    # unhexlify() checks the digits, but takes lowercase too
+    if s.upper() != s:
+        raise binascii.Error('Non-base16 digit found')
+    try:
+        return binascii.unhexlify(s)
+    except (ValueError, TypeError):
+        raise binascii.Error('Non-base16 digit found')
+
+
+def b16decode_into(s, dst):
+    """Decode the uppercase Base16 byte string s into the writable buffer dst.
+
+    dst must hold len(s) // 2 bytes.  Returns the number of bytes written.
+    binascii.Error is raised as in b16decode().
+    """
+    if len(s) % 2:
+        raise binascii.Error('Odd-length string')
+    n = len(s) // 2
+    if _viper is None:
+        memoryview(dst)[:n] = _b16decode(s)
+    elif _viper.b16decode_block(memoryview(s), memoryview(dst), n, _b16rev) < n:
+        raise binascii.Error('Non-base16 digit found')
+    return n
 
 
 def b16decode(s, casefold=False):
@@ -302,9 +551,11 @@ def b16decode(s, casefold=False):
     s = _bytes_from_decode_data(s)
     if casefold:
         s = s.upper()
-    if re.search(b'[^0-9A-F]', s):
-        raise binascii.Error('Non-base16 digit found')
-    return binascii.unhexlify(s)
+    if _viper is None:
+        return _b16decode(s)
+    decoded = bytearray(len(s) // 2)
+    b16decode_into(s, decoded)
+    return bytes(decoded)
 
 
 
@@ -317,6 +568,15 @@ MAXBINSIZE = (MAXLINESIZE//4)*3
 
 def encode(input, output):
     """Encode a file; input and output are binary files."""
+    if hasattr(input, 'readinto'):
+        # One line buffer for the whole file
+        line = memoryview(bytearray(MAXBINSIZE))
+        while True:
+            n = _readinto_full(input, line)
+            if not n:
+                break
+            output.write(binascii.b2a_base64(line[:n]))
+        return
     while True:
         s = input.read(MAXBINSIZE)
         if not s:
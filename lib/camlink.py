@@ -0,0 +1,185 @@
+import utime
+
+from uartrx import UartTimeout
+
+try:
+    from ubinascii import crc32
+except ImportError:
+    crc32 = None
+
+_SYNC = 0xa5
+_ACK = 0x06
+_NAK = 0x15
+
+
+def _crc32_table():
+    table = []
+    for i in range(256):
+        c = i
+        for _ in range(8):
+            c = (c >> 1) ^ 0xedb88320 if c & 1 else c >> 1
+        table.append(c)
+    return table
+
+
+if crc32 is None:
+    _CRC_TABLE = _crc32_table()
+
+    def crc32(data, crc=0):
+        crc ^= 0xffffffff
+        for b in data:
+            crc = _CRC_TABLE[(crc ^ b) & 0xff] ^ (crc >> 8)
+        return crc ^ 0xffffffff
+
+
+class CameraLinkError(OSError):
+    pass
+
+
+class CameraLink:
+    """Picture transfer from the ESP32-CAM over the UART.
+
+    After the Hello/ready handshake, negotiate() steps the baud rate up.  For
+    each rate the GPy sends 'BAUD <rate>' and the camera answers 'OK <rate>'
+    (or 'NO' if it can not use that rate).  Both sides switch and the GPy
+    repeats 'Hello'; if 'ready' does not come back at the new rate, both
+    return to the base rate and the next lower rate is tried.  Only call it
+    with a camera whose firmware knows the BAUD request: the firmware before
+    it takes the request as the picture filename and starts a capture.
+
+    At a negotiated rate the picture is sent in blocks:
+        0xa5, sequence (2 bytes LE), length (2 bytes LE), data, CRC32 (4 bytes LE)
+    The CRC covers the sequence, length and data.  Each block is answered with
+    ACK (0x06) or NAK (0x15) followed by the sequence; the camera repeats a
+    block after a NAK or when no answer arrives.
+
+    All reads go through the UartReceiver rx, so they are bounded by its
+    inter-byte and transfer deadlines.  read(mv, n) fills a memoryview with
+    picture bytes in either protocol and the transfer rate is reported by
+    report().
+    """
+
+    BAUDRATES = (921600, 460800, 230400, 115200)
+
+    def __init__(self, uart, rx, baudrate=38400, rx_buffer_size=4096,
+                 block_size=1024, timeout_ms=1000, retries=5):
+        self.uart = uart
+        self.rx = rx
+        self.base_baudrate = baudrate
+        self.baudrate = baudrate
+        self.rx_buffer_size = rx_buffer_size
+        self.timeout_ms = timeout_ms
+        self.retries = retries
+        self.framed = False
+        self.block = bytearray(block_size + 9)
+        self.block_mv = memoryview(self.block)
+        self.reply = bytearray(3)
+        self.seq = 0
+        self.pos = 0            # Next unread byte of the current block
+        self.end = 0            # End of the data in the current block
+        self.bytes = 0
+        self.naks = 0
+
+    def _init(self, baudrate):
+        self.uart.init(baudrate, bits=8, parity=None, stop=1,
+                       rx_buffer_size=self.rx_buffer_size)
+        self.baudrate = baudrate
+
+    def negotiate(self, rates=BAUDRATES):
+        """Step the baud rate up.  Return the rate in use."""
+        for rate in rates:
+            self.uart.write('BAUD %d\0' % rate)
+            reply = self.rx.readline(500)
+            print("BAUD", rate, reply)
+            if reply is None:
+                return self.baudrate            # Camera without negotiation
+            if not reply.strip() == b'OK %d' % rate:
+                continue
+            utime.sleep_ms(20)
+            self._init(rate)
+            self.uart.write('Hello\0')
+            if self.rx.readline(500) == b'ready':
+                self.framed = True
+                return rate
+            # The camera also returns to the base rate when Hello does not come
+            self._init(self.base_baudrate)
+            utime.sleep_ms(1000)
+        return self.baudrate
+
+    def _read_exactly(self, mv, n):
+        """Fill mv[:n] from the UART.  Return False on a block timeout."""
+        try:
+            self.rx.readinto(mv, n, self.timeout_ms)
+        except UartTimeout:
+            if self.rx.expired():
+                raise
+            return False
+        return True
+
+    def _answer(self, code, seq):
+        self.reply[0] = code
+        self.reply[1] = seq & 0xff
+        self.reply[2] = seq >> 8
+        self.uart.write(self.reply)
+
+    def _next_block(self):
+        mv = self.block_mv
+        errors = 0
+        while errors <= self.retries:
+            # Look for the start of a block
+            if not self._read_exactly(mv, 1):
+                errors += 1
+                self._answer(_NAK, self.seq)
+                continue
+            if self.block[0] != _SYNC:
+                continue
+            ok = self._read_exactly(mv[1:], 4)
+            seq = self.block[1] | self.block[2] << 8
+            length = self.block[3] | self.block[4] << 8
+            if ok and length <= len(self.block) - 9:
+                ok = self._read_exactly(mv[5:], length + 4)
+            else:
+                ok = False
+            if ok:
+                crc = (self.block[5 + length] | self.block[6 + length] << 8 |
+                       self.block[7 + length] << 16 | self.block[8 + length] << 24)
+                ok = crc32(mv[1:5 + length]) & 0xffffffff == crc
+            if not ok:
+                errors += 1
+                self.naks += 1
+                self._answer(_NAK, self.seq)
+                continue
+            self._answer(_ACK, seq)
+            if seq != self.seq:
+                continue        # Repeat of a block whose ACK was lost
+            self.seq = (self.seq + 1) & 0xffff
+            self.pos = 5
+            self.end = 5 + length
+            return
+        raise CameraLinkError("camera link: block %d failed" % self.seq)
+
+    def read(self, mv, n):
+        """Fill the first n bytes of mv with picture bytes."""
+        if not self.framed:
+            self.rx.readinto(mv, n)
+        else:
+            filled = 0
+            while filled < n:
+                if self.pos == self.end:
+                    self._next_block()
+                k = min(n - filled, self.end - self.pos)
+                mv[filled:filled + k] = self.block_mv[self.pos:self.pos + k]
+                self.pos += k
+                filled += k
+        self.bytes += n
+
+    def report(self):
+        """Print and return the bytes/s of the transfer."""
+        stats = self.rx.stats()
+        ms = stats['ms']
+        rate = self.bytes * 1000 // ms if ms > 0 else 0
+        print("UART transfer: %d bytes in %d ms, %d bytes/s at %d baud, %d NAKs, "
+              "%d stalls, longest gap %d ms"
+              % (self.bytes, ms, rate, self.baudrate, self.naks,
+                 stats['stalls'], stats['max_gap_ms']))
+        return rate
@@ -0,0 +1,137 @@
+class ClockDiscipline:
+    """Drift of the DS3231 learnt from its error at the NTP syncs, kept on the flash.
+
+    record(t, error_ms) adds the error of the DS3231 (its time minus the NTP
+    time, in ms) measured at DS3231 time t (seconds) at a sync.  The last
+    samples of them are kept in the file at path, one 't error_ms' line each.
+    The DS3231 runs free between syncs, so the errors lie on a line whose
+    slope is the drift: drift_ppm() fits it by least squares, and
+    correction_ms(t) predicts the error at t, to be taken off the DS3231
+    time.  When the DS3231 is set, stepped(ms) moves the samples by the step
+    so that the line goes on.  An error far off the line (the DS3231 stopped
+    or was set elsewhere) starts a new history.
+
+    next_sync() is the DS3231 time at which the corrected time may be
+    tolerance_ms off.  Until three samples the drift is taken to be known to
+    max_ppm (the DS3231 specification from -40 to 85 C); then to how far the
+    drift between successive syncs strays from the fit, and at least min_ppm.
+    The interval after the last sync is kept between min_interval and
+    max_interval seconds.
+
+    calibrate() turns the learnt drift into a new aging offset of the
+    DS3231, so that it needs fewer syncs.
+    """
+
+    def __init__(self, path, tolerance_ms=1000, samples=8, max_ppm=3.5,
+                 min_ppm=0.1, min_interval=3600, max_interval=30 * 86400,
+                 jump_ms=60000):
+        self.path = path
+        self.tolerance_ms = tolerance_ms
+        self.samples = samples
+        self.max_ppm = max_ppm
+        self.min_ppm = min_ppm
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jump_ms = jump_ms
+        self.history = []           # (DS3231 seconds, error ms), oldest first
+        self._load()
+
+    def _load(self):
+        try:
+            f = open(self.path)
+        except OSError:
+            return
+        try:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2:
+                    self.history.append((int(parts[0]), int(parts[1])))
+        finally:
+            f.close()
+
+    def _save(self):
+        f = open(self.path, 'w')
+        try:
+            for t, error in self.history:
+                f.write('%d %d\n' % (t, error))
+        finally:
+            f.close()
+
+    def record(self, t, error_ms):
+        if self.history and abs(error_ms - self.correction_ms(t)) > self.jump_ms:
+            self.history = []
+        self.history.append((t, error_ms))
+        del self.history[:-self.samples]
+        self._save()
+
+    def stepped(self, ms):
+        """The DS3231 was set ms earlier (ms is the error it had)."""
+        s = (ms + 500) // 1000
+        self.history = [(t - s, error - ms) for t, error in self.history]
+        self._save()
+
+    def _fit(self):
+        # (mean time, mean error, slope in ms per s) of the history
+        n = len(self.history)
+        tm = sum(t for t, e in self.history) / n
+        em = sum(e for t, e in self.history) / n
+        stt = sum((t - tm) ** 2 for t, e in self.history)
+        if not stt:
+            return tm, em, 0.0
+        ste = sum((t - tm) * (e - em) for t, e in self.history)
+        return tm, em, ste / stt
+
+    def drift_ppm(self):
+        """Drift of the DS3231 in ppm (positive: fast), None before two samples."""
+        if len(self.history) < 2:
+            return None
+        return self._fit()[2] * 1000
+
+    def correction_ms(self, t):
+        """Predicted error of the DS3231 at its time t, in ms."""
+        if not self.history:
+            return 0
+        if len(self.history) < 2:
+            return self.history[0][1]
+        tm, em, slope = self._fit()
+        return int(em + slope * (t - tm))
+
+    def uncertainty_ppm(self):
+        if len(self.history) < 3:
+            return self.max_ppm
+        drift = self.drift_ppm()
+        stray = self.min_ppm
+        for i in range(1, len(self.history)):
+            t0, e0 = self.history[i - 1]
+            t1, e1 = self.history[i]
+            if t1 > t0:
+                stray = max(stray, abs((e1 - e0) * 1000 / (t1 - t0) - drift))
+        return min(stray, self.max_ppm)
+
+    def calibrate(self, aging, temperature, ppm_per_lsb=0.1, max_uncertainty=0.5):
+        """Return the aging offset that trims the drift out, None to keep aging.
+
+        The drift must be known to max_uncertainty ppm, at least one LSB of
+        the offset, and the DS3231 at 0 to 40 C, where one LSB is about
+        ppm_per_lsb.  The caller writes the new offset; the history is cut
+        to the last sample, since the drift it shows is gone.
+        """
+        if len(self.history) < 3 or not 0 <= temperature <= 40:
+            return None
+        if self.uncertainty_ppm() > max_uncertainty:
+            return None
+        new = aging + int(round(self.drift_ppm() / ppm_per_lsb))
+        new = max(-128, min(new, 127))
+        if new == aging:
+            return None
+        del self.history[:-1]
+        self._save()
+        return new
+
+    def next_sync(self):
+        """DS3231 time (seconds) of the next sync, 0 if there was none."""
+        if not self.history:
+            return 0
+        interval = int(self.tolerance_ms * 1000 / self.uncertainty_ppm())
+        interval = max(self.min_interval, min(interval, self.max_interval))
+        return self.history[-1][0] + interval
@@ -0,0 +1,125 @@
+try:
+    import usocket
+except ImportError:
+    import socket as usocket
+try:
+    import utime
+except ImportError:
+    import time as utime
+
+from wakestate import WakeState
+
+
+def _key(host):
+    # 32-bit FNV-1a hash of the name: NVS keys are at most 15 characters
+    h = 0x811c9dc5
+    for c in host.encode():
+        h = ((h ^ c) * 0x01000193) & 0xffffffff
+    return '%08x' % h
+
+
+def _lookup(host, port, af=0, type=0, proto=0):
+    # usocket.getaddrinfo() of the GPy takes the host and port only: the
+    # addresses of the family af are picked here, and given the type asked
+    ai = [(a[0], type or a[1], proto or a[2], a[3], a[4])
+          for a in usocket.getaddrinfo(host, port) if not af or a[0] == af]
+    if not ai:
+        raise OSError("no address for " + host)
+    return ai
+
+
+class DnsCache:
+    """Host name lookups kept over deep sleep in the pycom NVS.
+
+    getaddrinfo() answers from the cache while the address of the name is
+    less than ttl seconds old and looks the name up otherwise.  ttls gives
+    the names with their own ttl: 0 for names that rotate quickly (pool
+    names), which are always looked up and kept only for when the lookup
+    fails.  If the lookup fails, the last address is used however old it is.
+    prefetch() is called after the upload, while the link is still up: it
+    looks up the names whose address is past half its ttl, so that the next
+    wakes find them fresh.  clock() gives the time in
+    seconds; an address from the future (the clock was set back) is old.
+
+    Only IPv4 addresses are kept, as two values per name (the address and
+    the time of the lookup).  hits counts the answers from the cache, misses
+    the lookups and stale the failed lookups answered from the cache.
+    """
+
+    def __init__(self, ttl=86400, clock=utime.time, prefix='d_'):
+        self.ttl = ttl
+        self.ttls = {}
+        self.clock = clock
+        self.nvs = WakeState(prefix)
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def cached(self, host):
+        """Return (ip, age in seconds) of the address of host, None if there is none."""
+        key = _key(host)
+        ip = self.nvs.get(key + 'a')
+        if not ip:
+            return None
+        ip = '%d.%d.%d.%d' % (ip >> 24, ip >> 16 & 255, ip >> 8 & 255, ip & 255)
+        return ip, self.clock() - self.nvs.get(key + 't')
+
+    def _store(self, host, ai):
+        parts = ai[0][-1][0].split('.')
+        if len(parts) != 4:
+            return
+        key = _key(host)
+        self.nvs.set(key + 'a', int(parts[0]) << 24 | int(parts[1]) << 16 | int(parts[2]) << 8 | int(parts[3]))
+        self.nvs.set(key + 't', self.clock())
+
+    def getaddrinfo(self, host, port, af=0, type=0, proto=0, flags=0):
+        """usocket.getaddrinfo() answered from the cache when it can.
+
+        Takes the arguments of the full getaddrinfo(), but flags are ignored
+        and the lookups ask the host and port only, as the GPy does.
+        """
+        if host.replace('.', '').isdigit() or af not in (0, usocket.AF_INET):
+            return _lookup(host, port, af, type, proto)
+        cached = self.cached(host)
+        if cached and 0 <= cached[1] < self.ttls.get(host, self.ttl):
+            self.hits += 1
+            return [(usocket.AF_INET, type or usocket.SOCK_STREAM, proto, '', (cached[0], port))]
+        self.misses += 1
+        try:
+            ai = _lookup(host, port, usocket.AF_INET, type, proto)
+        except OSError:
+            if not cached:
+                raise
+            self.stale += 1
+            print("DNS failed, using the last address of", host)
+            return [(usocket.AF_INET, type or usocket.SOCK_STREAM, proto, '', (cached[0], port))]
+        self._store(host, ai)
+        return ai
+
+    def prefetch(self, hosts):
+        """Look up the hosts with no address or one past half its ttl.
+
+        Names with a ttl of 0 are skipped: the next wake looks them up
+        anyway.  A failed lookup keeps the old address.  Returns the number
+        of names looked up.
+        """
+        n = 0
+        for host in hosts:
+            ttl = self.ttls.get(host, self.ttl)
+            cached = self.cached(host)
+            if not ttl or cached and 0 <= cached[1] < ttl // 2:
+                continue
+            try:
+                self._store(host, _lookup(host, 80, usocket.AF_INET))
+            except OSError:
+                continue
+            n += 1
+        return n
+
+
+# The cache shared by main.py, urequests, resumable and untplib
+cache = DnsCache()
+
+
+def getaddrinfo(host, port, af=0, type=0, proto=0, flags=0):
+    return cache.getaddrinfo(host, port, af, type, proto, flags)
@@ -132,6 +132,19 @@ class DS3231:
         return ratio * factor
 
 
+    # Aging offset: signed trim of the oscillator, about -0.1ppm per LSB at 25C
+    def get_aging_offset(self):
+        return self._twos_complement(self.ds3231.readfrom_mem(DS3231_I2C_ADDR, 0x10, 1)[0], 8)
+
+    def set_aging_offset(self, value):
+        if not -128 <= value <= 127:
+            raise ValueError('aging offset out of range')
+        self.ds3231.writeto_mem(DS3231_I2C_ADDR, 0x10, tobytes(value & 0xff))
+        # Start a temperature conversion (CONV), which applies the new offset
+        control = self.ds3231.readfrom_mem(DS3231_I2C_ADDR, 0x0e, 1)[0]
+        self.ds3231.writeto_mem(DS3231_I2C_ADDR, 0x0e, tobytes(control | 0x20))
+
+
     def _twos_complement(self, input_value: int, num_bits: int) -> int:
         mask = 2 ** (num_bits - 1)
         return -(input_value & mask) + (input_value & ~mask)
@@ -0,0 +1,172 @@
+import uos
+import utime
+
+
+class Outbox:
+    """Pictures kept on the flash until the server has received them.
+
+    Each picture is one file named <station id>_<YYYYMMDDhhmmss>_<voltage>.jpg,
+    so the metadata needed to upload it later is kept with it.  The outbox is
+    bounded by max_bytes and max_files.  The oldest pictures are evicted to make
+    room for a new one.
+    """
+
+    def __init__(self, directory, max_bytes=512 * 1024, max_files=20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        try:
+            uos.mkdir(directory)
+        except OSError:
+            pass            # Already exists
+
+    def path(self, name):
+        return self.directory + '/' + name
+
+    def entries(self, newest_first=False):
+        """Return a list of (name, size) sorted by time stamp."""
+        names = [n for n in uos.listdir(self.directory) if n.endswith('.jpg')]
+        names.sort(key=lambda n: n.split('_')[1], reverse=newest_first)
+        return [(n, uos.stat(self.path(n))[6]) for n in names]
+
+    def add(self, station, stamp, voltage, size):
+        """Make room for a picture of size bytes and return its file path.
+
+        stamp is the time stamp in 2021-10-01T07:05:00 format.  Return None,
+        and evict nothing, if the picture is larger than the whole outbox.
+        """
+        if size > self.max_bytes:
+            print("Picture larger than the outbox:", size)
+            return None
+        name = '%s_%s_%s.jpg' % (station, stamp_digits(stamp), voltage)
+        entries = [e for e in self.entries() if e[0] != name]
+        total = sum(e[1] for e in entries)
+        while entries and (total + size > self.max_bytes or
+                           len(entries) >= self.max_files):
+            old, old_size = entries.pop(0)
+            print("Outbox full, evict", old)
+            uos.remove(self.path(old))
+            total -= old_size
+        return self.path(name)
+
+    def remove(self, name):
+        try:
+            uos.remove(self.path(name))
+        except OSError:
+            pass
+
+    def discard(self, path):
+        """Remove the picture at path, as returned by add()."""
+        self.remove(path[len(self.directory) + 1:])
+
+    def drain(self, send, max_bytes, max_ms, newest_first=False):
+        """Upload pictures with send(path, station, stamp, voltage, size).
+
+        send returns True once the server holds the picture, which is then
+        removed.  The first picture is sent whatever its size; a later one
+        that would exceed the byte budget is skipped, for the next drain.
+        Stop at the first failure or when max_ms have passed.  Return the
+        number of pictures sent.
+        """
+        start = utime.ticks_ms()
+        sent = 0
+        sent_bytes = 0
+        for name, size in self.entries(newest_first):
+            if sent and sent_bytes + size > max_bytes:
+                continue
+            if utime.ticks_diff(utime.ticks_ms(), start) > max_ms:
+                break
+            station, stamp, voltage = meta(name)
+            if not send(self.path(name), station, stamp, voltage, size):
+                break
+            self.remove(name)
+            sent += 1
+            sent_bytes += size
+        return sent
+
+
+def meta(name):
+    """Return (station, stamp, voltage) of an outbox file name."""
+    station, digits, voltage = name[:-4].split('_')
+    stamp = '{}-{}-{}T{}:{}:{}'.format(digits[0:4], digits[4:6], digits[6:8],
+                                     digits[8:10], digits[10:12], digits[12:14])
+    return station, stamp, voltage
+
+
+# 2021-10-01T07:05:00 -> 20211001070500
+def stamp_digits(stamp):
+    return stamp.replace('-', '').replace('T', '').replace(':', '')
+
+
+class Spool:
+    """A picture received into an outbox file while it is being uploaded.
+
+    pump() moves the next chunk from read_source(mv, n) (the camera) to the
+    file.  read(mv, n) returns the picture bytes in order from the file and
+    pumps more from the source whenever it catches up with the receiver, so
+    the upload can start before the picture is complete and never waits for
+    more than the bytes it needs.  An exception raised by read_source is kept
+    in error and raised again by every later pump().  With no path (the
+    picture does not fit the outbox) nothing is kept: read() takes the bytes
+    straight from the source and pump() does nothing.
+    """
+
+    def __init__(self, path, length, read_source, chunk_size=1536):
+        self.path = path
+        self.length = length
+        self.read_source = read_source
+        self.buf = bytearray(chunk_size)
+        self.mv = memoryview(self.buf)
+        self.received = 0
+        self.pos = 0
+        self.error = None
+        self.w = open(path, 'wb') if path else None
+        self.r = None
+
+    def done(self):
+        return self.received >= self.length
+
+    def _source(self, mv, n):
+        if self.error:
+            raise self.error
+        try:
+            self.read_source(mv, n)
+        except Exception as e:
+            self.error = e
+            raise
+
+    def pump(self):
+        if self.error:
+            raise self.error
+        n = min(len(self.buf), self.length - self.received)
+        if n <= 0 or self.w is None:
+            return
+        self._source(self.mv, n)
+        self.w.write(self.mv[:n])
+        self.w.flush()
+        self.received += n
+
+    def read(self, mv, n):
+        if self.w is None:
+            self._source(mv, n)
+            self.received += n
+            self.pos += n
+            return
+        while self.received < self.pos + n:
+            self.pump()
+        if self.r is None:
+            self.r = open(self.path, 'rb')
+        self.r.seek(self.pos)
+        got = 0
+        while got < n:
+            r = self.r.readinto(mv[got:n])
+            if not r:
+                raise OSError("picture file too short")
+            got += r
+        self.pos += n
+
+    def close(self):
+        if self.w:
+            self.w.close()
+        if self.r:
+            self.r.close()
@@ -0,0 +1,150 @@
+import usocket
+
+from dnscache import getaddrinfo
+
+
+class UploadError(Exception):
+    pass
+
+
+class ResumableUpload:
+    """Resumable upload of one picture.
+
+    The picture is sent in fixed-size chunks.  Each chunk is a PATCH request to
+    <path>/<upload_id> carrying the byte offset of the chunk (Upload-Offset) and
+    the picture length (Upload-Length).  The server keeps every complete chunk
+    under the upload id, so after a dropped connection a HEAD request returns
+    the offset to continue from, within the same wake or on a later one.  The
+    extra headers (picture metadata, wake trace) go with the chunk at offset 0
+    only; the server keeps them with the chunks.
+
+    One connection (HTTP/1.1 keep-alive) is used for all chunks until it fails.
+    """
+
+    def __init__(self, host, port, path, upload_id, headers="", timeout=30):
+        self.host = host
+        self.port = port
+        self.base_path = path
+        self.timeout = timeout
+        self.s = None
+        self.f = None
+        self.bytes_sent = 0         # Picture bytes put on the wire, including resends
+        self.retries = 0            # Reconnects after a failed request
+        self.start(upload_id, headers)
+
+    def start(self, upload_id, headers=""):
+        """Start the upload of a picture.  An open connection is kept."""
+        self.path = self.base_path + "/" + upload_id
+        self.headers = headers      # Extra header lines sent with the first chunk
+        self.reply = None           # Body of the reply to the last chunk
+
+    def connect(self):
+        ai = getaddrinfo(self.host, self.port)[0]
+        s = usocket.socket()
+        s.settimeout(self.timeout)
+        try:
+            s.connect(ai[-1])
+        except OSError:
+            s.close()
+            raise
+        self.s = s
+        self.f = s.makefile('rb', 0)
+
+    def close(self):
+        if self.s:
+            self.s.close()
+            self.s = None
+            self.f = None
+
+    def _read_response(self, head=False):
+        l = self.f.readline()
+        if not l:
+            raise OSError("connection closed")
+        status = int(l.split(None, 2)[1])
+        offset = None
+        length = 0
+        while True:
+            l = self.f.readline()
+            if not l or l == b"\r\n":
+                break
+            l = l.lower()
+            if l.startswith(b"upload-offset:"):
+                offset = int(l[14:])
+            elif l.startswith(b"content-length:"):
+                length = int(l[15:])
+        body = b""
+        # The reply to a HEAD request has no body, even with a Content-Length
+        while not head and len(body) < length:
+            data = self.f.read(length - len(body))
+            if not data:
+                raise OSError("connection closed")
+            body += data
+        return status, offset, body
+
+    def _request(self, method, headers, body=None):
+        if self.s is None:
+            self.connect()
+        try:
+            self.s.sendall(("%s %s HTTP/1.1\r\nHost: %s:%d\r\n%s\r\n" % (
+                method, self.path, self.host, self.port, headers)).encode())
+            if body is not None:
+                self.s.sendall(body)
+                self.bytes_sent += len(body)
+            return self._read_response(method == "HEAD")
+        except OSError:
+            self.close()
+            raise
+
+    def offset(self):
+        """Return the number of picture bytes the server already holds."""
+        status, offset, body = self._request("HEAD", "")
+        if status == 404:
+            return 0
+        if status != 200 or offset is None:
+            raise UploadError("HEAD status %d" % status)
+        return offset
+
+    def send(self, offset, mv, length):
+        """Send the chunk mv that starts at offset.  Return the server offset."""
+        first = self.headers + "Content-Type: application/offset+octet-stream\r\n" \
+            if offset == 0 else ""
+        status, offset, body = self._request(
+            "PATCH",
+            "%sContent-Length: %d\r\nUpload-Offset: %d\r\nUpload-Length: %d\r\n"
+            % (first, len(mv), offset, length), mv)
+        # 409 Conflict: the server holds a different offset.  Continue from there.
+        if status not in (200, 204, 409) or offset is None:
+            raise UploadError("PATCH status %d" % status)
+        if status == 200:
+            self.reply = body
+        return offset
+
+    def resume(self, f, end, length, mv, retries=3):
+        """Send the bytes of the file f the server does not hold, up to offset end.
+
+        f holds the picture from offset 0.  mv is the chunk buffer; its length is
+        the chunk size and must be the same for every request of the upload.
+        Reconnect up to retries times if the connection fails.  Return the
+        server offset.
+        """
+        attempt = 0
+        while True:
+            try:
+                offset = self.offset()
+                while offset < end:
+                    n = min(len(mv), length - offset)
+                    f.seek(offset)
+                    got = 0
+                    while got < n:
+                        r = f.readinto(mv[got:n])
+                        if not r:
+                            raise UploadError("picture file too short")
+                        got += r
+                    offset = self.send(offset, mv[:n], length)
+                return offset
+            except OSError as e:
+                attempt += 1
+                self.retries += 1
+                print("Upload interrupted:", e)
+                if attempt > retries:
+                    raise
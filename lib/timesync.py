@@ -0,0 +1,97 @@
+import uselect
+import usocket
+import utime
+
+from dnscache import getaddrinfo
+from untplib import NTPClient, NTPException, NTPPacket, NTPStats, ntp_to_system_us
+
+
+class TimeSync(NTPClient):
+    """NTP time from the best of several servers within a time budget.
+
+    sync() sends one request to each server in hosts from a single
+    non-blocking UDP socket and collects the replies until every server has
+    answered or budget_ms has passed, so it takes about one round trip.  The
+    reply with the lowest round-trip delay is kept: its offset is the least
+    disturbed by the network.  The server names are looked up through the
+    DNS cache, within the budget.  Times are those of the GPy clock
+    (utime.time()), to the microsecond through utime.ticks_us().  The
+    packets are built in and parsed from the buffer of the client into two
+    NTPStats (the best reply and the last one); the 64-bit timestamps are
+    still long ints, allocated at each packet.
+    """
+
+    def __init__(self, hosts, budget_ms=3000, version=3, port=123):
+        NTPClient.__init__(self)
+        self.hosts = hosts
+        self.budget_ms = budget_ms
+        self.version = version
+        self.port = port
+        self.best = None            # NTPStats of the best reply
+        self._reply = NTPStats()
+        self._query = NTPPacket(version, 3)
+        self.sent = 0
+        self.replies = 0
+
+    def sync(self):
+        """Query the servers.  Return the best NTPStats, None if no server answered."""
+        start = utime.ticks_ms()
+        self.best = None
+        self.sent = self.replies = 0
+        s = usocket.socket(usocket.AF_INET, usocket.SOCK_DGRAM)
+        try:
+            s.setblocking(False)
+            pending = {}            # Transmit timestamp of the request by server address
+            for host in self.hosts:
+                if utime.ticks_diff(utime.ticks_ms(), start) >= self.budget_ms:
+                    break
+                try:
+                    address = getaddrinfo(host, self.port, 0, usocket.SOCK_DGRAM)[0][-1]
+                    if address[0] in pending:
+                        continue    # Pool names can share a server
+                    tx = self.local_time()
+                    self._query.tx_timestamp = tx
+                    self._query.pack_into(self.buf)
+                    s.sendto(self.buf, address)
+                except OSError as e:
+                    print("NTP server", host, e)
+                    continue
+                pending[address[0]] = tx
+                self.sent += 1
+
+            poll = uselect.poll()
+            poll.register(s, uselect.POLLIN)
+            while pending:
+                left = self.budget_ms - utime.ticks_diff(utime.ticks_ms(), start)
+                if left <= 0 or not poll.poll(left):
+                    break
+                data, address = s.recvfrom(256)
+                dest = self.local_time()
+                if address[0] not in pending:
+                    continue
+                stats = self._reply
+                try:
+                    stats.unpack_from(data)
+                except NTPException:
+                    continue
+                # Only the answer to our request, from a synchronized server
+                if stats.orig_timestamp != pending[address[0]] or stats.mode != 4 \
+                        or not 0 < stats.stratum < 16 or stats.leap == 3:
+                    continue
+                del pending[address[0]]
+                stats.dest_timestamp = dest
+                self.replies += 1
+                if self.best is None or stats.delay < self.best.delay:
+                    self._reply = self.best or NTPStats()
+                    self.best = stats
+        finally:
+            s.close()
+        return self.best
+
+    def time_us(self):
+        """Return the UTC time in microseconds: the GPy clock corrected by the best offset."""
+        return ntp_to_system_us(self.local_time() + self.best.offset)
+
+    def time(self):
+        """Return the UTC time in whole seconds."""
+        return self.time_us() // 1000000
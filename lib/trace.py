@@ -0,0 +1,131 @@
+import utime
+
+
+class Trace:
+    """Timing spans and counters of the wake cycle, kept on the flash.
+
+    span(name, start, end) records the ticks_ms span of a phase.  Spans of the
+    same name (e.g. the encode time of every chunk) are added up from the first
+    start.  begin(name) and end(name) record a span around the code between
+    them; count(name, n) adds to a counter.
+
+    save() writes the cycle as one line of text to a ring of the last cycles
+    slots in the file at path:
+
+        seq=12 t=20211001070500 boot=0+1850 battery=1850+14 wifi=1864+4210 bytes=30411 naks=1
+
+    Spans are <start>+<duration> in ms since boot, counters are plain numbers.
+    Each slot is slot_size bytes, so saving a cycle rewrites a single slot.
+    pending() returns the saved cycles the server has not been sent yet, which
+    are attached to the next upload (header()) and marked sent with ack().
+    """
+
+    def __init__(self, path, cycles=8, slot_size=256):
+        self.path = path
+        self.cycles = cycles
+        self.slot_size = slot_size
+        self.spans = {}
+        self.order = []
+        self.counters = {}
+        self.open = {}
+        self.seq = 0
+        self.acked = 0
+        self.records = []
+        self._load()
+
+    def _load(self):
+        # Slot 0 holds the sequence number of the last cycle sent to the server
+        try:
+            f = open(self.path, 'rb')
+        except OSError:
+            return
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        for i in range(0, len(data), self.slot_size):
+            line = data[i:i + self.slot_size].decode().strip()
+            if not line:
+                continue
+            if i == 0:
+                self.acked = int(line)
+                continue
+            seq = int(line.split(' ', 1)[0][4:])
+            self.records.append((seq, line))
+        self.records.sort()
+        if self.records:
+            self.seq = self.records[-1][0]
+
+    def _write_slot(self, index, line):
+        line = line.encode()[:self.slot_size - 1]
+        slot = line + b' ' * (self.slot_size - 1 - len(line)) + b'\n'
+        try:
+            f = open(self.path, 'r+b')
+        except OSError:
+            f = open(self.path, 'wb')
+            for i in range(self.cycles + 1):
+                f.write(b' ' * (self.slot_size - 1) + b'\n')
+        try:
+            f.seek(index * self.slot_size)
+            f.write(slot)
+        finally:
+            f.close()
+
+    def span(self, name, start, end):
+        d = utime.ticks_diff(end, start)
+        if name in self.spans:
+            self.spans[name][1] += d
+        else:
+            self.spans[name] = [start, d]
+            self.order.append(name)
+
+    def begin(self, name):
+        self.open[name] = utime.ticks_ms()
+
+    def end(self, name):
+        start = self.open.pop(name, None)
+        if start is not None:
+            self.span(name, start, utime.ticks_ms())
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def line(self, stamp=''):
+        """Return the current cycle as a line of text."""
+        parts = ['seq=%d' % (self.seq + 1)]
+        if stamp:
+            parts.append('t=' + stamp)
+        for name in self.order:
+            start, d = self.spans[name]
+            parts.append('%s=%d+%d' % (name, start, d))
+        for name in self.counters:
+            parts.append('%s=%d' % (name, self.counters[name]))
+        return ' '.join(parts)
+
+    def save(self, stamp=''):
+        """Write the current cycle to the ring."""
+        line = self.line(stamp)
+        self.seq += 1
+        self._write_slot(1 + (self.seq - 1) % self.cycles, line)
+        self.records.append((self.seq, line))
+        self.records = self.records[-self.cycles:]
+
+    def pending(self):
+        """Return the saved cycles not sent to the server, oldest first."""
+        return [line for seq, line in self.records if seq > self.acked]
+
+    def header(self, name='X-Wake-Trace'):
+        """Return the pending cycles as a header line ('' if there are none)."""
+        lines = self.pending()
+        if not lines:
+            return ''
+        return name + ': ' + ', '.join(lines) + '\r\n'
+
+    def ack(self):
+        """Mark the pending cycles as sent."""
+        if self.acked != self.seq:
+            self.acked = self.seq
+            self._write_slot(0, str(self.seq))
+
+    def report(self):
+        print("Trace:", self.line())
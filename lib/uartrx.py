@@ -0,0 +1,151 @@
+import utime
+
+try:
+    import uselect
+except ImportError:
+    uselect = None
+
+
+class UartTimeout(OSError):
+    pass
+
+
+class UartReceiver:
+    """Bounded UART receive engine.
+
+    Every read has an inter-byte deadline (gap_ms) and the transfer started
+    with start() has an overall deadline, so a hung sender can not keep the
+    GPy awake.  While no data is waiting the receiver sleeps (in a poll on the
+    UART where supported, otherwise in poll_ms steps) instead of spinning.
+
+    With ring_size > 0 the bytes waiting in the UART are moved to a ring
+    buffer in as few UART reads as possible and copied to the caller from
+    there; with ring_size 0 they are read directly into the caller's buffer.
+
+    stats() returns the bytes, duration, stalls (gaps longer than stall_ms)
+    and longest gap of the transfer.
+    """
+
+    def __init__(self, uart, ring_size=0, gap_ms=2000, stall_ms=50, poll_ms=10):
+        self.uart = uart
+        self.gap_ms = gap_ms
+        self.stall_ms = stall_ms
+        self.poll_ms = poll_ms
+        self.ring = bytearray(ring_size)
+        self.ring_mv = memoryview(self.ring)
+        self.rpos = 0
+        self.count = 0
+        self.poller = None
+        if uselect is not None:
+            try:
+                self.poller = uselect.poll()
+                self.poller.register(uart, uselect.POLLIN)
+            except Exception:
+                self.poller = None
+        self.start()
+
+    def start(self, timeout_ms=None):
+        """Start a transfer that must finish within timeout_ms (None: no limit)."""
+        now = utime.ticks_ms()
+        self.deadline = None
+        if timeout_ms is not None:
+            self.deadline = utime.ticks_add(now, timeout_ms)
+        self.start_ms = now
+        self.last_ms = now
+        self.bytes = 0
+        self.stalls = 0
+        self.max_gap_ms = 0
+
+    def stats(self):
+        return {
+            'bytes': self.bytes,
+            'ms': utime.ticks_diff(self.last_ms, self.start_ms),
+            'stalls': self.stalls,
+            'max_gap_ms': self.max_gap_ms,
+        }
+
+    def expired(self):
+        """Return True once the transfer deadline has passed."""
+        return (self.deadline is not None and
+                utime.ticks_diff(self.deadline, utime.ticks_ms()) <= 0)
+
+    def any(self):
+        return self.count + self.uart.any()
+
+    def wait(self, timeout_ms):
+        """Sleep until data is waiting.  Return False after timeout_ms."""
+        start = utime.ticks_ms()
+        while not self.any():
+            left = timeout_ms - utime.ticks_diff(utime.ticks_ms(), start)
+            if left <= 0:
+                return False
+            if self.poller:
+                self.poller.poll(left)
+            else:
+                utime.sleep_ms(min(left, self.poll_ms))
+        return True
+
+    def _fill(self):
+        # Move the bytes waiting in the UART to the ring buffer
+        n = len(self.ring)
+        while self.count < n and self.uart.any():
+            w = (self.rpos + self.count) % n
+            end = n if w >= self.rpos else self.rpos
+            r = self.uart.readinto(self.ring_mv[w:end])
+            if not r:
+                break
+            self.count += r
+
+    def _read(self, mv):
+        if not self.ring:
+            return self.uart.readinto(mv) or 0
+        if not self.count:
+            self._fill()
+        k = min(len(mv), self.count, len(self.ring) - self.rpos)
+        mv[:k] = self.ring_mv[self.rpos:self.rpos + k]
+        self.rpos = (self.rpos + k) % len(self.ring)
+        self.count -= k
+        return k
+
+    def readinto(self, mv, n, gap_ms=None):
+        """Fill the first n bytes of mv.
+
+        Raise UartTimeout if no byte arrives for gap_ms or the transfer
+        deadline passes.
+        """
+        if gap_ms is None:
+            gap_ms = self.gap_ms
+        got = 0
+        since = utime.ticks_ms()     # Start of the call or the last byte
+        while got < n:
+            wait_ms = gap_ms - utime.ticks_diff(utime.ticks_ms(), since)
+            if self.deadline is not None:
+                wait_ms = min(wait_ms, utime.ticks_diff(self.deadline,
+                                                        utime.ticks_ms()))
+            if not self.wait(wait_ms):
+                if self.expired():
+                    raise UartTimeout("UART transfer deadline after %d bytes"
+                                      % self.bytes)
+                raise UartTimeout("UART silent for %d ms after %d bytes"
+                                  % (gap_ms, self.bytes))
+            r = self._read(mv[got:n])
+            if r:
+                now = utime.ticks_ms()
+                gap = utime.ticks_diff(now, self.last_ms)
+                if gap > self.max_gap_ms:
+                    self.max_gap_ms = gap
+                if gap > self.stall_ms:
+                    self.stalls += 1
+                self.last_ms = now
+                since = now
+                got += r
+                self.bytes += r
+
+    def readline(self, timeout_ms):
+        """Return the next line (or the bytes that arrive before a pause), or
+        None if nothing arrives within timeout_ms.  For the handshake before
+        a transfer; the line is read directly from the UART."""
+        if not self.wait(timeout_ms):
+            return None
+        utime.sleep_ms(20)      # Let the rest of the line arrive
+        return self.uart.readline()
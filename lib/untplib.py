@@ -40,6 +40,16 @@ import socket
 import struct
 import time
 
+try:
+    from utime import ticks_us, ticks_diff
+except ImportError:
+    ticks_us = None
+
+from dnscache import getaddrinfo
+
+# ustruct raises ValueError, and has no struct.error
+_struct_errors = (ValueError, getattr(struct, 'error', ValueError))
+
 
 class NTPException(Exception):
     """Exception raised by this module."""
@@ -54,7 +64,8 @@ class NTP:
     #_NTP_EPOCH = datetime.date(1900, 1, 1)
     """NTP epoch"""
     #NTP_DELTA = (_SYSTEM_EPOCH - _NTP_EPOCH).days * 24 * 3600
-    NTP_DELTA = 3155673600
+    # The WiPy counts from 2000, the Pycom ports from 1970
+    NTP_DELTA = 2208988800 if time.gmtime(0)[0] == 1970 else 3155673600
     """delta between system and NTP time"""
 
     REF_ID_TABLE = {
@@ -123,12 +134,22 @@ class NTP:
 class NTPPacket:
     """NTP packet class.
 
-    This represents an NTP packet.
+    This represents an NTP packet.  Timestamps, root delay and root
+    dispersion are integers in NTP fixed point: seconds << 32 | fraction.
+    The timestamps need 64 bits, so on MicroPython they are long ints, and
+    packing, unpacking and the offset and delay math allocate them.
     """
 
+    __slots__ = ('leap', 'version', 'mode', 'stratum', 'poll', 'precision',
+                 'root_delay', 'root_dispersion', 'ref_id', 'ref_timestamp',
+                 'orig_timestamp', 'recv_timestamp', 'tx_timestamp')
+
     _PACKET_FORMAT = "!BBBbIIIIIIIIIII"
     """packet format to pack/unpack"""
 
+    PACKET_SIZE = 48
+    """size of a packet without extension fields"""
+
     def __init__(self, version=2, mode=3, tx_timestamp=0):
         """Constructor.
 
@@ -173,27 +194,40 @@ class NTPPacket:
         Raises:
         NTPException -- in case of invalid field
         """
+        buf = bytearray(NTPPacket.PACKET_SIZE)
+        self.pack_into(buf)
+        return buf
+
+    def pack_into(self, buf, offset=0):
+        """Write this NTPPacket into buf at offset, instead of a new buffer.
+
+        Parameters:
+        buf    -- writable buffer of at least offset + 48 bytes
+        offset -- position of the packet in buf
+
+        Raises:
+        NTPException -- in case of invalid field
+        """
+        # The _to_int() and _to_frac() shifts, inline
         try:
-            packed = struct.pack(NTPPacket._PACKET_FORMAT,
+            struct.pack_into(NTPPacket._PACKET_FORMAT, buf, offset,
                 (self.leap << 6 | self.version << 3 | self.mode),
                 self.stratum,
                 self.poll,
                 self.precision,
-                _to_int(self.root_delay) << 16 | _to_frac(self.root_delay, 16),
-                _to_int(self.root_dispersion) << 16 |
-                _to_frac(self.root_dispersion, 16),
+                self.root_delay >> 16 & 0xffffffff,
+                self.root_dispersion >> 16 & 0xffffffff,
                 self.ref_id,
-                _to_int(self.ref_timestamp),
-                _to_frac(self.ref_timestamp),
-                _to_int(self.orig_timestamp),
-                _to_frac(self.orig_timestamp),
-                _to_int(self.recv_timestamp),
-                _to_frac(self.recv_timestamp),
-                _to_int(self.tx_timestamp),
-                _to_frac(self.tx_timestamp))
-        except struct.error:
+                self.ref_timestamp >> 32,
+                self.ref_timestamp & 0xffffffff,
+                self.orig_timestamp >> 32,
+                self.orig_timestamp & 0xffffffff,
+                self.recv_timestamp >> 32,
+                self.recv_timestamp & 0xffffffff,
+                self.tx_timestamp >> 32,
+                self.tx_timestamp & 0xffffffff)
+        except _struct_errors:
             raise NTPException("Invalid NTP packet fields.")
-        return packed
 
     def from_data(self, data):
         """Populate this instance from a NTP packet payload received from
@@ -205,10 +239,24 @@ class NTPPacket:
         Raises:
         NTPException -- in case of invalid packet format
         """
+        self.unpack_from(data)
+
+    def unpack_from(self, buf, offset=0):
+        """Populate this instance from the packet in buf at offset, without
+        copying it.
+
+        Parameters:
+        buf    -- buffer holding the packet
+        offset -- position of the packet in buf
+
+        Raises:
+        NTPException -- in case of invalid packet format
+        """
+        if len(buf) < offset + NTPPacket.PACKET_SIZE:
+            raise NTPException("Invalid NTP packet.")
         try:
-            unpacked = struct.unpack(NTPPacket._PACKET_FORMAT,
-                    data[0:struct.calcsize(NTPPacket._PACKET_FORMAT)])
-        except struct.error:
+            unpacked = struct.unpack_from(NTPPacket._PACKET_FORMAT, buf, offset)
+        except _struct_errors:
             raise NTPException("Invalid NTP packet.")
 
         self.leap = unpacked[0] >> 6 & 0x3
@@ -217,22 +265,26 @@ class NTPPacket:
         self.stratum = unpacked[1]
         self.poll = unpacked[2]
         self.precision = unpacked[3]
-        self.root_delay = (unpacked[4])//2**16
-        self.root_dispersion = (unpacked[5])//2**16
+        # The _to_time() shifts, inline
+        self.root_delay = unpacked[4] << 16
+        self.root_dispersion = unpacked[5] << 16
         self.ref_id = unpacked[6]
-        self.ref_timestamp = _to_time(unpacked[7], unpacked[8])
-        self.orig_timestamp = _to_time(unpacked[9], unpacked[10])
-        self.recv_timestamp = _to_time(unpacked[11], unpacked[12])
-        self.tx_timestamp = _to_time(unpacked[13], unpacked[14])
+        self.ref_timestamp = unpacked[7] << 32 | unpacked[8]
+        self.orig_timestamp = unpacked[9] << 32 | unpacked[10]
+        self.recv_timestamp = unpacked[11] << 32 | unpacked[12]
+        self.tx_timestamp = unpacked[13] << 32 | unpacked[14]
 
 
 class NTPStats(NTPPacket):
     """NTP statistics.
 
     Wrapper for NTPPacket, offering additional statistics like offset and
-    delay, and timestamps converted to system time.
+    delay, and timestamps converted to system time.  offset and delay are in
+    NTP fixed point, offset_us and delay_us in microseconds.
     """
 
+    __slots__ = ('dest_timestamp',)
+
     def __init__(self):
         """Constructor."""
         NTPPacket.__init__(self)
@@ -251,6 +303,16 @@ class NTPStats(NTPPacket):
         return ((self.dest_timestamp - self.orig_timestamp) -
                 (self.tx_timestamp - self.recv_timestamp))
 
+    @property
+    def offset_us(self):
+        """offset in microseconds"""
+        return ntp_to_us(self.offset)
+
+    @property
+    def delay_us(self):
+        """round-trip delay in microseconds"""
+        return ntp_to_us(self.delay)
+
     @property
     def tx_time(self):
         """Transmit timestamp in system time."""
@@ -278,11 +340,30 @@ class NTPStats(NTPPacket):
 
 
 class NTPClient:
-    """NTP client session."""
+    """NTP client session.
+
+    The request and the reply go through one 48-byte buffer per client.
+    Local timestamps are taken from the system clock, to the microsecond
+    with utime.ticks_us() on MicroPython.
+    """
 
     def __init__(self):
         """Constructor."""
-        pass
+        self.buf = bytearray(NTPPacket.PACKET_SIZE)
+        """packet buffer"""
+        self._epoch = None
+        """(system time, ticks_us) the local timestamps count from"""
+
+    def local_time(self):
+        """Return the NTP timestamp of the system clock now."""
+        if ticks_us is None:
+            return system_us_to_ntp_time(int(time.time() * 1000000))
+        if self._epoch is None:
+            # The fraction of the second is unknown, but the same for all the
+            # timestamps of the client, so it cancels out of the offset.
+            self._epoch = (time.time(), ticks_us())
+        return system_us_to_ntp_time(self._epoch[0] * 1000000 +
+                                     ticks_diff(ticks_us(), self._epoch[1]))
 
     def request(self, host, version=2, port=123, timeout=5):
         """Query a NTP server.
@@ -297,7 +378,7 @@ class NTPClient:
         NTPStats object
         """
         # lookup server address
-        addrinfo = socket.getaddrinfo(host, port)[0]
+        addrinfo = getaddrinfo(host, port, 0, socket.SOCK_DGRAM)[0]
         family, sockaddr = addrinfo[0], addrinfo[4]
 
         # create the socket
@@ -308,10 +389,11 @@ class NTPClient:
 
             # create the request packet - mode 3 is client
             query_packet = NTPPacket(mode=3, version=version,
-                                tx_timestamp=system_to_ntp_time(time.time()))
+                                tx_timestamp=self.local_time())
 
             # send the request
-            s.sendto(query_packet.to_data(), sockaddr)
+            query_packet.pack_into(self.buf)
+            s.sendto(self.buf, sockaddr)
 
             # wait for the response - check the source address
             src_addr = None,
@@ -319,7 +401,7 @@ class NTPClient:
                 response_packet, src_addr = s.recvfrom(256)
 
             # build the destination timestamp
-            dest_timestamp = system_to_ntp_time(time.time())
+            dest_timestamp = self.local_time()
         except socket.timeout:
             raise NTPException("No response received from %s." % host)
         finally:
@@ -327,7 +409,7 @@ class NTPClient:
 
         # construct corresponding statistics
         stats = NTPStats()
-        stats.from_data(response_packet)
+        stats.unpack_from(response_packet)
         stats.dest_timestamp = dest_timestamp
 
         return stats
@@ -342,8 +424,7 @@ def _to_int(timestamp):
     Retuns:
     integral part
     """
-    return timestamp
-    #return int(timestamp)
+    return timestamp >> 32
 
 
 def _to_frac(timestamp, n=32):
@@ -356,8 +437,7 @@ def _to_frac(timestamp, n=32):
     Retuns:
     fractional part
     """
-    return 0
-    #return int(abs(timestamp - _to_int(timestamp)) * 2**n)
+    return (timestamp & 0xffffffff) >> (32 - n)
 
 
 def _to_time(integ, frac, n=32):
@@ -371,8 +451,7 @@ def _to_time(integ, frac, n=32):
     Retuns:
     timestamp
     """
-    return integ
-    #return integ + float(frac)/2**n
+    return integ << 32 | frac << (32 - n)
 
 
 def ntp_to_system_time(timestamp):
@@ -382,21 +461,58 @@ def ntp_to_system_time(timestamp):
     timestamp -- timestamp in NTP time
 
     Returns:
-    corresponding system time
+    corresponding system time, in whole seconds
     """
-    return timestamp - NTP.NTP_DELTA
+    return (timestamp >> 32) - NTP.NTP_DELTA
 
 
 def system_to_ntp_time(timestamp):
     """Convert a system time to a NTP time.
 
     Parameters:
-    timestamp -- timestamp in system time
+    timestamp -- timestamp in system time, in whole seconds
+
+    Returns:
+    corresponding NTP time
+    """
+    return (timestamp + NTP.NTP_DELTA) << 32
+
+
+def ntp_to_us(timestamp):
+    """Convert a NTP time or time difference to microseconds.
+
+    Parameters:
+    timestamp -- NTP time or difference of NTP times
+
+    Returns:
+    microseconds, rounded down
+    """
+    return (timestamp * 1000000) >> 32
+
+
+def ntp_to_system_us(timestamp):
+    """Convert a NTP time to system time in microseconds.
+
+    Parameters:
+    timestamp -- timestamp in NTP time
+
+    Returns:
+    corresponding system time, in microseconds
+    """
+    return ntp_to_us(timestamp) - NTP.NTP_DELTA * 1000000
+
+
+def system_us_to_ntp_time(us):
+    """Convert a system time in microseconds to a NTP time.
+
+    Parameters:
+    us -- timestamp in system time, in microseconds
 
     Returns:
     corresponding NTP time
     """
-    return timestamp + NTP.NTP_DELTA
+    seconds, us = divmod(us, 1000000)
+    return (seconds + NTP.NTP_DELTA) << 32 | (us << 32) // 1000000
 
 
 def leap_to_text(leap):
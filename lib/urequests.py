@@ -1,26 +1,203 @@
-import usocket
+try:
+    import usocket
+except ImportError:
+    usocket = None          # CPython: only the helpers used by arequests
+
+try:
+    from dnscache import getaddrinfo    # Addresses kept over deep sleep
+except ImportError:
+    getaddrinfo = None
+
+try:
+    import uerrno
+except ImportError:
+    import errno as uerrno
+
+try:
+    from utime import ticks_ms, ticks_add, ticks_diff
+except ImportError:
+    from time import monotonic
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_add(t, delta):
+        return t + delta
+
+    def ticks_diff(t1, t0):
+        return t1 - t0
+
+
+class RequestTimeout(OSError):
+    # args: (phase, message).  The phase is 'dns', 'connect', 'tls', 'send',
+    # 'head' (status line and headers) or 'body'.
+
+    @property
+    def phase(self):
+        return self.args[0]
+
+
+# OSError args[0] of a socket timeout: MicroPython ports raise ETIMEDOUT or
+# EAGAIN, CPython raises socket.timeout("timed out")
+_TIMEOUTS = (uerrno.ETIMEDOUT, uerrno.EAGAIN, "timed out")
+
+
+class _Budget:
+    # The time limits of one request (with its redirects): the connect and read
+    # timeouts of each socket operation in seconds and the deadline of the whole
+
+    def __init__(self, timeout=None, deadline=None):
+        if isinstance(timeout, tuple):
+            self.connect, self.read = timeout
+        else:
+            self.connect = self.read = timeout
+        self.end = None
+        if deadline is not None:
+            self.end = ticks_add(ticks_ms(), int(deadline * 1000))
+
+    def check(self, phase):
+        # Return the seconds left before the deadline (None without one).
+        # Raise RequestTimeout if none are left.
+        if self.end is None:
+            return None
+        left = ticks_diff(self.end, ticks_ms())
+        if left <= 0:
+            raise RequestTimeout(phase, "HTTP deadline passed in " + phase)
+        return left / 1000
+
+    def set(self, s, phase, timeout):
+        # Set the timeout of the socket operations of phase
+        left = self.check(phase)
+        if left is not None and (timeout is None or left < timeout):
+            timeout = left
+        if timeout is not None:
+            s.settimeout(timeout)
+
+    def error(self, e, phase):
+        # Return the exception to raise for the OSError e raised in phase
+        if isinstance(e, RequestTimeout) or not e.args or e.args[0] not in _TIMEOUTS:
+            return e
+        self.check(phase)
+        return RequestTimeout(phase, "HTTP %s timed out" % phase)
+
+
+_no_budget = _Budget()
+
 
 class Response:
 
-    def __init__(self, f):
+    def __init__(self, f, length=None, chunked=False, release=None, budget=_no_budget):
+        # The body is read from f: length bytes, in chunked transfer encoding,
+        # or up to the end of the connection if neither is known.  If given,
+        # release(f) takes back the connection once the body has been read.
         self.raw = f
         self.encoding = "utf-8"
         self._cached = None
+        self._chunked = chunked
+        self._left = 0 if chunked else length
+        self._release = release
+        self._budget = budget
 
     def close(self):
         if self.raw:
-            self.raw.close()
+            if self._release is not None and self._drain():
+                self._release(self.raw)
+            else:
+                self.raw.close()
             self.raw = None
         self._cached = None
 
+    def _drain(self, limit=4096):
+        # Read the rest of a short body so that the connection can be reused.
+        # Return False if the connection has to be closed instead.
+        if self._left is None:
+            return False
+        buf = bytearray(256)
+        try:
+            while limit > 0:
+                n = self.readinto(buf)
+                if not n:
+                    return True
+                limit -= n
+        except (OSError, ValueError):
+            pass
+        return False
+
+    def readinto(self, buf, nbytes=None):
+        """Read up to nbytes (len(buf)) of the body into buf.
+
+        Returns the number of bytes read, 0 at the end of the body.
+        """
+        if self.raw is None:
+            return 0
+        mv = memoryview(buf)
+        if nbytes is None:
+            nbytes = len(mv)
+        self._budget.set(self.raw, "body", self._budget.read)
+        try:
+            return self._readinto(mv, nbytes)
+        except OSError as e:
+            raise self._budget.error(e, "body")
+
+    def _readinto(self, mv, nbytes):
+        if self._chunked and not self._left:
+            size = int(self.raw.readline().split(b";", 1)[0], 16)
+            if not size:
+                while self.raw.readline() not in (b"\r\n", b""):
+                    pass            # Trailer fields
+                self._chunked = False
+            self._left = size
+        if self._left is not None:
+            nbytes = min(nbytes, self._left)
+        if not nbytes:
+            return 0
+        n = self.raw.readinto(mv[:nbytes])
+        if not n:
+            if self._left is not None:
+                raise OSError("Body cut short")
+            return 0
+        if self._left is not None:
+            self._left -= n
+            if self._chunked and not self._left:
+                self.raw.readline()         # CRLF after the chunk
+        return n
+
+    def iter_content(self, chunk_size=1024):
+        """Yield the body in bytes objects of at most chunk_size bytes.
+
+        The body is read through one chunk_size buffer, so a body of any size
+        is read in constant memory.  The connection is closed at the end.
+        """
+        buf = bytearray(chunk_size)
+        try:
+            while True:
+                n = self.readinto(buf)
+                if not n:
+                    return
+                yield bytes(buf[:n])
+        finally:
+            self.close()
+
     @property
     def content(self):
         if self._cached is None:
             try:
-                self._cached = self.raw.read()
+                if self._chunked or self._budget.end is not None:
+                    # In pieces, to check the deadline between them
+                    content = b"".join(self.iter_content())
+                else:
+                    self._budget.set(self.raw, "body", self._budget.read)
+                    try:
+                        if self._left is None:
+                            content = self.raw.read()
+                        else:
+                            content = self.raw.read(self._left)
+                            self._left -= len(content)
+                    except OSError as e:
+                        raise self._budget.error(e, "body")
             finally:
-                self.raw.close()
-                self.raw = None
+                self.close()
+            self._cached = content
         return self._cached
 
     @property
@@ -32,7 +209,86 @@ class Response:
         return ujson.loads(self.content)
 
 
-def request(method, url, data=None, json=None, headers={}, stream=None):
+def _head(method, host, path, headers, data, length, is_json, keep_alive):
+    # Yield the parts (str or bytes) of the request line and headers.  A body
+    # of unknown length (length None) is sent chunked.
+    yield method
+    yield b" /"
+    yield path
+    yield b" HTTP/1.1\r\n"
+    if not "Host" in headers:
+        yield b"Host: "
+        yield host
+        yield b"\r\n"
+    if keep_alive:
+        yield b"Connection: keep-alive\r\n"
+    else:
+        yield b"Connection: close\r\n"
+    # Iterate over keys to avoid tuple alloc
+    for k in headers:
+        yield k
+        yield b": "
+        yield headers[k]
+        yield b"\r\n"
+    if is_json:
+        yield b"Content-Type: application/json\r\n"
+    if data is not None and length is None:
+        yield b"Transfer-Encoding: chunked\r\n"
+    elif data is not None and not "Content-Length" in headers:
+        yield b"Content-Length: %d\r\n" % length
+    yield b"\r\n"
+
+
+def _body(data, length, chunk_size):
+    # Yield the buffers to send for data: a buffer, an iterable of buffers or a
+    # file-like object with readinto() (or read()).  It must be length bytes,
+    # or is framed in chunked transfer encoding if length is None.
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = (data,)
+    elif hasattr(data, "readinto"):
+        data = _read_chunks(data, chunk_size)
+    elif hasattr(data, "read"):
+        data = iter(lambda: data.read(chunk_size), b"")
+    sent = 0
+    for chunk in data:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        n = len(chunk)
+        if not n:
+            continue                # An empty chunk would end the body
+        sent += n
+        if length is None:
+            yield b"%x\r\n" % n
+        elif sent > length:
+            break
+        yield chunk
+        if length is None:
+            yield b"\r\n"
+    if length is None:
+        yield b"0\r\n\r\n"
+    elif sent != length:
+        raise ValueError("Body is not Content-Length %d bytes" % length)
+
+
+def _write_body(s, data, length, chunk_size, budget=_no_budget):
+    # The deadline is checked before every write
+    for part in _body(data, length, chunk_size):
+        budget.set(s, "send", budget.read)
+        s.write(part)
+
+
+def _read_chunks(f, chunk_size):
+    # Yield the content of f through one reused buffer
+    buf = bytearray(chunk_size)
+    mv = memoryview(buf)
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            return
+        yield mv[:n]
+
+
+def _split_url(url):
     try:
         proto, dummy, host, path = url.split("/", 3)
     except ValueError:
@@ -41,7 +297,6 @@ def request(method, url, data=None, json=None, headers={}, stream=None):
     if proto == "http:":
         port = 80
     elif proto == "https:":
-        import ussl
         port = 443
     else:
         raise ValueError("Unsupported protocol: " + proto)
@@ -49,60 +304,294 @@ def request(method, url, data=None, json=None, headers={}, stream=None):
     if ":" in host:
         host, port = host.split(":", 1)
         port = int(port)
+    return proto, host, port, path
+
 
-    ai = usocket.getaddrinfo(host, port, 0, usocket.SOCK_STREAM)
+# TLS sessions by (host, port), to resume instead of a full handshake on the next
+# connection in this wake.  Needs a port with ussl.save_session() (Pycom) or the
+# CPython ssl module.
+_tls_sessions = {}
+
+
+def _wrap_tls(s, host, port):
+    import ussl
+    session = _tls_sessions.get((host, port))
+    if session is None:
+        s = ussl.wrap_socket(s, server_hostname=host)
+    else:
+        s = ussl.wrap_socket(s, server_hostname=host, saved_session=session)
+    save = getattr(ussl, "save_session", None)
+    if save is not None:
+        _tls_sessions[(host, port)] = save(s)
+    return s
+
+
+def _connect(proto, host, port, budget=_no_budget, stats=None):
+    # Fill stats (if given) with the connect and TLS handshake times in ms and
+    # whether the TLS session was resumed (None if the port can not tell).
+    # getaddrinfo() can not be given a timeout: the deadline is only checked
+    # before and after it.  Names are looked up through the DNS cache of
+    # dnscache.py when it is there.
+    budget.check("dns")
+    try:
+        ai = (getaddrinfo or usocket.getaddrinfo)(host, port)
+    except OSError as e:
+        raise budget.error(e, "dns")
     ai = ai[0]
 
     s = usocket.socket(ai[0], ai[1], ai[2])
+    phase = "connect"
     try:
+        budget.set(s, phase, budget.connect)
+        t = ticks_ms()
         s.connect(ai[-1])
+        if stats is not None:
+            stats["connect_ms"] = ticks_diff(ticks_ms(), t)
         if proto == "https:":
-            s = ussl.wrap_socket(s, server_hostname=host)
-        s.write(b"%s /%s HTTP/1.0\r\n" % (method, path))
-        if not "Host" in headers:
-            s.write(b"Host: %s\r\n" % host)
-        # Iterate over keys to avoid tuple alloc
-        for k in headers:
-            s.write(k)
-            s.write(b": ")
-            s.write(headers[k])
-            s.write(b"\r\n")
+            phase = "tls"
+            budget.set(s, phase, budget.connect)
+            t = ticks_ms()
+            s = _wrap_tls(s, host, port)
+            if stats is not None:
+                stats["tls_ms"] = ticks_diff(ticks_ms(), t)
+                stats["tls_resumed"] = getattr(s, "session_reused", None)
+    except OSError as e:
+        s.close()
+        raise budget.error(e, phase)
+    return s
+
+
+class _Head:
+    # The status line and headers of a response, fed a line at a time: the
+    # status, the reason, the body length (None if unknown), whether the body
+    # is chunked, the Location of a redirect and whether the connection can
+    # be reused
+
+    def __init__(self, method):
+        self.method = method
+        self.status = None
+        self.length = None
+        self.chunked = False
+        self.location = None
+
+    def feed(self, l):
+        # Return False once the head is complete
+        #print(l)
+        if self.status is None:
+            if not l:
+                raise OSError("Connection closed")
+            l = l.split(None, 2)
+            self.keep = l[0] != b"HTTP/1.0"
+            self.status = int(l[1])
+            self.reason = ""
+            if len(l) > 2:
+                self.reason = l[2].rstrip()
+            return True
+        if not l or l == b"\r\n":
+            if self.method == "HEAD" or self.status < 200 or self.status in (204, 304):
+                self.length = 0
+                self.chunked = False
+            return False
+        h = l.lower()
+        if h.startswith(b"transfer-encoding:"):
+            self.chunked = b"chunked" in h
+        elif h.startswith(b"content-length:"):
+            self.length = int(l[15:])
+        elif h.startswith(b"connection:"):
+            self.keep = b"keep-alive" in h
+        elif h.startswith(b"location:") and self.status in (301, 302, 303, 307, 308):
+            self.location = l[9:].strip().decode()
+        return True
+
+
+def _follow(status, method, url, location, data, headers):
+    # Return the method, URL, body and headers of the request that follows a
+    # redirect to location
+    if location.startswith("/"):
+        url = "/".join(url.split("/", 3)[:3]) + location
+    else:
+        url = location
+    if status == 303 or status < 303 and method == "POST":
+        # Follow with a GET without the body
+        if method != "HEAD":
+            method = "GET"
+        data = None
+        if "Content-Length" in headers:
+            headers = dict(headers)
+            del headers["Content-Length"]
+    elif data is not None and not isinstance(data, (bytes, bytearray, memoryview)):
+        raise ValueError("Can't send a streamed body again to " + url)
+    return method, url, data, headers
+
+
+class Session:
+    """HTTP/1.1 client that keeps one connection open per host and port.
+
+    A connection goes back to the session when the response is closed (by
+    content, iter_content or close()) with its body read to the end, and the
+    next request to the same host and port is sent on it.  A connection
+    that the server has closed meanwhile is replaced once, if the body can be
+    sent again.  The request line and headers (and a body that fits) are built
+    in one buffer and sent in a single write.  A new HTTPS connection resumes
+    the TLS session of the last one to the same host and port where the port
+    supports it.  Response.stats has the connect and TLS handshake times of
+    the request's connection; the session totals the handshakes.  With keep_alive False every
+    request asks the server to close the connection, as request() does.
+    """
+
+    def __init__(self, keep_alive=True, buffer_size=512):
+        self.keep_alive = keep_alive
+        self.idle = {}              # (proto, host, port): idle connection
+        self.buf = bytearray(buffer_size)
+        self.mv = memoryview(self.buf)
+        self.connects = 0
+        self.requests = 0
+        self.tls_handshakes = 0
+        self.tls_resumed = 0
+        self.tls_ms = 0             # Time spent in TLS handshakes
+
+    def close(self):
+        for s in self.idle.values():
+            s.close()
+        self.idle = {}
+
+    def request(self, method, url, data=None, json=None, headers={}, stream=None,
+                chunk_size=1024, max_redirects=2, timeout=None, deadline=None):
         if json is not None:
             assert data is None
             import ujson
             data = ujson.dumps(json)
-            s.write(b"Content-Type: application/json\r\n")
-        if data:
-            s.write(b"Content-Length: %d\r\n" % len(data))
-        s.write(b"\r\n")
-        if data:
-            s.write(data)
-
-        l = s.readline()
-        #print(l)
-        l = l.split(None, 2)
-        status = int(l[1])
-        reason = ""
-        if len(l) > 2:
-            reason = l[2].rstrip()
+        if isinstance(data, str):
+            data = data.encode()
+        # timeout: seconds, or (connect, read) seconds, of each socket operation.
+        # deadline: seconds for the whole request, redirects and reading the
+        # response included.  RequestTimeout is raised when either runs out.
+        budget = _no_budget
+        if timeout is not None or deadline is not None:
+            budget = _Budget(timeout, deadline)
+        # Follow up to max_redirects redirects; with 0 the redirect is returned
+        for i in range(max_redirects + 1):
+            resp, location = self._request(method, url, data,
+                                           json is not None and data is not None,
+                                           headers, chunk_size, budget)
+            if location is None or not max_redirects:
+                return resp
+            resp.close()
+            method, url, data, headers = _follow(resp.status_code, method, url,
+                                                 location, data, headers)
+        raise ValueError("Too many redirects")
+
+    def _request(self, method, url, data, is_json, headers, chunk_size, budget):
+        # Send one request.  Return the response and the Location it redirects
+        # to (None if it is not a redirect).
+        proto, host, port, path = _split_url(url)
+        key = (proto, host, port)
+        # A body of unknown length (iterable or file without a Content-Length
+        # header) is sent chunked
+        length = None
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            length = len(data)
+        elif "Content-Length" in headers:
+            length = int(headers["Content-Length"])
+        replay = data is None or isinstance(data, (bytes, bytearray, memoryview))
+
+        s = self.idle.pop(key, None)
         while True:
-            l = s.readline()
-            if not l or l == b"\r\n":
+            reused = s is not None
+            stats = {"reused": reused, "connect_ms": 0, "tls_ms": 0, "tls_resumed": None}
+            if not reused:
+                s = _connect(proto, host, port, budget, stats)
+                self.connects += 1
+                if proto == "https:":
+                    self.tls_handshakes += 1
+                    self.tls_resumed += stats["tls_resumed"] is True
+                    self.tls_ms += stats["tls_ms"]
+            phase = "send"
+            try:
+                self._send(s, method, host, path, headers, data, length, is_json,
+                           chunk_size, budget)
+                phase = "head"
+                budget.set(s, phase, budget.read)
+                head = _Head(method)
+                while head.feed(s.readline()):
+                    pass
                 break
-            #print(l)
-            if l.startswith(b"Transfer-Encoding:"):
-                if b"chunked" in l:
-                    raise ValueError("Unsupported " + l)
-            elif l.startswith(b"Location:") and not 200 <= status <= 299:
-                raise NotImplementedError("Redirects not yet supported")
-    except OSError:
-        s.close()
-        raise
+            except OSError as e:
+                s.close()
+                e = budget.error(e, phase)
+                if not (reused and replay) or isinstance(e, RequestTimeout):
+                    raise e
+                s = None            # Closed by the server while idle
+            except ValueError:
+                s.close()
+                raise
+        self.requests += 1
+
+        release = None
+        if self.keep_alive and head.keep and (head.chunked or head.length is not None):
+            release = lambda f: self._release(key, f)
+        resp = Response(s, head.length, head.chunked, release, budget)
+        resp.status_code = head.status
+        resp.reason = head.reason
+        resp.stats = stats
+        return resp, head.location
+
+    def _release(self, key, s):
+        if key in self.idle:
+            s.close()
+        else:
+            s.settimeout(None)      # Until the next request sets its own
+            self.idle[key] = s
+
+    def _put(self, pos, p):
+        # Copy p (bytes or str) into the buffer at pos, growing it if needed.
+        # Return the position after it.
+        if isinstance(p, str):
+            p = p.encode()
+        end = pos + len(p)
+        if end > len(self.buf):
+            self.buf = self.buf[:pos] + bytearray(end + len(self.buf) - pos)
+            self.mv = memoryview(self.buf)
+        self.mv[pos:end] = p
+        return end
+
+    def _send(self, s, method, host, path, headers, data, length, is_json,
+              chunk_size, budget):
+        pos = 0
+        for part in _head(method, host, path, headers, data, length, is_json,
+                          self.keep_alive):
+            pos = self._put(pos, part)
+        if (data is not None and isinstance(data, (bytes, bytearray, memoryview))
+                and pos + length <= len(self.buf)):
+            pos = self._put(pos, data)
+            data = None
+        budget.set(s, "send", budget.read)
+        s.write(self.mv[:pos])
+        if data is not None:
+            _write_body(s, data, length, chunk_size, budget)
+
+    def head(self, url, **kw):
+        return self.request("HEAD", url, **kw)
+
+    def get(self, url, **kw):
+        return self.request("GET", url, **kw)
+
+    def post(self, url, **kw):
+        return self.request("POST", url, **kw)
+
+    def put(self, url, **kw):
+        return self.request("PUT", url, **kw)
+
+    def patch(self, url, **kw):
+        return self.request("PATCH", url, **kw)
+
+    def delete(self, url, **kw):
+        return self.request("DELETE", url, **kw)
+
 
-    resp = Response(s)
-    resp.status_code = status
-    resp.reason = reason
-    return resp
+def request(method, url, **kw):
+    # One request on its own connection, closed after the response
+    return Session(False, 256).request(method, url, **kw)
 
 
 def head(url, **kw):
@@ -121,4 +610,4 @@ def patch(url, **kw):
     return request("PATCH", url, **kw)
 
 def delete(url, **kw):
-    return request("DELETE", url, **kw)
\ No newline at end of file
+    return request("DELETE", url, **kw)
@@ -12,12 +12,25 @@ def datetime_tuple(year=None, month=None, day=None, weekday=None, hour=None,
                          second, millisecond)
 
 
+# BCD conversions by table lookup (bytes above 0x99 are not BCD)
+_BCD2BIN = bytes(v - 6 * (v >> 4) for v in range(256))
+_BIN2BCD = bytes(v + 6 * (v // 10) for v in range(100))
+
+
 def _bcd2bin(value):
-    return (value or 0) - 6 * ((value or 0) >> 4)
+    return _BCD2BIN[value or 0]
 
 
 def _bin2bcd(value):
-    return (value or 0) + 6 * ((value or 0) // 10)
+    return _BIN2BCD[value or 0]
+
+
+# Days in the year before the first of each month (not a leap year)
+_DAYS_BEFORE_MONTH = (0, 0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334)
+
+# Seconds of 2000-01-01 00:00:00 in the epoch of utime (1970 or 2000): add it
+#   to epoch() for the time of utime.mktime()
+EPOCH_2000 = utime.mktime((2000, 1, 1, 0, 0, 0, 0, 0))
 
 
 def tuple2seconds(datetime):
@@ -37,11 +50,26 @@ class _BaseRTC:
     def __init__(self, i2c, address=0x68):
         self.i2c = i2c
         self.address = address
+        self.transactions = 0       # I2C transactions so far
+        self._buffer = bytearray(7)     # The date and time registers
+        self._second = bytearray(1)     # The seconds register, for tick()
+
+    def _read(self, register, n):
+        self.transactions += 1
+        return self.i2c.readfrom_mem(self.address, register, n)
+
+    def _read_into(self, register, buffer):
+        self.transactions += 1
+        self.i2c.readfrom_mem_into(self.address, register, buffer)
+
+    def _write(self, register, buffer):
+        self.transactions += 1
+        self.i2c.writeto_mem(self.address, register, buffer)
 
     def _register(self, register, buffer=None):
         if buffer is None:
-            return self.i2c.readfrom_mem(self.address, register, 1)[0]
-        self.i2c.writeto_mem(self.address, register, buffer)
+            return self._read(register, 1)[0]
+        self._write(register, buffer)
 
     def _flag(self, register, mask, value=None):
         data = self._register(register)
@@ -56,8 +84,8 @@ class _BaseRTC:
 
     def datetime(self, datetime=None):
         if datetime is None:
-            buffer = self.i2c.readfrom_mem(self.address,
-                                           self._DATETIME_REGISTER, 7)
+            buffer = self._buffer
+            self._read_into(self._DATETIME_REGISTER, buffer)
             if self._SWAP_DAY_WEEKDAY:
                 day = buffer[3]
                 weekday = buffer[4]
@@ -65,13 +93,13 @@ class _BaseRTC:
                 day = buffer[4]
                 weekday = buffer[3]
             return datetime_tuple(
-                year=_bcd2bin(buffer[6]) + 2000,
-                month=_bcd2bin(buffer[5]),
-                day=_bcd2bin(day),
-                weekday=_bcd2bin(weekday),
-                hour=_bcd2bin(buffer[2]),
-                minute=_bcd2bin(buffer[1]),
-                second=_bcd2bin(buffer[0]),
+                year=_BCD2BIN[buffer[6]] + 2000,
+                month=_BCD2BIN[buffer[5]],
+                day=_BCD2BIN[day],
+                weekday=_BCD2BIN[weekday],
+                hour=_BCD2BIN[buffer[2]],
+                minute=_BCD2BIN[buffer[1]],
+                second=_BCD2BIN[buffer[0]],
             )
         datetime = datetime_tuple(*datetime)
 
@@ -92,6 +120,90 @@ class _BaseRTC:
         buffer[6] = _bin2bcd(datetime.year - 2000)
         self._register(self._DATETIME_REGISTER, buffer)
 
+    # Reads of the time that allocate nothing: the registers are read into a
+    # buffer of the instance and decoded without building a DateTimeTuple.
+
+    def datetime_into(self, buf):
+        """Fill buf (a list or array of 8 or more) with the fields of datetime().
+
+        Year, month, day, weekday, hour, minute, second and 0 for the
+        milliseconds, as in a DateTimeTuple.  Returns buf.
+        """
+        buffer = self._buffer
+        self._read_into(self._DATETIME_REGISTER, buffer)
+        if self._SWAP_DAY_WEEKDAY:
+            buf[2] = _BCD2BIN[buffer[3] & 0x3f]
+            buf[3] = _BCD2BIN[buffer[4] & 0x07]
+        else:
+            buf[2] = _BCD2BIN[buffer[4] & 0x3f]
+            buf[3] = _BCD2BIN[buffer[3] & 0x07]
+        buf[0] = _BCD2BIN[buffer[6]] + 2000
+        buf[1] = _BCD2BIN[buffer[5] & 0x1f]
+        buf[4] = _BCD2BIN[buffer[2] & 0x3f]
+        buf[5] = _BCD2BIN[buffer[1] & 0x7f]
+        buf[6] = _BCD2BIN[buffer[0] & 0x7f]
+        buf[7] = 0
+        return buf
+
+    def epoch(self):
+        """Return the time in seconds since 2000-01-01 00:00:00.
+
+        Good from 2000 to 2099, the years of the clock.  Until 2034 the value
+        fits a MicroPython small int (2**30) and allocates nothing; seconds
+        since 1970 would not.  Add EPOCH_2000 for the time of utime.mktime().
+        """
+        buffer = self._buffer
+        self._read_into(self._DATETIME_REGISTER, buffer)
+        day = buffer[3] if self._SWAP_DAY_WEEKDAY else buffer[4]
+        year = _BCD2BIN[buffer[6]]
+        month = _BCD2BIN[buffer[5] & 0x1f]
+        days = (year * 365 + (year + 3) // 4 + _DAYS_BEFORE_MONTH[month]
+                + _BCD2BIN[day & 0x3f] - 1)
+        if month > 2 and not year & 3:
+            days += 1               # Past February 29
+        return (days * 86400 + _BCD2BIN[buffer[2] & 0x3f] * 3600
+                + _BCD2BIN[buffer[1] & 0x7f] * 60 + _BCD2BIN[buffer[0] & 0x7f])
+
+    def tick(self, timeout_ms=1100):
+        """Wait for the seconds of the clock to tick over and return epoch() then.
+
+        Polls the seconds register alone every 2 ms.  Returns None if the
+        seconds do not change within timeout_ms (the oscillator is stopped).
+        """
+        buffer = self._second
+        self._read_into(self._DATETIME_REGISTER, buffer)
+        second = buffer[0]
+        start = utime.ticks_ms()
+        while utime.ticks_diff(utime.ticks_ms(), start) < timeout_ms:
+            utime.sleep_ms(2)
+            self._read_into(self._DATETIME_REGISTER, buffer)
+            if buffer[0] != second:
+                return self.epoch()
+        return None
+
+    def sync_rtc(self, rtc, correction_ms=None, align=False):
+        """Set rtc (machine.RTC) to the time of the clock.
+
+        rtc is up to a second behind the clock, which is only read to the
+        second.  With align, rtc is set when the seconds of the clock tick
+        over (tick(): up to a second of I2C polling), or to the time read if
+        they do not tick.  correction_ms(t), if
+        given, is the error of the clock in ms at its time t in seconds since
+        the epoch of utime, taken off the time set.  Returns the time of the
+        clock (epoch()) before the correction.
+        """
+        seconds = self.tick() if align else None
+        if seconds is None:
+            seconds = self.epoch()
+        ms = 0
+        if correction_ms is not None:
+            ms = correction_ms(seconds + EPOCH_2000)
+        # Whole seconds and ms apart: the time in ms does not fit a small int
+        back, ms = divmod(-ms, 1000)
+        t = utime.gmtime(seconds + EPOCH_2000 + back)
+        rtc.init((t[0], t[1], t[2], t[3], t[4], t[5], ms * 1000))
+        return seconds
+
 
 class DS1307(_BaseRTC):
     _NVRAM_REGISTER = 0x08
@@ -113,6 +225,15 @@ class DS3231(_BaseRTC):
     _DATETIME_REGISTER = 0x00
     _ALARM_REGISTERS = (0x08, 0x0b)
     _SQUARE_WAVE_REGISTER = 0x0e
+    _AGING_REGISTER = 0x10
+    _TEMPERATURE_REGISTER = 0x11
+    _REGISTERS = 0x13
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._shadow = bytearray(self._REGISTERS)
+        self._loaded = False
+        self._dirty = 0             # Bit n set: register n changed in the shadow
 
     def lost_power(self):
         return self._flag(self._STATUS_REGISTER, 0b10000000)
@@ -138,6 +259,24 @@ class DS3231(_BaseRTC):
     def stop(self, value=None):
         return self._flag(self._CONTROL_REGISTER, 0b10000000, value)
 
+    def aging_offset(self, value=None):
+        # Signed trim of the oscillator, about -0.1 ppm per LSB at 25 C.  A new
+        # value takes effect at the temperature conversion started here.
+        if value is None:
+            data = self._register(self._AGING_REGISTER)
+            return data - 256 if data & 0x80 else data
+        if not -128 <= value <= 127:
+            raise ValueError("aging offset out of range")
+        self._register(self._AGING_REGISTER, bytearray((value & 0xff,)))
+        self._flag(self._CONTROL_REGISTER, 0b00100000, 1)    # CONV
+
+    def get_temperature(self):
+        buffer = self._read(self._TEMPERATURE_REGISTER, 2)
+        data = buffer[0] << 2 | buffer[1] >> 6
+        if data & 0x200:
+            data -= 0x400
+        return data * 0.25
+
     def datetime(self, datetime=None):
         if datetime is not None:
             status = self._register(self._STATUS_REGISTER) & 0b01111111
@@ -145,28 +284,30 @@ class DS3231(_BaseRTC):
         return super().datetime(datetime)
 
     def alarm_time(self, datetime=None, alarm=0):
+        # Alarm 1 has a seconds register before the minutes, hours and day
+        register = self._ALARM_REGISTERS[alarm]
+        if alarm == 0:
+            register -= 1
         if datetime is None:
-            buffer = self.i2c.readfrom_mem(self.address,
-                                           self._ALARM_REGISTERS[alarm], 3)
+            buffer = self._read(register, 4 if alarm == 0 else 3)
+            second = None
+            if alarm == 0:
+                # handle seconds
+                second = (_BCD2BIN[buffer[0] & 0x7f]
+                          if not buffer[0] & 0x80 else None)
+                buffer = buffer[1:]
             day = None
             weekday = None
-            second = None
             if buffer[2] & 0b10000000:
                 pass
             elif buffer[2] & 0b01000000:
-                day = _bcd2bin(buffer[2] & 0x3f)
+                day = _BCD2BIN[buffer[2] & 0x3f]
             else:
-                weekday = _bcd2bin(buffer[2] & 0x3f)
-            minute = (_bcd2bin(buffer[0] & 0x7f)
+                weekday = _BCD2BIN[buffer[2] & 0x3f]
+            minute = (_BCD2BIN[buffer[0] & 0x7f]
                       if not buffer[0] & 0x80 else None)
-            hour = (_bcd2bin(buffer[1] & 0x7f)
+            hour = (_BCD2BIN[buffer[1] & 0x7f]
                     if not buffer[1] & 0x80 else None)
-            if alarm == 0:
-                # handle seconds
-                buffer = self.i2c.readfrom_mem(
-                    self.address, self._ALARM_REGISTERS[alarm] - 1, 1)
-                second = (_bcd2bin(buffer[0] & 0x7f)
-                          if not buffer[0] & 0x80 else None)
             return datetime_tuple(
                 day=day,
                 weekday=weekday,
@@ -175,26 +316,77 @@ class DS3231(_BaseRTC):
                 second=second,
             )
         datetime = datetime_tuple(*datetime)
-        buffer = bytearray(3)
-        buffer[0] = (_bin2bcd(datetime.minute)
+        buffer = bytearray(4 if alarm == 0 else 3)
+        i = 0
+        if alarm == 0:
+            # handle seconds
+            buffer[0] = (_BIN2BCD[datetime.second]
+                         if datetime.second is not None else 0x80)
+            i = 1
+        buffer[i] = (_BIN2BCD[datetime.minute]
                      if datetime.minute is not None else 0x80)
-        buffer[1] = (_bin2bcd(datetime.hour)
-                     if datetime.hour is not None else 0x80)
+        buffer[i + 1] = (_BIN2BCD[datetime.hour]
+                         if datetime.hour is not None else 0x80)
         if datetime.day is not None:
             if datetime.weekday is not None:
                 raise ValueError("can't specify both day and weekday")
-            buffer[2] = _bin2bcd(datetime.day)
+            buffer[i + 2] = _BIN2BCD[datetime.day]
         elif datetime.weekday is not None:
-            buffer[2] = _bin2bcd(datetime.weekday) | 0b01000000
+            buffer[i + 2] = _BIN2BCD[datetime.weekday] | 0b01000000
         else:
-            buffer[2] = 0x80
-        self._register(self._ALARM_REGISTERS[alarm], buffer)
+            buffer[i + 2] = 0x80
+        self._register(register, buffer)
+
+    # Register shadow: load() reads the registers in one transaction, then the
+    # methods work on the copy in memory until flush() writes back the changed
+    # ones, one transaction per run of adjacent registers.
+
+    def load(self):
+        """Read all the registers (0x00 to 0x12) into the shadow.
+
+        Until flush(), reads come from the shadow (the time is that of the
+        load) and writes change it.
+        """
+        self.transactions += 1
+        self.i2c.readfrom_mem_into(self.address, 0, self._shadow)
+        self._dirty = 0
+        self._loaded = True
+
+    def flush(self):
+        """Write the registers changed since load() and leave the shadow."""
+        self._loaded = False
+        dirty = self._dirty
+        register = 0
+        while dirty:
+            if dirty & 1:
+                end = register
+                while dirty & 1:
+                    dirty >>= 1
+                    end += 1
+                self._write(register, memoryview(self._shadow)[register:end])
+                register = end
+            else:
+                dirty >>= 1
+                register += 1
+        self._dirty = 0
 
-        if alarm == 0:
-            # handle seconds
-            buffer = bytearray([_bin2bcd(datetime.second)
-                                if datetime.second is not None else 0x80])
-            self._register(self._ALARM_REGISTERS[alarm] - 1, buffer)
+    def _read(self, register, n):
+        if self._loaded:
+            return memoryview(self._shadow)[register:register + n]
+        return super()._read(register, n)
+
+    def _read_into(self, register, buffer):
+        if self._loaded:
+            buffer[:] = memoryview(self._shadow)[register:register + len(buffer)]
+            return
+        super()._read_into(register, buffer)
+
+    def _write(self, register, buffer):
+        if self._loaded:
+            self._shadow[register:register + len(buffer)] = buffer
+            self._dirty |= ((1 << len(buffer)) - 1) << register
+            return
+        super()._write(register, buffer)
 
 
 class PCF8523(_BaseRTC):
@@ -237,8 +429,7 @@ class PCF8523(_BaseRTC):
 
     def alarm_time(self, datetime=None):
         if datetime is None:
-            buffer = self.i2c.readfrom_mem(self.address,
-                                           self._ALARM_REGISTER, 4)
+            buffer = self._read(self._ALARM_REGISTER, 4)
             return datetime_tuple(
                 weekday=_bcd2bin(buffer[3] &
                                  0x7f) if not buffer[3] & 0x80 else None,
@@ -0,0 +1,81 @@
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+import utime
+
+
+class StageSkipped(Exception):
+    pass
+
+
+class WakeCycle:
+    """Run the stages of a wake cycle concurrently.
+
+    Each stage is a coroutine function that starts as soon as the stages named
+    in its after and wait lists have finished.  A stage that raises an
+    exception fails; the stages that have it in their after list are skipped,
+    those that only wait for it still run.  Stages share the event loop, so
+    a stage waiting on the radio or the camera must await (asyncio.sleep) to
+    let the other stages run.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.results = {}
+        self.errors = {}
+        self.times = {}
+
+    def stage(self, name, func, after=(), wait=()):
+        self.stages.append((name, func, after, wait))
+
+    def ok(self, name):
+        return name in self.results
+
+    def result(self, name, default=None):
+        return self.results.get(name, default)
+
+    async def _run(self, name, func, after, wait, done):
+        for dep in tuple(after) + tuple(wait):
+            await done[dep].wait()
+        start = utime.ticks_ms()
+        try:
+            for dep in after:
+                if dep not in self.results:
+                    raise StageSkipped(dep)
+            self.results[name] = await func()
+        except StageSkipped as e:
+            self.errors[name] = e
+            print("Stage %s skipped, %s failed" % (name, e))
+        except Exception as e:
+            self.errors[name] = e
+            print("Stage %s failed:" % name, e)
+        self.times[name] = (start, utime.ticks_ms())
+        done[name].set()
+
+    async def _main(self):
+        done = {}
+        for stage in self.stages:
+            done[stage[0]] = asyncio.Event()
+        tasks = [asyncio.create_task(self._run(*stage, done=done))
+                 for stage in self.stages]
+        for task in tasks:
+            await task
+
+    def run(self):
+        """Run all stages to the end.  Return True if none failed."""
+        self.start_ms = utime.ticks_ms()
+        asyncio.run(self._main())
+        self.end_ms = utime.ticks_ms()
+        return not self.errors
+
+    def report(self):
+        print("Wake cycle: %d ms" % utime.ticks_diff(self.end_ms, self.start_ms))
+        for stage in self.stages:
+            name = stage[0]
+            if name in self.times:
+                start, end = self.times[name]
+                print("  %-10s at %6d ms, %6d ms%s" % (
+                    name, utime.ticks_diff(start, self.start_ms),
+                    utime.ticks_diff(end, start),
+                    "" if name in self.results else " (failed)"))
@@ -0,0 +1,45 @@
+try:
+    import pycom
+except ImportError:
+    pycom = None
+
+
+class WakeState:
+    """Small integers kept over deep sleep and resets in the pycom NVS.
+
+    A deep sleep restarts main.py with an empty heap, so what one wake learns
+    (next alarm, last clock sync, server address, counters) is kept here for
+    the next one.  Values are unsigned 32-bit.  Keys are at most 15 characters
+    including the prefix.  A value is only written when it changes, to spare
+    the flash.  Without pycom (CPython) the values are kept in memory.
+    """
+
+    def __init__(self, prefix='w_'):
+        self.prefix = prefix
+        self.values = {}
+
+    def get(self, key, default=0):
+        if key in self.values:
+            return self.values[key]
+        value = default
+        if pycom is not None:
+            try:
+                value = pycom.nvs_get(self.prefix + key)
+            except (ValueError, KeyError):
+                pass            # Not set yet
+            if value is None:
+                value = default
+        self.values[key] = value
+        return value
+
+    def set(self, key, value):
+        value = int(value) & 0xffffffff
+        if self.get(key, None) == value:
+            return
+        self.values[key] = value
+        if pycom is not None:
+            pycom.nvs_set(self.prefix + key, value)
+
+    def add(self, key, n=1):
+        self.set(key, self.get(key) + n)
+        return self.values[key]
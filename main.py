@@ -6,13 +6,31 @@ from machine import UART        # Receiving pictures from the ESP32-CAM
 from machine import ADC         # Battery voltage measurement
 from network import WLAN        # Connecting with the WiFi; Will not be needed when connecting with LTE
 from network import LTE         # Connect to network using LTE
-import base64                   # For encoding the picture
+import base64                   # Incremental Base64 encoding of the picture
 import urequests as requests    # Used for http transfer with the server
 import utime                    # Time delays
 import usocket as socket
-#from socket import AF_INET, SOCK_DGRAM
-import ustruct
 from urtc import DS3231         # DS3231 real time clock
+from urtc import EPOCH_2000     # Seconds of 2000-01-01 in the epoch of utime
+from resumable import ResumableUpload  # Resumable chunked picture upload
+from outbox import Outbox       # Pictures kept on the flash until the server has them
+from outbox import stamp_digits as outbox_stamp_digits
+from camlink import CameraLink  # Baud rate negotiation and CRC framed picture transfer
+from camlink import CameraLinkError
+from uartrx import UartReceiver, UartTimeout  # Bounded UART receive
+from outbox import Spool        # Picture received into the outbox while it is uploaded
+from trace import Trace         # Wake cycle phase timings kept on the flash
+from wakestate import WakeState # Next alarm, clock sync and counters kept over deep sleep
+import dnscache                 # Server addresses kept over deep sleep
+from timesync import TimeSync   # DS3231 clock sync from the best of several NTP servers
+from discipline import ClockDiscipline  # DS3231 drift learnt from the NTP syncs
+import uerrno
+import uselect
+try:
+    import uasyncio as asyncio  # Overlapped wake cycle (see run_wake_pipeline)
+    from wakecycle import WakeCycle
+except ImportError:
+    asyncio = None
 
 pycom.heartbeat(False)
 
@@ -36,8 +54,32 @@ ds3231 = DS3231(i2c)
 
 # Define uart for UART1.  This is the UART that
 #    receives data from the ESP32-CAM
-#    For now, the ESP32-CAM transmits to the GPy at 38400 bps.  This can probably be increased.
-uart = UART(1, baudrate=38400)
+#    The ESP32-CAM starts at 38400 bps.  After the Hello/ready handshake the link is
+#    stepped up to the fastest of camera_baudrates that works (see CameraLink)
+#    The receive buffer is enlarged so that picture bytes are not lost while a
+#    streamed upload chunk is being sent to the server.
+uart = UART(1, baudrate=38400, rx_buffer_size=4096)
+
+# Negotiate a higher baud rate and CRC framed blocks with the ESP32-CAM.  Only for a
+#   camera whose firmware knows the BAUD request: the firmware before it takes any
+#   message after 'ready' as the picture filename, so it would take a picture named
+#   'BAUD 921600'.  Leave this off until the camera firmware is updated.
+camera_negotiate = False
+camera_baudrates = (921600, 460800, 230400, 115200)
+
+# UART receive limits.  A camera that does not answer within camera_ready_ms, is silent
+#   for camera_gap_ms during a transfer or does not finish the picture within
+#   camera_transfer_ms ends the picture transfer instead of keeping the GPy awake until
+#   the next DS3231 alarm.
+camera_ready_ms = 30000
+camera_gap_ms = 2000
+camera_transfer_ms = 180000
+
+# Size of the UART receive ring buffer.  0 reads directly into the picture buffers.
+camera_ring_size = 0
+
+rx = UartReceiver(uart, ring_size=camera_ring_size, gap_ms=camera_gap_ms)
+camera = CameraLink(uart, rx, baudrate=38400, rx_buffer_size=4096)
 
 # Real time clock object
 rtc = RTC()
@@ -52,6 +94,143 @@ headers = {
     'Content-Type': 'application/json',
 }
 
+# Server that receives the pictures (Host on Digital Ocean)
+upload_host = "water.roeber.dev"
+upload_port = 80
+upload_path = "/file/base64"
+upload_binary_path = "/file/binary"
+upload_resumable_path = "/file/resumable"
+
+# NTP servers for the DS3231 clock sync.  They are asked at once, and the sync gives up
+#   after ntp_budget_ms.
+ntp_hosts = ('0.pool.ntp.org', '1.pool.ntp.org', '2.pool.ntp.org')
+ntp_budget_ms = 3000
+
+# DS3231 clock discipline
+#   At each NTP sync the error of the DS3231 is kept in clock_history_file, and its drift is
+#   learnt from the errors.  Between syncs the GPy clock is set from the DS3231 corrected
+#   for the drift.  The next sync is due when the corrected time may be clock_tolerance_ms
+#   off.  The DS3231 itself is set when it is more than clock_step_ms off.
+clock_history_file = '/flash/clock.log'
+clock_tolerance_ms = 1000
+clock_step_ms = 500
+
+# DNS cache
+#   The addresses of the servers are kept in NVS for dns_ttl seconds, so most wakes do not
+#   look them up over the radio.  If a lookup fails, the last address is used.  The NTP
+#   pool names point to other servers every few minutes, so they are not served from the
+#   cache (dns_ttls): they are looked up at each sync, and their last address is only
+#   used when the lookup fails.  The refresh is a prefetch after the upload, not a
+#   pipeline task: the names of dns_hosts whose address is past half its ttl are looked
+#   up again while the link is still up.
+dns_ttl = 86400
+dns_ttls = {host: 0 for host in ntp_hosts}
+dns_hosts = (upload_host, 'gaepd.janusresearch.com')
+
+# Picture upload mode
+#   'resumable'- Send the JPEG bytes in PATCH requests of resumable_chunk_size bytes to
+#                upload_resumable_path/<upload id>, where the upload id is the station id
+#                and time stamp.  The picture is always written to the outbox.  If the
+#                connection drops, reconnect, ask the server which offset it holds and
+#                send only the missing chunks.  A picture that could not be completed is
+#                resumed on the next wake.
+#   'binary'   - Send the JPEG bytes as they are received from the UART in an
+#                application/octet-stream POST to upload_binary_path.  The station id,
+#                voltage and time stamp are sent in X-Station-Id, X-Voltage and
+#                X-Timestamp headers.  No Base64 overhead (33% less data on the air).
+#   'stream'   - Base64 encode the picture as it is received from the UART and send
+#                it to the server chunk by chunk in the JSON document expected by
+#                upload_path.  Peak memory is a few KB regardless of the picture size
+#                and the upload overlaps the UART transfer.
+#   'buffered' - Receive the whole picture, then encode it chunk by chunk and send it to
+#                upload_path.  Needs the picture size in RAM.
+#   Use 'stream' or 'buffered' for servers that only accept the JSON/Base64 upload.
+upload_mode = 'binary'
+
+# Number of picture bytes sent per chunk.  The Base64 encoder carries the bytes of an
+#   incomplete 3-byte group over to the next chunk, so any size works.
+upload_chunk_size = 3 * 512
+
+# Chunk size and number of reconnects in a wake for the 'resumable' mode.  The chunk
+#   size must not change while pictures are pending.
+resumable_chunk_size = 8192
+resumable_retries = 3
+
+# Outbox on the flash for pictures the server has not received
+#   The picture is written to the outbox while it is received and removed once the
+#   server has it.  When a later wake connects, the pictures left in the outbox are
+#   sent over one connection, up to outbox_drain_bytes and outbox_drain_ms per wake,
+#   newest or oldest first; the first picture is sent whatever its size.  The outbox
+#   holds at most outbox_max_bytes and outbox_max_files; the oldest pictures are evicted
+#   first.  outbox_drain_bytes must be at least outbox_max_bytes, so that a full outbox
+#   can be sent in one wake.
+#   Filename: <station id>_<YYYYMMDDhhmmss>_<voltage>.jpg
+outbox_enabled = True
+outbox_dir = '/flash/outbox'
+outbox_max_bytes = 512 * 1024
+outbox_max_files = 20
+outbox_drain_bytes = 512 * 1024
+outbox_drain_ms = 90000
+outbox_newest_first = True
+
+if outbox_drain_bytes < outbox_max_bytes:
+    raise ValueError("outbox_drain_bytes must be at least outbox_max_bytes")
+
+outbox = Outbox(outbox_dir, outbox_max_bytes, outbox_max_files)
+
+# Wake cycle trace
+#   The time spent in each phase (boot, battery, network, dns, clock, camera, uart, encode,
+#   connect, send, reply) and counters (picture bytes, bytes on the wire, attach attempts,
+#   retries, backstop wakes, charge used in uAh) of the last trace_cycles wakes are kept in
+#   trace_file on the flash.  The cycles the server has not seen are sent in an
+#   X-Wake-Trace header with the next upload.
+trace_file = '/flash/trace.log'
+trace_cycles = 8
+
+trace = Trace(trace_file, trace_cycles)
+trace.span('boot', 0, utime.ticks_ms())
+
+# Data link for the upload: WiFi (testing) or LTE
+use_lte = False
+
+# Run the wake cycle as concurrent stages (see run_wake_pipeline).  The camera is triggered
+#   and the picture received into the outbox while the radio attaches and the server
+#   address is looked up, and the upload starts as soon as the connection is open.
+#   Needs uasyncio.  If it is False or uasyncio is missing, the steps run one after the
+#   other.
+wake_pipeline = True
+
+# Low-power shutdown
+#   With deep_sleep the GPy goes to deep sleep at the end of the wake instead of waiting
+#   awake in utime.sleep() for the DS3231 to reset it through P23.  The DS3231 INT on P22
+#   wakes it at the next alarm.  A timer wakes it sleep_backstop_s after the alarm time
+#   if the alarm does not come (e.g. the DS3231 lost its time); that wake syncs the clock.
+deep_sleep = True
+sleep_backstop_s = 900
+
+# Current draw of the GPy (mA) for the energy estimate: awake with the radio on, idle in
+#   utime.sleep() and in deep sleep.  wakes_per_day is the number of DS3231 alarms per day.
+awake_ma = 110.0
+idle_ma = 40.0
+deepsleep_ma = 0.02
+wakes_per_day = 4
+
+# The next alarm, the server addresses and the wake counters are kept
+#   in NVS so that a wake from deep sleep does not start blind.  The age of a cached
+#   address is counted in DS3231 seconds from the start of the wake.
+state = WakeState()
+discipline = ClockDiscipline(clock_history_file, clock_tolerance_ms)
+dns = dnscache.cache
+dns.ttl = dns_ttl
+dns.ttls = dns_ttls
+dns.clock = lambda: ds3231_seconds(startup_datetime)
+wake = machine.wake_reason()[0]
+state.add('wakes')
+if wake == machine.RTC_WAKE:
+    print("Woken by the backstop timer, the DS3231 alarm did not come")
+    state.add('backstop')
+    trace.count('backstop')
+
 # Real time clock time zone offset
 est_timezone = -5   # Eastern standard time is GMT - 5
 edt_timezone = -4   # Eastern daylight time is GMT - 4
@@ -90,9 +269,15 @@ gpy_enable_vmeas.value(0)
 def connect_to_wifi():
     #wlan.connect(ssid='polaris', auth=(WLAN.WPA2, 'gALAtians_03:20'))
     wlan.connect(ssid='JRG Guest', auth=(WLAN.WPA2, '600guest'), timeout=5000)
+    trace.count('attach')
+    start = utime.ticks_ms()
     while not wlan.isconnected():
+        if utime.ticks_diff(utime.ticks_ms(), start) > 30000:
+            print("Failed to connect to the WiFi")
+            return 0
         machine.idle()
     print(wlan.ifconfig())
+    return 1
 
 
 def attach_to_lte():
@@ -108,6 +293,7 @@ def attach_to_lte():
         utime.sleep(7)
 
         lte.attach(apn="m2mglobal",type=LTE.IP)
+        trace.count('attach')
         #lte.attach(apn="wireless.dish.com",type=LTE.IP)
         #lte.attach(apn="wireless.dish.com",type=LTE.IP,legacyattach=True)
         print("attaching..",end='')
@@ -179,98 +365,485 @@ def connect_to_lte_data():
     return return_val
 
 
-def process_picture(picture_len_int):
-    buf = bytearray(picture_len_int)
-    mv = memoryview(buf)
+# Bring up the data link selected by use_lte.  Return 1 if connected, 0 otherwise.
+def network_connect():
+    if use_lte:
+        return attach_to_lte() and connect_to_lte_data()
+    return connect_to_wifi()
+
+
+# Same as network_connect(), but wait for the radio with asyncio.sleep so that the
+#   other wake cycle stages (camera, picture receive) run while the link comes up
+async def network_connect_async():
+    if not use_lte:
+        wlan.connect(ssid='JRG Guest', auth=(WLAN.WPA2, '600guest'), timeout=5000)
+        trace.count('attach')
+        start = utime.ticks_ms()
+        while not wlan.isconnected():
+            if utime.ticks_diff(utime.ticks_ms(), start) > 30000:
+                print("Failed to connect to the WiFi")
+                return 0
+            await asyncio.sleep(0.05)
+        print(wlan.ifconfig())
+        return 1
+
+    for attach_try in range(3):
+        await asyncio.sleep(7)
+        lte.attach(apn="m2mglobal", type=LTE.IP)
+        trace.count('attach')
+        print("attaching..")
+        for attempt in range(100):
+            if lte.isattached():
+                break
+            await asyncio.sleep(1)
+        if lte.isattached():
+            print("attached!")
+            break
+        print("Attempt #%d failed. Try attaching again!" % (attach_try + 1))
+    else:
+        print("Failed to attach to the LTE system")
+        return 0
 
-    idx = 0
-    while idx < picture_len_int:
-        if uart.any():
-            bytes_read = uart.readinto(mv[idx:])
-            idx += bytes_read
-            print('.', end='')
+    lte.connect()
+    for attempt in range(100):
+        if lte.isconnected():
+            print("connected!")
+            return 1
+        await asyncio.sleep(1)
+    print("Failed to connect to the LTE data network")
+    lte.detach(reset=False)
+    return 0
 
-    # Print the index counter.  This is the number of bytes copied to the picture buffer
-    print(idx)
 
-    b64_picture_bytes = base64.b64encode(buf)
+# Build the HTTP POST request header for the picture upload
+#   extra_headers is a string of additional header lines, each ending with \r\n
+def http_post_header(path, content_type, content_length, extra_headers=""):
+    headers = """\
+POST {path} HTTP/1.1\r
+Content-Type: {content_type}\r
+Content-Length: {content_length}\r
+Host: {host}\r
+{extra_headers}\r\n"""
+
+    return headers.format(
+        path=path,
+        content_type=content_type,
+        content_length=content_length,
+        host=str(upload_host) + ":" + str(upload_port),
+        extra_headers=extra_headers
+    ).encode('iso-8859-1')
 
-    del buf
 
-    # Transmit the encoded image to the server
-    #data_file = "{\"base64File\": \"" +  b64_picture_bytes.decode('ascii') + "\", \"id\": " + station_id + ", \"timeStamp\": \"" + time_stamp + "\"}"
-    data_file = "{\"voltage\": " + voltage_level + ",\"base64File\": \"" +  b64_picture_bytes.decode('ascii') + "\", \"id\": " + station_id + ", \"timeStamp\": \"" + time_stamp + "\"}" 
+# Picture metadata sent in the headers of a 'binary' or 'resumable' upload, followed by
+#   the wake cycle trace the server has not seen yet
+def picture_meta_headers(station, voltage, stamp):
+    return ("X-Station-Id: " + station + "\r\n" +
+            "X-Voltage: " + voltage + "\r\n" +
+            "X-Timestamp: " + stamp + "\r\n" +
+            trace.header())
 
-    # Post the picture using the uPython urequests library
-    """
-    try:
-        wdt=machine.WDT(timeout=5*1000)
-        response = requests.post(url, headers=headers, data=data_file)
-        print(response.text)  # Prints the return filename from the server in json format
-        response.close()
-    except Exception as e:
-        print(e)
-    """
 
+# The JSON document sent to the server is {"voltage": .., "base64File": "..", "id": .., "timeStamp": ".."}
+#   Return the parts before and after the Base64 encoded picture
+def picture_json_envelope(station, voltage, stamp):
+    prefix = "{\"voltage\": " + voltage + ",\"base64File\": \""
+    suffix = "\", \"id\": " + station + ", \"timeStamp\": \"" + stamp + "\"}"
+    return prefix.encode(), suffix.encode()
 
 
-    # Post the picture using the uPython usockets library
-    # Host at JRG, Inc
-    """
-    host = "gaepd.janusresearch.com"
-    port = 8555
-    if(lte.isconnected()):
-        server_address = socket.getaddrinfo('gaepd.janusresearch.com', 8555)[0][-1]
-    else:
-        print("No longer connected")
-        shutdown()
-    """
-
-    # Host on Digital Ocean
-    host = "water.roeber.dev"
-    port = 80
+def connect_to_server():
     #if(lte.isconnected()):
     #    print("Get server address...")
-    server_address = socket.getaddrinfo('water.roeber.dev', 80)[0][-1]
+    server_address = resolve_server()
     #else:
      #   print("No longer connected")
     #    shutdown()
 
-
-    headers = """\
-POST /file/base64 HTTP/1.1\r
-Content-Type: {content_type}\r
-Content-Length: {content_length}\r
-Host: {host}\r
-\r\n"""
-
-    header_bytes = headers.format(
-        content_type="application/json",
-        content_length=len(data_file),
-        host=str(host) + ":" + str(port)
-    ).encode('iso-8859-1')
-
-    payload = header_bytes + data_file
-
-    #print(server_address)
-    #print(header_bytes)
-
     #s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s = socket.socket()
     s.setblocking(True)
+
+    print("Connect to server")
     s.settimeout(30)
+    trace.begin('connect')
+    try:
+        s.connect(server_address)
+    except OSError:
+        s.close()
+        raise
+    finally:
+        trace.end('connect')
+    return s
+
+
+# Look up the upload server through the DNS cache
+def resolve_server():
+    return dns.getaddrinfo(upload_host, upload_port)[0][-1]
+
+
+# Prefetch after the upload: look up the names of dns_hosts that are due while the link is
+#   still up, and count the cache hits and misses of the wake in the trace
+def dns_prefetch(connected):
+    if connected:
+        trace.begin('prefetch')
+        n = dns.prefetch(dns_hosts)
+        trace.end('prefetch')
+        if n:
+            print("DNS prefetch: %d names looked up" % n)
+    for name, n in (('dns_hit', dns.hits), ('dns_miss', dns.misses), ('dns_stale', dns.stale)):
+        if n:
+            trace.count(name, n)
+
+
+# Open the connection to server_address without blocking the other wake cycle stages.
+#   The connect runs non-blocking and the socket is polled until it is writable.
+async def connect_to_server_async(server_address):
+    s = socket.socket()
+    s.setblocking(False)
 
     print("Connect to server")
+    try:
+        s.connect(server_address)
+    except OSError as e:
+        if e.args[0] != uerrno.EINPROGRESS:
+            s.close()
+            raise
+    poller = uselect.poll()
+    poller.register(s, uselect.POLLOUT)
+    start = utime.ticks_ms()
+    while not poller.poll(0):
+        if utime.ticks_diff(utime.ticks_ms(), start) > 30000:
+            s.close()
+            raise OSError("connect to server timed out")
+        await asyncio.sleep(0.02)
+    s.setblocking(True)
     s.settimeout(30)
-    s.connect(server_address)
+    return s
+
+
+# Read the reply of the server to the end so that the connection can carry the next
+#   request.  Return the status code and the body.
+def read_reply(s):
+    f = s.makefile('rb', 0)
+    l = f.readline()
+    if not l:
+        raise OSError("connection closed")
+    status = int(l.split(None, 2)[1])
+    length = 0
+    while True:
+        l = f.readline()
+        if not l or l == b"\r\n":
+            break
+        if l.lower().startswith(b"content-length:"):
+            length = int(l[15:])
+    body = b""
+    while len(body) < length:
+        data = f.read(length - len(body))
+        if not data:
+            raise OSError("connection closed")
+        body += data
+    return status, body
+
+
+# Receive the picture and upload it in the configured upload_mode.  online is True if the
+#   data link is up.  s is the connection opened before the capture in the 'binary' and
+#   'stream' modes, or None if the server could not be reached.  The picture is written
+#   to the outbox while it is received and removed again once the server has it, so a
+#   failed upload is retried on a later wake.  A picture too large for the outbox is only
+#   sent, and not at all in the 'resumable' mode, which uploads from the outbox file.
+#   Return True if the server received the picture.
+def process_picture(picture_len_int, online, s=None):
+    spool = None
+    if outbox_enabled or upload_mode == 'resumable':
+        spool = outbox.add(station_id, time_stamp, voltage_level, picture_len_int)
+
+    try:
+        if upload_mode == 'resumable':
+            if not spool:
+                return False
+            return process_picture_resumable(picture_len_int, spool, online)
+        if upload_mode == 'buffered':
+            sent = process_picture_buffered(picture_len_int, spool)
+        else:
+            f = open(spool, 'wb') if spool else None
+            try:
+                sent = send_picture(s, camera.read, picture_len_int,
+                                    station_id, voltage_level, time_stamp, f)
+            finally:
+                if f:
+                    f.close()
+    except (UartTimeout, CameraLinkError) as e:
+        # The picture is incomplete.  Do not keep it.
+        print("Picture transfer failed:", e)
+        if s:
+            s.close()
+        if spool:
+            outbox.discard(spool)
+        return False
+    if sent and spool:
+        outbox.discard(spool)
+    elif spool:
+        print("Picture kept in the outbox")
+    return sent
+
+
+# Return a function that fills the first n bytes of a memoryview from the file f
+def file_reader(f):
+    def read_chunk(mv, n):
+        filled = 0
+        while filled < n:
+            r = f.readinto(mv[filled:n])
+            if not r:
+                raise OSError("picture file too short")
+            filled += r
+    return read_chunk
+
+
+# Send data on the connection s.  If that fails, close the connection and return None
+#   so that the caller carries on receiving the picture without the network.
+def send_or_drop(s, data):
+    if s is None:
+        return None
+    start = utime.ticks_ms()
+    try:
+        s.sendall(data)
+        trace.count('wire', len(data))
+        return s
+    except OSError as e:
+        print("Upload interrupted:", e)
+        s.close()
+        return None
+    finally:
+        trace.span('send', start, utime.ticks_ms())
+
+
+# Send a picture to the server as its bytes are produced by read(mv, n), chunk by chunk.
+#   'binary' mode: the bytes are sent as they are, with the metadata in the headers.
+#   Otherwise: each chunk is Base64 encoded and sent in the JSON document.  The
+#   Content-Length is known up front because the Base64 length only depends on the
+#   picture length.
+#   If spool is a file, every chunk is also written to it, so the whole picture is
+#   received even if the connection fails.  Return True if the server accepted it.
+def send_picture(s, read, picture_len_int, station, voltage, stamp, spool=None):
+    binary = upload_mode == 'binary'
+    if binary:
+        header = http_post_header(upload_binary_path, "application/octet-stream",
+                                  picture_len_int,
+                                  picture_meta_headers(station, voltage, stamp))
+        suffix = b""
+    else:
+        prefix, suffix = picture_json_envelope(station, voltage, stamp)
+        b64_len = ((picture_len_int + 2) // 3) * 4
+        header = http_post_header(upload_path, "application/json",
+                                  len(prefix) + b64_len + len(suffix),
+                                  trace.header()) + prefix
 
     print("Sending photo to server...")
-    s.settimeout(240)
-    s.sendall(payload)
+    if s:
+        s.settimeout(60)
+    s = send_or_drop(s, header)
+
+    buf = bytearray(upload_chunk_size)
+    mv = memoryview(buf)
+    if not binary:
+        # One output buffer for the Base64 of every chunk
+        encoder = base64.B64Encoder()
+        out = memoryview(bytearray(encoder.encoded_len(upload_chunk_size) + 4))
+
+    idx = 0
+    while idx < picture_len_int:
+        chunk_len = min(upload_chunk_size, picture_len_int - idx)
+        read(mv, chunk_len)
+        if spool:
+            spool.write(mv[:chunk_len])
+
+        if binary:
+            s = send_or_drop(s, mv[:chunk_len])
+        elif s:
+            start = utime.ticks_ms()
+            n = encoder.encode_into(mv[:chunk_len], out)
+            trace.span('encode', start, utime.ticks_ms())
+            s = send_or_drop(s, out[:n])
+
+        idx += chunk_len
+        print('.', end='')
+
+    if not binary:
+        n = encoder.finish(out)
+        if n:
+            s = send_or_drop(s, out[:n])
+    s = send_or_drop(s, suffix)
+
+    # Print the index counter.  This is the number of picture bytes received
+    print(idx)
+    if s is None:
+        return False
     print("...Send complete")
 
-    s.settimeout(60)
-    print(s.recv(1024))  # Print the data that the server returns
+    trace.begin('reply')
+    try:
+        status, reply = read_reply(s)
+    except OSError as e:
+        print("No reply from the server:", e)
+        s.close()
+        return False
+    finally:
+        trace.end('reply')
+    print(reply)  # Print the data that the server returns
+    return 200 <= status < 300
+
+
+# Receive the picture from the UART, write it to the outbox file and send it in resumable
+#   chunks as it arrives.  On a dropped connection, receive the rest of the picture to
+#   the flash first (the UART can not wait for the reconnect), then resume from the file.
+#   Without a data link (online False) the picture is only written to the outbox.
+def process_picture_resumable(picture_len_int, filename, online):
+    up = ResumableUpload(upload_host, upload_port, upload_resumable_path,
+                         station_id + '_' + outbox_stamp_digits(time_stamp),
+                         picture_meta_headers(station_id, voltage_level, time_stamp))
+
+    f = open(filename, 'wb')
+
+    buf = bytearray(resumable_chunk_size)
+    mv = memoryview(buf)
+
+    print("Sending photo to server...")
+    offset = 0          # Number of picture bytes the server holds
+    idx = 0
+    sending = online
+    try:
+        while idx < picture_len_int:
+            chunk_len = min(resumable_chunk_size, picture_len_int - idx)
+            camera.read(mv, chunk_len)
+            f.write(mv[:chunk_len])
+            if sending:
+                try:
+                    offset = up.send(idx, mv[:chunk_len], picture_len_int)
+                except Exception as e:
+                    print("Upload interrupted:", e)
+                    sending = False
+            idx += chunk_len
+            print('.', end='')
+    finally:
+        f.close()
+        if idx < picture_len_int:
+            up.close()
+    print(idx)
+
+    if not online:
+        up.close()
+        print("No network, picture kept in the outbox")
+        return False
+    sent = resume_upload(up, filename, picture_len_int, buf, offset)
+    up.close()
+    if sent:
+        print("...Send complete")
+    print("Picture bytes sent: %d of %d" % (up.bytes_sent, picture_len_int))
+    trace.count('wire', up.bytes_sent)
+    trace.count('retries', up.retries)
+    return sent
+
+
+# Send the part of the picture file that the server does not hold yet.  Delete the file
+#   once the server holds the whole picture.  Return True on success.
+def resume_upload(up, filename, picture_len_int, buf, offset=0):
+    try:
+        if offset < picture_len_int:
+            f = open(filename, 'rb')
+            try:
+                offset = up.resume(f, picture_len_int, picture_len_int, memoryview(buf),
+                                   resumable_retries)
+            finally:
+                f.close()
+    except Exception as e:
+        print("Upload failed, picture kept in the outbox:", e)
+        return False
+    if up.reply:
+        print(up.reply)  # Print the data that the server returns
+    if offset >= picture_len_int:
+        outbox.discard(filename)
+        return True
+    return False
+
+
+# Upload the pictures left in the outbox by earlier wakes over one connection, within
+#   the outbox_drain_bytes and outbox_drain_ms budgets
+def drain_outbox():
+    if not outbox.entries():
+        return
+    print("Draining the outbox")
+    if upload_mode == 'resumable':
+        up = ResumableUpload(upload_host, upload_port, upload_resumable_path, '')
+        buf = bytearray(resumable_chunk_size)
+
+        def send(path, station, stamp, voltage, size):
+            print("Resume upload of", path)
+            up.start(station + '_' + outbox_stamp_digits(stamp),
+                     picture_meta_headers(station, voltage, stamp))
+            # resume_upload removes the file once the server has the picture
+            return resume_upload(up, path, size, buf)
+    else:
+        try:
+            up = connect_to_server()
+        except OSError as e:
+            print("Can not drain the outbox:", e)
+            return
+
+        def send(path, station, stamp, voltage, size):
+            print("Upload", path)
+            f = open(path, 'rb')
+            try:
+                return send_picture(up, file_reader(f), size, station, voltage, stamp)
+            finally:
+                f.close()
+    try:
+        sent = outbox.drain(send, outbox_drain_bytes, outbox_drain_ms,
+                            outbox_newest_first)
+    finally:
+        up.close()
+    if upload_mode == 'resumable':
+        trace.count('wire', up.bytes_sent)
+        trace.count('retries', up.retries)
+    trace.count('drained', sent)
+    print("Outbox pictures sent: %d, left: %d" % (sent, len(outbox.entries())))
+
+
+def process_picture_buffered(picture_len_int, spool=None):
+    buf = bytearray(picture_len_int)
+    mv = memoryview(buf)
+
+    idx = 0
+    while idx < picture_len_int:
+        bytes_read = min(upload_chunk_size, picture_len_int - idx)
+        camera.read(mv[idx:], bytes_read)
+        idx += bytes_read
+        print('.', end='')
+
+    # Print the index counter.  This is the number of bytes copied to the picture buffer
+    print(idx)
+
+    # Keep the picture in the outbox until the server has it
+    if spool:
+        f = open(spool, 'wb')
+        f.write(buf)
+        f.close()
+
+    # Encode and send the picture chunk by chunk from the buffer
+    pos = [0]
+
+    def read(dst, n):
+        dst[:n] = mv[pos[0]:pos[0] + n]
+        pos[0] += n
+
+    try:
+        s = connect_to_server()
+    except OSError as e:
+        print("Can not reach the server:", e)
+        return False
+    try:
+        return send_picture(s, read, picture_len_int, station_id, voltage_level, time_stamp)
+    finally:
+        s.close()
 
 """
     s = socket.socket()
@@ -327,64 +900,98 @@ def battery_voltage():
     integer_value = int(rounded_value)    # for rounded_value = 648.  integer_value = 648 
     return str(integer_value)
 
-# Set the clock with NTP date/time
+# Set the DS3231 clock with NTP date/time.  All of ntp_hosts are asked at once; the reply
+#   with the lowest round-trip delay is used.  Return 1 if the clock was set.
 def sync_clock():
-    return_val = 0
-
     print("Setting the DS3231 RTC ...")
-    print("   Connecting to ntp")
-    host = "pool.ntp.org"
-    port = 123
-    buf = 1024
-    address = socket.getaddrinfo(host,  port)[0][-1]
-    msg = '\x1b' + 47 * '\0'
-    msg = msg.encode()
-    TIME1970 = 2208988800 # 1970-01-01 00:00:00
-
-    # connect to server
-    # TODO: Need a timeout to prevent hanging during NTP call
-    ntp_try = 0
-    while ntp_try < 5:
-        client = socket.socket(AF_INET, SOCK_DGRAM)
-        bytes_sent = 0
-        for _ in range(10):
-            bytes_sent = client.sendto(msg, address)
-            utime.sleep(1)
-            if bytes_sent > 0:                       #Connection to NTP server successful if bytes are sent
-                #print("Sent to NTP server")
-                # Receive the NTP time into t.  Adjust t with the base time, TIME1970
-                msg, address = client.recvfrom(buf)
-                t = ustruct.unpack("!12I", msg)[10]
-                t -= TIME1970
-                # adjust utime for the local timezone. By default, NTP time will be GMT
-                utime.timezone(est_timezone*60**2)  # Calculate timezone using appropriate GMT offset
-                # Convert epoch time, t, to 8-tuple [yr, mo, mday, hr, min, sec, weekday, yearday]
-                ntp_time = utime.localtime(t)
-
-                print("ntp_time (localtime): ", ntp_time)
-
-                # Set DS3231 time using NTP time.  First, adjust the time tuple to match the
-                #    format requried by the DS3231 driver
-                a = list(ntp_time)
-
-                del a[7]            # delete the yearday value
-                a.insert(3, 1)      # insert 1 for the weekday value.  Any weekday value is in range 1-7
-                                    # is OK since this program does not use the weekday.
-
-                localtime = tuple(a)
-                #print("Local time: ", localtime)
-                ds3231.datetime(localtime)
-
-                return_val = 1    # Update the return_val to indicate time update success
-                return return_val
-            else:
-                print("loop in time server")
-                utime.sleep(5)
-        ntp_try += 1
-        client.close()
-        print("Try NTP again")
-        utime.sleep(5)            # Time delay before next attempt at connecting to the NTP server
-    return return_val
+    ntp = TimeSync(ntp_hosts, ntp_budget_ms)
+    best = ntp.sync()
+    trace.count('ntp', ntp.replies)
+    if best is None:
+        print("   No answer from %d NTP servers" % ntp.sent)
+        return 0
+    print("   %d of %d NTP servers answered, delay %d ms, offset %d ms"
+          % (ntp.replies, ntp.sent, best.delay_us // 1000, best.offset_us // 1000))
+
+    # adjust utime for the local timezone. By default, NTP time will be GMT
+    utime.timezone(est_timezone*60**2)  # Calculate timezone using appropriate GMT offset
+
+    # Error of the DS3231, measured at the start of one of its seconds (as in
+    #   ds3231_port.DS3231.rtc_test)
+    ds_seconds = ds3231_transition()
+    if ds_seconds is not None:
+        error_ms = ds_seconds * 1000 - (ntp.time_us() // 1000 + est_timezone*60**2 * 1000)
+        discipline.record(ds_seconds, error_ms)
+        drift = discipline.drift_ppm()
+        print("   DS3231 error %d ms, drift %s ppm" % (error_ms, 'unknown' if drift is None else '%.2f' % drift))
+        calibrate_aging()
+        if abs(error_ms) <= clock_step_ms:
+            return 1
+
+    # The DS3231 is set at the start of the next second: writing the seconds register
+    #   restarts its count of the second
+    us = ntp.time_us()
+    t = us // 1000000 + 1
+    # Convert epoch time, t, to 8-tuple [yr, mo, mday, hr, min, sec, weekday, yearday]
+    ntp_time = utime.localtime(t)
+
+    print("ntp_time (localtime): ", ntp_time)
+
+    # Set DS3231 time using NTP time.  First, adjust the time tuple to match the
+    #    format requried by the DS3231 driver
+    a = list(ntp_time)
+
+    del a[7]            # delete the yearday value
+    a.insert(3, 1)      # insert 1 for the weekday value.  Any weekday value is in range 1-7
+                        # is OK since this program does not use the weekday.
+
+    a = tuple(a)
+    utime.sleep_us(max(0, t * 1000000 - ntp.time_us()))
+    ds3231.datetime(a)
+    if ds_seconds is not None:
+        discipline.stepped(error_ms)
+    return 1
+
+
+# Trim the DS3231 oscillator with its aging offset once the clock discipline knows its drift
+def calibrate_aging():
+    aging = ds3231.aging_offset()
+    temperature = ds3231.get_temperature()
+    new = discipline.calibrate(aging, temperature)
+    if new is not None:
+        print("   DS3231 aging offset %d -> %d at %.2f C" % (aging, new, temperature))
+        ds3231.aging_offset(new)
+
+
+# Wait for the DS3231 seconds to change and return its time (seconds since 1970) then.
+#   None if they do not change within 1.1 s (the oscillator is stopped).
+def ds3231_transition():
+    t = ds3231.tick()
+    if t is None:
+        return None
+    return t + EPOCH_2000
+
+# Seconds since 1970 (DS3231 local time) of a ds3231.datetime() tuple
+def ds3231_seconds(dt):
+    return utime.mktime((dt[0], dt[1], dt[2], dt[4], dt[5], dt[6], 0, 0))
+
+
+# Seconds of the first hour:minute:00 after now (seconds)
+def next_alarm_seconds(now, hour, minute):
+    alarm = now - now % 86400 + hour * 3600 + minute * 60
+    if alarm <= now:
+        alarm += 86400
+    return alarm
+
+
+# Decide if the DS3231 needs an NTP sync: the year is wrong (usually on first start or the
+#   backup battery is discharged), the DS3231 alarm was missed (backstop wake), or the
+#   clock discipline expects the corrected time to be clock_tolerance_ms off by now
+def clock_needs_sync():
+    if startup_year < 2021 or wake == machine.RTC_WAKE:
+        return True
+    return ds3231_seconds(startup_datetime) >= discipline.next_sync()
+
 
 def gpy_reset():
     # Pull the RESET pin LOW to reset the GPy
@@ -410,6 +1017,19 @@ def ds3231_int_handler(arg):
 #      RTC initiates a RESET every six hours, put the GPy in a sleep mode for 6hrs and 15 minutes.  If all else
 #      fails, the GPy will reboot at the end of the software delay
 def shutdown():
+    if deep_sleep:
+        # Sleep until the DS3231 alarm pulls P22 LOW.  The timer is the backstop.
+        sleep_s = 22500
+        left = state.get('alarm') - utime.time()
+        if 0 < left <= 86400:
+            sleep_s = left + sleep_backstop_s
+        print("Deep sleep for up to %d s" % sleep_s)
+        # LTE() at the top powers the modem up even in WiFi mode, and it stays powered in
+        #   deep sleep unless it is switched off here
+        lte.deinit()
+        machine.pin_sleep_wakeup(['P22'], mode=machine.WAKEUP_ALL_LOW, enable_pull=False)
+        machine.deepsleep(sleep_s * 1000)
+
     # Delay.  Expect that the RTC will reset the GPY before this delay expires.
     #    Delay 6hrs and 15 minutes (22500 seconds) assuming that the RTC interrupts every 6 hours
     #machine.deepsleep(22500000)
@@ -423,6 +1043,272 @@ def shutdown():
     # Pull the RESET pin LOW to reset the GPy
     gpy_reset()
 
+
+# Set the GPy software clock from the DS3231, re-check the alarm time and return the
+#   picture time stamps (2021-10-01T07:05:00, 202110010705)
+#   align: the wake synced the DS3231 with NTP, so the GPy clock is set when the DS3231
+#   seconds tick over (up to 1 s of I2C polling) rather than up to 1 s behind
+def set_clocks(align=False):
+    # Set the GPy software clock using the DS3231 time, read straight into RTC() without
+    #   building a date tuple first.
+    #   The error of the DS3231 predicted from its drift is taken off
+    ds3231.sync_rtc(rtc, discipline.correction_ms, align)
+
+    print('DS3231 time:', ds3231.datetime())
+    print('RTC time:   ', rtc.now())
+
+    # The GPy software RTC is set using the DS3231 time.  Now verify the alarm time for next GPy reset
+    #   If the rtc year and the startup_year are the same, the next alarm is properly set
+    #   If the rtc year and startup_year are different, set the alarm using the correct time
+    current_datetime = rtc.now()
+    current_hour = current_datetime[3]
+    current_year = current_datetime[0]
+
+    if current_year != startup_year:
+        if current_hour >= 0 and current_hour < 7:
+            next_hour = 7
+        elif current_hour >= 7 and current_hour < 13:
+            next_hour = 13
+        elif current_hour >= 13 and current_hour < 19:
+            next_hour = 19
+        else:
+            next_hour = 1
+
+        # set the alarm
+        # (year, month, day, weekday, hour, minute, second, millisecond)
+        alarm = [None, None, None, None, next_hour, next_minute, 0, None]  # Alarm when hours, minutes and seconds match
+
+        alarm_datetime = tuple(alarm)
+        ds3231.alarm_time(alarm_datetime)
+        state.set('alarm', next_alarm_seconds(utime.time(), next_hour, next_minute))
+
+        print("Next Alarm Time: ", ds3231.alarm_time())          # For debugging, print the alarm time
+        ds3231.alarm(value=False, alarm=0)  # Clear the alarm flag
+        ds3231.interrupt(alarm=0)           # Enable the interrupt
+
+    time_stamp = '{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}'.format(current_datetime[0], current_datetime[1], current_datetime[2], current_datetime[3], current_datetime[4], current_datetime[5])
+    camera_time_stamp = '{:04d}{:02d}{:02d}{:02d}{:02d}'.format(current_datetime[0], current_datetime[1], current_datetime[2], current_datetime[3], current_datetime[4])
+    return time_stamp, camera_time_stamp
+
+
+# Wake the ESP32-CAM, send it the picture filename and return the picture length
+#   (0 if the camera does not answer)
+def camera_handshake(picture_filename):
+    # Toggle the ESP32-CAM RESET line to initiate the picture capture process
+    camera_trigger(0)
+    utime.sleep_ms(10)
+    camera_trigger(1)
+
+    # For testing only.  Print a string to the GPy terminal
+    print('new picture')
+
+    # Transmit 'Hello' until 'ready' is received.  Give up after camera_ready_ms.
+    keyword = b'ready'  # Expected word from the ESP32-CAM
+    utime.sleep(1)
+    # Send a greeting followed by reading the response
+    camera_ready = False
+    hello_start = utime.ticks_ms()
+    while utime.ticks_diff(utime.ticks_ms(), hello_start) < camera_ready_ms:
+        uart.write('Hello\0')
+        reply = rx.readline(200)
+        print(reply)
+        if reply == keyword:
+            camera_ready = True
+            break
+
+    if not camera_ready:
+        print("The ESP32-CAM did not answer")
+        return 0
+
+    print("found the keyword")  # The word 'ready' was received
+
+    if camera_negotiate:
+        print("Camera link at %d baud" % camera.negotiate(camera_baudrates))
+
+    # Send the picture filename to the ESP32-CAM.  This filename will be used
+    #   by the ESP32-CAM to store the picture to its local SD-Card.
+    utime.sleep_ms(200)
+    uart.write(picture_filename)
+
+    # Read the picture length from the ESP32-Cam.  Convert the value to an integer
+    picture_len = rx.readline(camera_ready_ms)
+
+    # Strip the trailing whitespace (e.g. \r\n) and cast the value to an integer
+    picture_len_int = 0
+    try:
+        picture_len_int = int(picture_len.strip())
+    except (AttributeError, ValueError):
+        print("No picture length from the ESP32-CAM:", picture_len)
+    print(picture_len_int)
+    return picture_len_int
+
+
+# Run the wake cycle as concurrent stages (see WakeCycle).  The radio attaches while the
+#   camera takes the picture and the picture is received into the outbox, and the upload
+#   starts as soon as the connection to the server is open:
+#
+#     network -> dns -> connect ------------------------.
+#     network -> clock (only when the RTC needs an update) |
+#     battery, time (after clock) -> camera -> receive     +-> upload
+#
+#   In the 'binary' and 'stream' modes the upload follows the camera directly and reads
+#   the picture from the spool as it arrives.  The 'resumable' and 'buffered' modes upload
+#   the outbox file once the whole picture is received.
+#   The camera handshake runs without yielding (a few seconds); the radio keeps attaching
+#   in the background meanwhile.  Return True if the server received the picture.
+def run_wake_pipeline():
+    global connected
+
+    cycle = WakeCycle()
+    connected = 0
+    clock_sync = clock_needs_sync()
+
+    async def network():
+        global connected
+        connected = await network_connect_async()
+        if not connected:
+            raise OSError("no data link")
+        return connected
+
+    async def battery():
+        global voltage_level
+        voltage_level = battery_voltage()
+        return voltage_level
+
+    async def resolve_host():
+        print("server address")
+        server_address = resolve_server()
+        print(server_address)
+        return server_address
+
+    async def clock():
+        return sync_clock()
+
+    async def timestamps():
+        global time_stamp, camera_time_stamp
+        time_stamp, camera_time_stamp = set_clocks(cycle.result('clock', 0))
+        return time_stamp
+
+    async def capture():
+        # Picture filename.  Transmit this to the ESP32-CAM. It is used for the SD Card filename on the ESP32-CAM
+        picture_filename = station_id + '_' + camera_time_stamp + '_' + voltage_level + '\0'
+        print(picture_filename)
+        picture_len_int = camera_handshake(picture_filename)
+        if picture_len_int <= 0:
+            raise OSError("no picture")
+        print('Begin transfer')
+        rx.start(camera_transfer_ms)
+        path = outbox.add(station_id, time_stamp, voltage_level, picture_len_int)
+        if not path:
+            if upload_mode == 'resumable':
+                raise OSError("picture too large for the outbox")
+            print("Picture sent straight from the camera, not kept in the outbox")
+        return Spool(path, picture_len_int, camera.read, upload_chunk_size)
+
+    async def receive():
+        spool = cycle.result('camera')
+        if not spool.path:
+            return 0        # The upload reads the picture from the camera itself
+        while not spool.done():
+            spool.pump()
+            print('.', end='')
+            await asyncio.sleep(0)
+        print(spool.received)
+        return spool.received
+
+    async def connect():
+        return await connect_to_server_async(cycle.result('dns'))
+
+    async def upload():
+        spool = cycle.result('camera')
+        if upload_mode == 'resumable':
+            up = ResumableUpload(upload_host, upload_port, upload_resumable_path,
+                                 station_id + '_' + outbox_stamp_digits(time_stamp),
+                                 picture_meta_headers(station_id, voltage_level, time_stamp))
+            try:
+                return resume_upload(up, spool.path, spool.length,
+                                     bytearray(resumable_chunk_size))
+            finally:
+                up.close()
+                trace.count('wire', up.bytes_sent)
+                trace.count('retries', up.retries)
+        if upload_mode == 'buffered' and spool.path:
+            f = open(spool.path, 'rb')
+            try:
+                return send_picture(cycle.result('connect'), file_reader(f), spool.length,
+                                    station_id, voltage_level, time_stamp)
+            finally:
+                f.close()
+        return send_picture(cycle.result('connect'), spool.read, spool.length,
+                            station_id, voltage_level, time_stamp)
+
+    cycle.stage('network', network)
+    cycle.stage('battery', battery)
+    cycle.stage('dns', resolve_host, after=('network',))
+    if clock_sync:
+        cycle.stage('clock', clock, after=('network',))
+    else:
+        print("DS3231 RTC does not need updating")
+    cycle.stage('time', timestamps, wait=('clock',) if clock_sync else ())
+    cycle.stage('camera', capture, after=('battery', 'time'))
+    cycle.stage('receive', receive, after=('camera',))
+    if upload_mode == 'resumable':
+        cycle.stage('upload', upload, after=('receive', 'network'))
+    else:
+        cycle.stage('connect', connect, after=('dns',))
+        if upload_mode == 'buffered':
+            cycle.stage('upload', upload, after=('receive', 'connect'))
+        else:
+            cycle.stage('upload', upload, after=('camera', 'connect'))
+
+    cycle.run()
+    cycle.report()
+    for stage in cycle.stages:
+        if stage[0] in cycle.times:
+            trace.span(stage[0], *cycle.times[stage[0]])
+
+    sent = bool(cycle.result('upload'))
+    s = cycle.result('connect')
+    if s:
+        s.close()
+    spool = cycle.result('camera')
+    if spool:
+        spool.close()
+        camera.report()
+        if not spool.path:
+            if not spool.done():
+                print("Picture transfer failed:", spool.error)
+        elif not spool.done():
+            # The picture is incomplete.  Do not keep it.
+            print("Picture transfer failed:", spool.error)
+            outbox.discard(spool.path)
+        elif sent:
+            outbox.discard(spool.path)
+        else:
+            print("Picture kept in the outbox")
+    return sent
+
+
+# Estimate the battery charge per day from the average awake time of the last wakes (kept
+#   in NVS) and print the charge deep sleep saves against waiting awake in utime.sleep().
+#   The charge is not measured: it is the awake time times the configured currents
+#   (awake_ma, idle_ma, deepsleep_ma).
+def energy_report():
+    awake_ms = utime.ticks_ms()
+    trace.count('uah', int(awake_ms * awake_ma / 3600))     # Estimate, not measured
+    average = state.get('awake_ms') or awake_ms
+    average = (3 * average + awake_ms) // 4
+    state.set('awake_ms', average)
+    awake_h = wakes_per_day * average / 3600000
+    awake_mah = awake_h * awake_ma
+    idle_mah = awake_mah + (24 - awake_h) * idle_ma
+    sleep_mah = awake_mah + (24 - awake_h) * deepsleep_ma
+    print("Estimated charge per day (configured currents): %.1f mAh with deep sleep, "
+          "%.1f mAh waiting awake, %.1f mAh saved" % (sleep_mah, idle_mah, idle_mah - sleep_mah))
+    print("Wakes %d, pictures sent %d, backstop wakes %d"
+          % (state.get('wakes'), state.get('sent'), state.get('backstop')))
+
+
 #########################################################
 ################ End function definitions ###############
 
@@ -436,7 +1322,10 @@ utime.sleep(1)
 # Before any other action, set the next DS3231 alarm time.  If any of the functions hang,
 #   the DS3231 will reset the GPy at the next alarm.  Even if the DS3231 starts with the wrong
 #   clock time, set a future alarm time.
+#   The DS3231 registers are read in one I2C transaction into a shadow copy; the alarm
+#   and flag changes below are made to the copy and written back together by flush().
 
+ds3231.load()                           # Read all the DS3231 registers at once
 startup_datetime = ds3231.datetime()   # Get the time from the DS3231 RTC on startup
 
 startup_minute = startup_datetime[5]
@@ -476,6 +1365,7 @@ next_minute = 5
 alarm = [None, None, None, None, next_hour, next_minute, 0, None]  # Alarm when hours, minutes and seconds (0) match
 alarm_datetime = tuple(alarm)
 ds3231.alarm_time(alarm_datetime)
+state.set('alarm', next_alarm_seconds(ds3231_seconds(startup_datetime), next_hour, next_minute))
 
 print("Next Alarm Time: ", ds3231.alarm_time())     # For debugging, print the alarm time
 ds3231.no_interrupt()               # Ensure both alarm interrupts are disabled
@@ -483,6 +1373,7 @@ ds3231.no_alarmflag()               # Ensure both alarm flags in the status regi
 #ds3231.alarm(value=False, alarm=0)  # Clear the Alarm 1 (alarm=0) flag
 #ds3231.alarm(value=False, alarm=1)  # Clear the Alarm 2 (alarm=1) flag even though Alarm 2 is not used
 ds3231.interrupt(alarm=0)           # Enable Alarm 1 (alarm=0) interrupt
+ds3231.flush()                      # Write the changed DS3231 registers
 
 
 # Now that the DS3231 alarm flag is cleared, configure P22 as an
@@ -492,203 +1383,141 @@ ds3231_trigger.callback(Pin.IRQ_FALLING, ds3231_int_handler)
 
 
 
-######################## Read the battery voltage ##############################
-voltage_level = battery_voltage()
-
-
-
-
-
-
-#################################### Network Connection #############################################################
-connect_to_wifi()
-
-"""
-attached = 0
-attached = attach_to_lte()
-
-if not attached:
-    print("Shutting down.  Better luck next reset.")
-    shutdown()     # Wait for the next scheduled reset
-"""
-
-################## Send SMS ################################
-"""
-def _getlte():
-  if not lte.isattached():
-    print('lte attaching '); lte.attach()
-    while 1:
-      if lte.isattached(): print(' OK'); break
-      print('. ', end=''); utime.sleep(1)
-
-_getlte()
-"""
-
-
-
-#print('configuring for sms', end=' '); ans=lte.send_at_cmd('AT+CMGF=1').split('\r\n'); print(ans, end=' ')
-#ans=lte.send_at_cmd('AT+CPMS="SM", "SM", "SM"').split('\r\n'); print(ans); print()
-#print('receiving an sms', end=' '); ans=lte.send_at_cmd('AT+CMGL="all"').split('\r\n'); print(ans); print()                                               
-#print('sending an sms', end=' '); ans=lte.send_at_cmd('AT+SQNSMSSEND="7623204402",sms_data').split('\r\n'); print(ans)
-
-""""
-voltage = 7.628
-#var2="Meter Number {0:0d} @ Voltage {1:0.2f}".format(station_id,voltage)
-var2="{}Meter Number {:05d} @ Voltage {:.2f}{}"
-print(var2.format("\"",station_id,voltage,"\""))
-print('sending an sms', end=' '); ans=lte.send_at_cmd('AT+SQNSMSSEND="7623204402",var2.format("\"",station_id,voltage,"\""))').split('\r\n'); print(ans)
-"""
-
-"""
-connected = 0
-connected = connect_to_lte_data()
-
-if not connected:
-    shutdown()      # Wait for the next scheduled reset
-"""
-
-
-print("server addresses")
-server_address = socket.getaddrinfo('water.roeber.dev', 80)[0][-1]
-print(server_address)
-server_address1 = socket.getaddrinfo('gaepd.janusresearch.com', 8555)[0][-1]
-print(server_address1)
-
-################################### RTC Synchronization with NTP server ##################################################
-# Synchronize the DS3231 clock with NTP on the first day of the month
-#   or if the year is wrong (usually on first start or backup battery is discharged)
-if(startup_year < 2021 or startup_year > 2025 or startup_day == 1):
-    sync_clock()
+######################## Wake cycle ##############################
+# The pipeline brings up the network, takes the picture and uploads it concurrently.
+#   Otherwise each step below runs after the previous one.
+picture_sent = False
+time_stamp = ''
+if wake_pipeline and asyncio:
+    picture_sent = run_wake_pipeline()
 else:
-    print("DS3231 RTC does not need updating")
-
-
-# Set the GPy software clock using the DS3231 time.  Read the DS3231 and adjust the
-#   tuple to the format required by RTC()
-ds3231_time = ds3231.datetime()
-a = list(ds3231_time)
-del a[7]            # ds3231.datetime() returns 'None' as a[7].  Delete it
-del a[3]            # delete the weekday value
-a.append(0)         # Append 0 in the microseconds position
-
-localtime = tuple(a)
-rtc.init(localtime)
+    ######################## Read the battery voltage ##############################
+    trace.begin('battery')
+    voltage_level = battery_voltage()
+    trace.end('battery')
+
+    #################################### Network Connection #############################################################
+    # If the network is not available, the picture is still taken and kept in the outbox
+    trace.begin('network')
+    connected = network_connect()
+    trace.end('network')
+
+    ################## Send SMS ################################
+    """
+    def _getlte():
+      if not lte.isattached():
+        print('lte attaching '); lte.attach()
+        while 1:
+          if lte.isattached(): print(' OK'); break
+          print('. ', end=''); utime.sleep(1)
+
+    _getlte()
+    """
 
-print('DS3231 time:', ds3231.datetime())
-print('RTC time:   ', rtc.now())
 
 
+    #print('configuring for sms', end=' '); ans=lte.send_at_cmd('AT+CMGF=1').split('\r\n'); print(ans, end=' ')
+    #ans=lte.send_at_cmd('AT+CPMS="SM", "SM", "SM"').split('\r\n'); print(ans); print()
+    #print('receiving an sms', end=' '); ans=lte.send_at_cmd('AT+CMGL="all"').split('\r\n'); print(ans); print()
+    #print('sending an sms', end=' '); ans=lte.send_at_cmd('AT+SQNSMSSEND="7623204402",sms_data').split('\r\n'); print(ans)
 
-# The GPy software RTC is set using the DS3231 time.  Now verify the alarm time for next GPy reset
-#   If the rtc year and the startup_year are the same, the next alarm is properly set
-#   If the rtc year and startup_year are different, set the alarm using the correct time
-current_datetime = rtc.now()
-current_hour = current_datetime[3]
-current_year = current_datetime[0]
+    """"
+    voltage = 7.628
+    #var2="Meter Number {0:0d} @ Voltage {1:0.2f}".format(station_id,voltage)
+    var2="{}Meter Number {:05d} @ Voltage {:.2f}{}"
+    print(var2.format("\"",station_id,voltage,"\""))
+    print('sending an sms', end=' '); ans=lte.send_at_cmd('AT+SQNSMSSEND="7623204402",var2.format("\"",station_id,voltage,"\""))').split('\r\n'); print(ans)
+    """
 
 
-if current_year != startup_year:
-    if current_hour >= 0 and current_hour < 7:
-        next_hour = 7
-    elif current_hour >= 7 and current_hour < 13:
-        next_hour = 13
-    elif current_hour >= 13 and current_hour < 19:
-        next_hour = 19
+    if connected:
+        trace.begin('dns')
+        print("server addresses")
+        server_address = dns.getaddrinfo('water.roeber.dev', 80)[0][-1]
+        print(server_address)
+        server_address1 = dns.getaddrinfo('gaepd.janusresearch.com', 8555)[0][-1]
+        print(server_address1)
+        trace.end('dns')
+
+    ################################### RTC Synchronization with NTP server ##################################################
+    # Synchronize the DS3231 clock with NTP on the first day of the month
+    #   or if the year is wrong (usually on first start or backup battery is discharged)
+    synced = 0
+    if not connected:
+        print("No network, the DS3231 RTC is not updated")
+    elif clock_needs_sync():
+        trace.begin('clock')
+        synced = sync_clock()
+        trace.end('clock')
     else:
-        next_hour = 1
-
-    # set the alarm
-    # (year, month, day, weekday, hour, minute, second, millisecond)
-    alarm = [None, None, None, None, next_hour, next_minute, 0, None]  # Alarm when hours, minutes and seconds match
-
-    alarm_datetime = tuple(alarm)
-    ds3231.alarm_time(alarm_datetime)
-
-    print("Next Alarm Time: ", ds3231.alarm_time())          # For debugging, print the alarm time
-    ds3231.alarm(value=False, alarm=0)  # Clear the alarm flag
-    ds3231.interrupt(alarm=0)           # Enable the interrupt
-
-
-time_stamp = '{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}'.format(current_datetime[0], current_datetime[1], current_datetime[2], current_datetime[3], current_datetime[4], current_datetime[5])
-camera_time_stamp = '{:04d}{:02d}{:02d}{:02d}{:02d}'.format(current_datetime[0], current_datetime[1], current_datetime[2], current_datetime[3], current_datetime[4])
-
-
+        print("DS3231 RTC does not need updating")
 
-# Picture filename.  Transmit this to the ESP32-CAM. It is used for the SD Card filename on the ESP32-CAM
-picture_filename = station_id + '_' + camera_time_stamp + '_' + voltage_level + '\0'
-#print("Timestamp", time_stamp)
-print(picture_filename)  # Print the filename to make sure it is properly formatted
 
+    # Set the GPy software clock and the alarm time.  Get the picture time stamps
+    time_stamp, camera_time_stamp = set_clocks(synced)
 
-# Toggle the ESP32-CAM RESET line to initiate the picture capture process
-camera_trigger(0)
-utime.sleep_ms(10)
-camera_trigger(1)
 
 
-# For testing only.  Print a string to the GPy terminal
-print('new picture')
+    # Picture filename.  Transmit this to the ESP32-CAM. It is used for the SD Card filename on the ESP32-CAM
+    picture_filename = station_id + '_' + camera_time_stamp + '_' + voltage_level + '\0'
+    #print("Timestamp", time_stamp)
+    print(picture_filename)  # Print the filename to make sure it is properly formatted
 
 
-# Parse through the data that follows the ESP32-CAM bootup
-#    transmission for the keyword
-# TODO: This needs a timeout escape so that the code does not hang here
-
-# Transmit 'Hello' until 'ready' is received
-keyword = b'ready'  # Expected word from the ESP32-CAM
-utime.sleep(1)
-# Send a greeting followed by reading the response
-while True:
-    uart.write('Hello\0')
-    utime.sleep_ms(200)
-    reply = uart.readline()
-    print(reply)
-    if reply == keyword:
-            break
-
-print("found the keyword")  # The word 'ready' was received
-
-# Send the picture filename to the ESP32-CAM.  This filename will be used
-#   by the ESP32-CAM to store the picture to its local SD-Card.
-utime.sleep_ms(200)
-uart.write(picture_filename)
+    # In the 'binary' and 'stream' modes, connect to the server before the picture capture starts
+    #   so that the upload can begin with the first picture bytes received from the ESP32-CAM
+    upload_socket = None
+    if connected and upload_mode in ('binary', 'stream'):
+        try:
+            upload_socket = connect_to_server()
+        except OSError as e:
+            print("Can not reach the server:", e)
 
 
+    # Trigger the ESP32-CAM and read the picture length
+    trace.begin('camera')
+    picture_len_int = camera_handshake(picture_filename)
+    trace.end('camera')
 
-# Read the picture length from the ESP32-Cam.  Convert the value to an integer
-while True:
-    picture_len = uart.readline()
-    if(picture_len is not None):
-        #print(picture_len)
-        break
-
-
-# Strip the trailing whitespace (e.g. \r\n)
-picture_len_bytes = picture_len.strip()
+    """
+    if not lte.isconnected():
+        print("Lost data connection")
+        connect_to_lte_data()
+    else:
+        print("Still connected")
+    """
 
-# Cast the value to an integer
-picture_len_int = int(picture_len_bytes)
-print(picture_len_int)
+    if picture_len_int > 0:
+        print('Begin transfer')
+        rx.start(camera_transfer_ms)
+        picture_sent = process_picture(picture_len_int, connected, upload_socket)
+        camera.report()
+    elif upload_socket:
+        upload_socket.close()
 
-print('Begin transfer')
+# Turn off the UART port
+uart.deinit()
 
-"""
-if not lte.isconnected():
-    print("Lost data connection")
-    connect_to_lte_data()
-else:
-    print("Still connected")
-"""
+if camera.bytes:
+    trace.span('uart', rx.start_ms, rx.last_ms)
+    trace.count('bytes', camera.bytes)
+    trace.count('naks', camera.naks)
 
-process_picture(picture_len_int)
+# The server has the trace of the earlier wakes with the picture
+if picture_sent:
+    state.add('sent')
+    trace.ack()
 
-# Turn off the UART port
-uart.deinit()
+# Send the pictures left by earlier wakes whenever the network is up, whether or not the
+#   picture of this wake was sent
+if connected:
+    drain_outbox()
 
 # For testing only.  Indicates that the picture processing (capture, encode, transmit) is complete
 print('end transfer')
 
-
+# Refresh the DNS cache for the next wakes before the link goes down
+dns_prefetch(connected)
 
 # Picture transfer is complete so disconnect from the network
 wlan.disconnect()
@@ -696,4 +1525,12 @@ wlan.disconnect()
 
 print("Network disconnected, going to sleep")
 
+energy_report()
+
+# Keep the trace of this wake for the next upload
+trace.count('outbox', len(outbox.entries()))
+trace.count('i2c', ds3231.transactions)
+trace.report()
+trace.save(outbox_stamp_digits(time_stamp))
+
 shutdown()
\ No newline at end of file